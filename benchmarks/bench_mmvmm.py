@@ -0,0 +1,455 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the hot paths of mmvmm against local stand-ins of QEMU, QMP, the tap devices and etcd.
+
+Usage: python3 benchmarks/bench_mmvmm.py [--sizes 10,100,1000] [--vms 5] [--commands 2000]
+                                         [--output results.json] [--compare baseline.json]
+
+Results are written as JSON, every metric has a unit and a direction, so two runs can be compared with --compare.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import statistics
+import tracemalloc
+
+from fakes import install_fakes, MemoryObjectStore, make_description
+
+from bettersocket import BetterSocketIO
+
+from client import Client, AsyncClient, OverloadedError
+from spawn import spawn
+
+from vm_manager import VMMAnager
+from control import SocketCommandProvider, SimpleCommandExecuter
+
+
+class Results(object):
+
+    def __init__(self):
+        self._results = {}
+
+    def add(self, name: str, value: float, unit: str, higher_is_better: bool):
+        self._results[name] = {"value": value, "unit": unit, "higher_is_better": higher_is_better}
+        print(f"{name:45} {value:14.3f} {unit}")
+
+    def add_latencies(self, name: str, samples: list, unit: str = "ms"):
+        samples = sorted(samples)
+        self.add(f"{name}.p50", statistics.median(samples), unit, False)
+        self.add(f"{name}.max", samples[-1], unit, False)
+
+    def dump(self) -> dict:
+        return {
+            "meta": {
+                "timestamp": time.time(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count()
+            },
+            "results": self._results
+        }
+
+
+def _populate(objectstore: MemoryObjectStore, count: int, guest_agent: bool = False):
+    for i in range(count):
+        description = make_description(i)
+        description['hardware']['guest_agent'] = guest_agent
+        objectstore.put(f"/virtualmachines/bench{i}", description)
+
+
+def _wait_for(condition, timeout: float = 30, interval: float = 0.001) -> bool:
+    started = time.monotonic()
+    while not condition():
+        if time.monotonic() - started > timeout:
+            return False
+        time.sleep(interval)
+    return True
+
+
+def bench_load_and_sync(results: Results, sizes: list):
+    for size in sizes:
+        objectstore = MemoryObjectStore()
+        _populate(objectstore, size)
+
+        started = time.perf_counter()
+        manager = VMMAnager(objectstore)
+        results.add(f"load.{size}", (time.perf_counter() - started) * 1000, "ms", False)
+
+        started = time.perf_counter()
+        manager.sync()
+        results.add(f"sync.{size}", (time.perf_counter() - started) * 1000, "ms", False)
+
+
+def bench_storage(results: Results, size: int):
+    """
+    Loads the same descriptions stored in the flat layout, migrates them online, then loads them in the compact format
+    """
+    objectstore = MemoryObjectStore(write_format='flat')
+    _populate(objectstore, size)
+    results.add("storage.flat.keys_per_vm", len(objectstore._keys) / size, "keys", False)
+    results.add("storage.flat.bytes_per_vm", sum(len(value) for value, _ in objectstore._data.values()) / size, "bytes", False)
+
+    started = time.perf_counter()
+    manager = VMMAnager(objectstore)
+    results.add(f"load.flat.{size}", (time.perf_counter() - started) * 1000, "ms", False)
+
+    started = time.perf_counter()
+    migrated = manager.execute_command(None, "migrate_storage", {})['virtualmachines']['migrated']
+    results.add(f"storage.migrate.{size}", (time.perf_counter() - started) * 1000, "ms", False)
+
+    if migrated != size:
+        raise RuntimeError(f"Only {migrated} of {size} descriptions were migrated")
+
+    results.add("storage.compact.keys_per_vm", len(objectstore._keys) / size, "keys", False)
+    results.add("storage.compact.bytes_per_vm", sum(len(value) for value, _ in objectstore._data.values()) / size, "bytes", False)
+
+    started = time.perf_counter()
+    VMMAnager(objectstore)
+    results.add(f"load.compact.{size}", (time.perf_counter() - started) * 1000, "ms", False)
+
+    manager.close(timeout=10)
+
+
+def bench_snapshot(results: Results, sizes: list, workdir: str):
+    for size in sizes:
+        objectstore = MemoryObjectStore()
+        _populate(objectstore, size)
+
+        path = os.path.join(workdir, f"snapshot.{size}")
+        VMMAnager(objectstore, snapshot_path=path).close(timeout=10)
+        results.add(f"snapshot.size.{size}", os.path.getsize(path) / size, "bytes/vm", False)
+
+        started = time.perf_counter()
+        manager = VMMAnager(objectstore, snapshot_path=path)
+        results.add(f"load.snapshot.{size}", (time.perf_counter() - started) * 1000, "ms", False)
+
+        if not _wait_for(lambda: not manager.stats()['snapshot']['catching_up']):
+            raise RuntimeError("Catching up with the store did not finish")
+        results.add(f"catch_up.{size}", manager.stats()['snapshot']['catch_up_time'] * 1000, "ms", False)
+
+        manager.close(timeout=10)
+
+
+def bench_memory(results: Results, size: int):
+    objectstore = MemoryObjectStore()
+    _populate(objectstore, size)
+
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    manager = VMMAnager(objectstore)
+    used = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+
+    results.add("memory.per_vm", used / max(1, len(manager.get_list())), "bytes", False)
+
+
+def bench_control(results: Results, commands: int):
+    objectstore = MemoryObjectStore()
+    _populate(objectstore, 100)
+    manager = VMMAnager(objectstore)
+
+    executer = SimpleCommandExecuter(SocketCommandProvider(rate_limit=0), manager)  # raw throughput, no rate limiting
+    loop_thread = threading.Thread(target=executer.loop, daemon=True)
+    loop_thread.start()
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(SocketCommandProvider.SOCKET_PATH)
+    sockio = BetterSocketIO(sock)
+
+    def roundtrip(command: dict) -> dict:
+        sockio.sendframe(json.dumps(command).encode('utf-8'))
+        response = None
+        while response is None:
+            response = sockio.readframe()
+        return json.loads(response.decode('utf-8'))
+
+    for name, command in [("get_list", {"cmd": "get_list"}), ("is_running", {"cmd": "is_running", "target": "bench0"})]:
+        latencies = []
+        started = time.perf_counter()
+        for _ in range(commands):
+            sent = time.perf_counter()
+            if not roundtrip(command)['success']:
+                raise RuntimeError(f"Command {name} failed")
+            latencies.append((time.perf_counter() - sent) * 1000)
+
+        results.add(f"control.{name}.throughput", commands / (time.perf_counter() - started), "ops/s", True)
+        results.add_latencies(f"control.{name}.latency", latencies)
+
+    sockio.close()
+
+    bench_client(results, commands)
+
+    executer.stop()
+    loop_thread.join(5)
+
+    bench_fairness(results, manager, commands // 10)
+
+
+def bench_client(results: Results, commands: int):
+    """
+    Compares the client library with the one connection per command pattern of the older tools
+    """
+    def per_command_connection():
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(SocketCommandProvider.SOCKET_PATH)
+        sockio = BetterSocketIO(sock)
+        sockio.sendframe(json.dumps({"cmd": "is_running", "target": "bench0"}).encode('utf-8'))
+        response = None
+        while response is None:
+            response = sockio.readframe()
+        sockio.close()
+        return json.loads(response.decode('utf-8'))['result']
+
+    started = time.perf_counter()
+    for _ in range(commands):
+        per_command_connection()
+    results.add("client.per_command_connection.throughput", commands / (time.perf_counter() - started), "ops/s", True)
+
+    with Client(SocketCommandProvider.SOCKET_PATH) as client:
+        vm = client.vm("bench0")
+
+        started = time.perf_counter()
+        for _ in range(commands):
+            vm.is_running()
+        results.add("client.pooled.throughput", commands / (time.perf_counter() - started), "ops/s", True)
+
+        started = time.perf_counter()
+        pipeline = client.pipeline()
+        for _ in range(commands):
+            pipeline.vm("bench0").is_running()
+        pipeline.execute()
+        results.add("client.pipelined.throughput", commands / (time.perf_counter() - started), "ops/s", True)
+
+    async def run_async(concurrency: int = 16):
+        async with AsyncClient(SocketCommandProvider.SOCKET_PATH) as async_client:
+            async_vm = async_client.vm("bench0")
+
+            async def worker(count: int):
+                for _ in range(count):
+                    await async_vm.is_running()
+
+            started = time.perf_counter()
+            await asyncio.gather(*[worker(commands // concurrency) for _ in range(concurrency)])
+            return (commands // concurrency) * concurrency / (time.perf_counter() - started)
+
+    results.add("client.async.throughput", asyncio.run(run_async()), "ops/s", True)
+
+
+def bench_fairness(results: Results, manager: VMMAnager, samples: int):
+    """
+    Latency of an interactive client, while an other connection floods the daemon with pipelined commands
+    """
+    provider = SocketCommandProvider()  # default rate limits
+    executer = SimpleCommandExecuter(provider, manager)
+    loop_thread = threading.Thread(target=executer.loop, daemon=True)
+    loop_thread.start()
+
+    flooding = threading.Event()
+    flooding.set()
+    flood_stats = {"sent": 0, "rejected": 0}
+
+    def flood():
+        with Client(SocketCommandProvider.SOCKET_PATH, pool_size=1, name="flood") as flood_client:
+            while flooding.is_set():
+                pipeline = flood_client.pipeline()
+                for _ in range(256):
+                    pipeline.vm("bench0").is_running()
+
+                for result in pipeline.execute(raise_on_error=False):
+                    flood_stats['sent'] += 1
+                    if isinstance(result, OverloadedError):
+                        flood_stats['rejected'] += 1
+
+    with Client(SocketCommandProvider.SOCKET_PATH, pool_size=1, name="interactive") as client:
+        vm = client.vm("bench0")
+
+        def measure() -> list:
+            latencies = []
+            for _ in range(samples):
+                sent = time.perf_counter()
+                vm.is_running()
+                latencies.append((time.perf_counter() - sent) * 1000)
+                time.sleep(0.001)
+            return latencies
+
+        results.add_latencies("fairness.idle.latency", measure())
+
+        flood_thread = threading.Thread(target=flood, daemon=True)
+        flood_thread.start()
+        time.sleep(0.2)  # let the queue fill up
+        results.add_latencies("fairness.flooded.latency", measure())
+        flooding.clear()
+        flood_thread.join(30)
+
+    results.add("fairness.flood.rejected_ratio", flood_stats['rejected'] / max(1, flood_stats['sent']), "ratio", False)
+
+    executer.stop()
+    loop_thread.join(5)
+
+
+def _rss_mb() -> float:
+    with open("/proc/self/status", "r") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+
+    return 0.0
+
+
+def bench_spawn(results: Results, rss_sizes: list, count: int = 50):
+    """
+    Spawn latency of fork+exec with preexec_fn (the old way of starting QEMU) and spawn(), as the daemon's memory grows
+    """
+    def popen_preexec():
+        return subprocess.Popen(["/bin/true"], preexec_fn=os.setpgrp)
+
+    def posix_spawn():
+        return spawn(["/bin/true"], pidfd=True)
+
+    ballast = []
+    for size in rss_sizes:  # MiB of ballast on top of the daemon itself, written so it is resident
+        ballast.append(bytearray(b"\x01") * ((size - sum(len(b) for b in ballast) // 2 ** 20) * 2 ** 20))
+
+        results.add(f"spawn.rss_{size}mb.rss", _rss_mb(), "MiB", False)
+        for name, method in [("preexec_fn", popen_preexec), ("posix_spawn", posix_spawn)]:
+            latencies = []
+            for _ in range(count):
+                started = time.perf_counter()
+                process = method()
+                latencies.append((time.perf_counter() - started) * 1000)
+                process.wait()
+
+            results.add_latencies(f"spawn.rss_{size}mb.{name}.latency", latencies)
+
+
+def bench_persistence(results: Results, count: int, updates: int = 3):
+    objectstore = MemoryObjectStore()
+    _populate(objectstore, count)
+    manager = VMMAnager(objectstore)
+
+    descriptions = {vm.get_name(): vm.dump_description() for vm in manager.get_vms()}
+
+    started = time.perf_counter()
+    for i in range(updates):
+        for name, description in descriptions.items():
+            description['autostart'] = bool(i % 2)
+            manager.execute_command(name, "update_description", {"new_description": description})
+
+    results.add("persistence.update.throughput", count * updates / (time.perf_counter() - started), "ops/s", True)
+
+    started = time.perf_counter()
+    manager.flush()
+    results.add("persistence.flush", (time.perf_counter() - started) * 1000, "ms", False)
+
+    stats = manager.stats()['persistence']
+    results.add("persistence.stored_per_write", stats['stored'] / max(1, stats['writes']), "ratio", False)
+
+    manager.close(timeout=10)
+
+
+def bench_lifecycle(results: Results, count: int, guest_agent: bool = False):
+    prefix = "lifecycle_agent" if guest_agent else "lifecycle"
+
+    objectstore = MemoryObjectStore()
+    _populate(objectstore, count, guest_agent)
+    manager = VMMAnager(objectstore)
+
+    start_latencies = []
+    ready_latencies = []
+    agent_ready_latencies = []
+    stop_latencies = []
+
+    for vm in manager.get_vms():
+        started = time.perf_counter()
+        vm.start()
+        start_latencies.append((time.perf_counter() - started) * 1000)
+
+        if not _wait_for(lambda: vm._qmp and vm._qmp.is_online()):
+            raise RuntimeError(f"QMP of {vm.get_name()} did not come online")
+        ready_latencies.append((time.perf_counter() - started) * 1000)
+
+        if guest_agent:
+            if not _wait_for(lambda: vm.get_readiness()['ready']):
+                raise RuntimeError(f"Guest agent of {vm.get_name()} did not answer")
+            agent_ready_latencies.append((time.perf_counter() - started) * 1000)
+
+        started = time.perf_counter()
+        vm.poweroff()
+        if not _wait_for(lambda: not vm.is_running()):
+            raise RuntimeError(f"{vm.get_name()} did not power off")
+        stop_latencies.append((time.perf_counter() - started) * 1000)
+
+    results.add_latencies(f"{prefix}.start", start_latencies)
+    results.add_latencies(f"{prefix}.qmp_ready", ready_latencies)
+    if guest_agent:
+        results.add_latencies(f"{prefix}.agent_ready", agent_ready_latencies)
+    results.add_latencies(f"{prefix}.poweroff", stop_latencies)
+
+    manager.close(timeout=10)
+
+
+def compare(current: dict, baseline: dict):
+    print()
+    print(f"{'metric':45} {'baseline':>14} {'current':>14} {'change':>9}")
+    for name, result in current['results'].items():
+        if name not in baseline['results']:
+            continue
+
+        old = baseline['results'][name]['value']
+        new = result['value']
+        change = ((new - old) / old * 100) if old else 0.0
+        better = (change > 0) == result['higher_is_better'] or change == 0
+        print(f"{name:45} {old:14.3f} {new:14.3f} {change:+8.1f}% {'' if better else '(worse)'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="mmvmm benchmarks")
+    parser.add_argument("--sizes", default="10,100,1000", help="Comma separated VM counts for the load/sync benchmark (up to 10000)")
+    parser.add_argument("--vms", type=int, default=5, help="Number of VMs started and stopped for the lifecycle benchmark")
+    parser.add_argument("--commands", type=int, default=2000, help="Number of control commands sent per command type")
+    parser.add_argument("--spawn-rss", default="0,256,1024", help="Comma separated MiB of memory the spawn benchmark grows the daemon to")
+    parser.add_argument("--skip-lifecycle", action="store_true", help="Do not start fake QEMU processes")
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--compare", help="Compare results with a previous JSON result file")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="mmvmm-bench-")
+    install_fakes(workdir)
+
+    results = Results()
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    bench_load_and_sync(results, sizes)
+    bench_snapshot(results, sizes, workdir)
+    bench_storage(results, max(sizes))
+    bench_memory(results, max(sizes))
+    bench_control(results, args.commands)
+    bench_persistence(results, min(max(sizes), 1000))
+
+    if not args.skip_lifecycle:
+        bench_lifecycle(results, args.vms)
+        bench_lifecycle(results, args.vms, guest_agent=True)
+
+    bench_spawn(results, [int(size) for size in args.spawn_rss.split(',')])  # last, it grows the process
+
+    dumped = results.dump()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(dumped, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            compare(dumped, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Compares the precompiled schema fast path with plain marshmallow.
+Also verifies that both give identical results and errors on a set of valid and invalid inputs.
+
+Usage: python3 benchmarks/bench_schema.py [iterations]
+"""
+import os
+import sys
+import copy
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mmvmm"))
+
+from marshmallow.exceptions import ValidationError  # noqa: E402
+
+from schema import VMDescriptionSchema, ControlCommandSchema  # noqa: E402
+from fastschema import CompiledSchema  # noqa: E402
+
+DESCRIPTION = {
+    "hardware": {
+        "cpu": 2,
+        "ram": 2048,
+        "boot": "c",
+        "network": [
+            {"model": "virtio-net", "mac": "52:54:00:12:34:56", "master": "br0"},
+            {"mac": "52:54:00:12:34:57", "master": "br1"}
+        ],
+        "media": [
+            {"type": "disk", "path": "/var/lib/mmvmm/test.qcow2", "format": "qcow2"},
+            {"type": "cdrom", "path": "/var/lib/mmvmm/install.iso", "format": "raw", "readonly": True}
+        ]
+    },
+    "vnc": {"enabled": True},
+    "autostart": True,
+    "tags": ["web", "production"]
+}
+
+COMMAND = {"target": "test", "cmd": "is_running", "args": {}}
+
+
+def _invalid_descriptions() -> list:
+    invalid = []
+
+    for path, value in [
+        (("hardware", "cpu"), 0),
+        (("hardware", "cpu"), "2"),
+        (("hardware", "ram"), None),
+        (("hardware", "boot"), "x"),
+        (("hardware", "rtc_utc"), "yes"),
+        (("hardware", "network", 0, "mac"), "52:54:00:12:34"),
+        (("hardware", "media", 0, "path"), "relative/path"),
+        (("hardware", "media", 1, "format"), "vmdk"),
+        (("vnc", "enabled"), 1),
+        (("tags",), ["web", ""]),
+        (("tags",), "web"),
+        (("unknown",), True),
+    ]:
+        description = copy.deepcopy(DESCRIPTION)
+        target = description
+        for key in path[:-1]:
+            target = target[key]
+        target[path[-1]] = value
+        invalid.append(description)
+
+    description = copy.deepcopy(DESCRIPTION)
+    del description["vnc"]
+    invalid.append(description)
+
+    return invalid
+
+
+def _result(schema, data):
+    try:
+        return "ok", schema.load(data)
+    except ValidationError as e:
+        return "error", e.messages
+
+
+def verify(marshmallow_schema, compiled_schema, inputs: list):
+    for data in inputs:
+        fast = _result(compiled_schema, data)
+        slow = _result(marshmallow_schema, data)
+
+        if fast != slow:
+            raise AssertionError(f"Result mismatch for {data}: {fast} != {slow}")
+
+        if fast[0] == "ok" and compiled_schema.dump(fast[1]) != marshmallow_schema.dump(slow[1]):
+            raise AssertionError(f"Dump mismatch for {data}")
+
+
+def bench(name: str, func, iterations: int):
+    seconds = timeit.timeit(func, number=iterations)
+    print(f"{name:40} {iterations / seconds:12.0f} ops/s {seconds / iterations * 1e6:10.2f} us/op")
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+    description_schema = VMDescriptionSchema(many=False)
+    compiled_description_schema = CompiledSchema(description_schema)
+    command_schema = ControlCommandSchema(many=False)
+    compiled_command_schema = CompiledSchema(command_schema)
+
+    verify(description_schema, compiled_description_schema, [DESCRIPTION] + _invalid_descriptions())
+    verify(command_schema, compiled_command_schema, [COMMAND, {"cmd": "get_list"}, {"cmd": ""}, {"cmd": "x", "foo": 1}, {"args": {}}])
+    print("Fast path results are identical to marshmallow's")
+
+    loaded = description_schema.load(DESCRIPTION)
+    CompiledSchema.set_enabled(True)
+
+    bench("marshmallow description load", lambda: description_schema.load(DESCRIPTION), iterations)
+    bench("compiled description load", lambda: compiled_description_schema.load(DESCRIPTION), iterations)
+    bench("marshmallow description dump", lambda: description_schema.dump(loaded), iterations)
+    bench("compiled description dump", lambda: compiled_description_schema.dump(loaded), iterations)
+    bench("marshmallow command load", lambda: command_schema.load(COMMAND), iterations)
+    bench("compiled command load", lambda: compiled_command_schema.load(COMMAND), iterations)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+A stand-in for the QEMU binary. It does not emulate anything, but speaks QMP on the socket given by -qmp,
+emits the lifecycle events mmvmm listens to and exits on system_powerdown like a well-behaving guest would.
+When a guest agent chardev is given, a fake guest agent answers on it after FAKE_QEMU_BOOT_DELAY seconds (default: 0.5).
+"""
+import os
+import sys
+import json
+import time
+import socket
+import signal
+import threading
+
+BALLOON_BYTES_PER_MB = 1024 * 1024
+
+
+def _parse_args(argv: list) -> dict:
+    options = {}
+    i = 1
+    while i < len(argv):
+        if argv[i].startswith('-') and i + 1 < len(argv) and not argv[i + 1].startswith('-'):
+            options.setdefault(argv[i], []).append(argv[i + 1])
+            i += 2
+        else:
+            options.setdefault(argv[i], [])
+            i += 1
+
+    return options
+
+
+class FakeQEMU(object):
+
+    def __init__(self, argv: list):
+        options = _parse_args(argv)
+
+        qmp_spec = options['-qmp'][0]  # unix:PATH,server,nowait
+        self._socket_path = qmp_spec[len("unix:"):].split(',')[0]
+
+        self._ram = int(options.get('-m', ['128'])[0].split(',')[0])
+        self._balloon = self._ram
+
+        smp = options.get('-smp', ['1'])[0].split(',')
+        self._cpus = int(smp[0])
+        self._max_cpus = int(dict(item.split('=', 1) for item in smp[1:]).get('maxcpus', self._cpus))
+
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(self._socket_path)
+        self._server.listen(1)
+
+        self._client = None
+        self._command_id = None
+        self._buffer = b""
+        self._send_lock = threading.Lock()
+
+        self._agent_path = None
+        for chardev in options.get('-chardev', []):
+            settings = dict(item.split('=', 1) for item in chardev.split(',')[1:] if '=' in item)
+            if settings.get('id') == 'qga0':
+                self._agent_path = settings['path']
+
+        self._booted_at = time.monotonic() + float(os.environ.get("FAKE_QEMU_BOOT_DELAY", "0.5"))
+        self._frozen = False
+
+        signal.signal(signal.SIGTERM, self._on_sigterm)
+
+    def _send(self, data: dict):
+        with self._send_lock:
+            self._client.sendall(json.dumps(data).encode('utf-8') + b"\n")
+
+    def _agent_handle(self, command: dict):
+        execute = command.get('execute')
+
+        if execute == 'guest-sync':
+            return {"return": command['arguments']['id']}
+        elif execute == 'guest-shutdown':
+            if self._client:
+                self._event("SHUTDOWN", {"guest": True, "reason": "guest-shutdown"})
+            self._exit()
+        elif execute in ('guest-fsfreeze-freeze', 'guest-fsfreeze-thaw'):
+            self._frozen = execute == 'guest-fsfreeze-freeze'
+            return {"return": 1}
+        elif execute == 'guest-fsfreeze-status':
+            return {"return": "frozen" if self._frozen else "thawed"}
+
+        return {"return": {}}
+
+    def _agent_serve(self):
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self._agent_path)
+        server.listen(1)
+
+        while True:
+            client, _ = server.accept()
+            reader = client.makefile('rb')
+
+            for line in reader:
+                if time.monotonic() < self._booted_at:  # The agent does not run until the guest is booted
+                    continue
+
+                response = self._agent_handle(json.loads(line.decode('utf-8')))
+                client.sendall(json.dumps(response).encode('utf-8') + b"\n")
+
+            client.close()
+
+    def _reply(self, response: dict):
+        if self._command_id is not None:  # echoed like QEMU does
+            response['id'] = self._command_id
+        self._send(response)
+
+    def _event(self, event: str, data: dict = None):
+        self._send({"event": event, "data": data or {}, "timestamp": {"seconds": 0, "microseconds": 0}})
+
+    def _recv(self):
+        while b"\n" not in self._buffer:
+            chunk = self._client.recv(4096)
+            if not chunk:
+                return None
+            self._buffer += chunk
+
+        line, self._buffer = self._buffer.split(b"\n", 1)
+        return json.loads(line.decode('utf-8'))
+
+    def _exit(self):
+        for path in (self._socket_path, self._agent_path):
+            try:
+                if path:
+                    os.unlink(path)
+            except OSError:
+                pass
+
+        os._exit(0)
+
+    def _on_sigterm(self, signum, frame):
+        if self._client:
+            try:
+                self._event("SHUTDOWN", {"guest": False, "reason": "host-signal"})
+            except OSError:
+                pass
+
+        self._exit()
+
+    def _handle(self, command: dict):
+        execute = command.get('execute')
+        arguments = command.get('arguments', {})
+
+        if execute == 'system_powerdown':
+            self._reply({"return": {}})
+            self._event("POWERDOWN")
+            self._event("SHUTDOWN", {"guest": True, "reason": "guest-shutdown"})
+            self._exit()
+
+        elif execute == 'system_reset':
+            self._reply({"return": {}})
+            self._event("RESET", {"guest": False, "reason": "host-qmp-system-reset"})
+
+        elif execute == 'stop':
+            self._reply({"return": {}})
+            self._event("STOP")
+
+        elif execute == 'cont':
+            self._reply({"return": {}})
+            self._event("RESUME")
+
+        elif execute == 'balloon':
+            self._balloon = arguments['value'] // BALLOON_BYTES_PER_MB
+            self._reply({"return": {}})
+
+        elif execute == 'query-balloon':
+            self._reply({"return": {"actual": self._balloon * BALLOON_BYTES_PER_MB}})
+
+        elif execute == 'query-hotpluggable-cpus':
+            slots = []
+            for i in range(self._max_cpus):
+                slot = {"type": "fake-x86_64-cpu", "vcpus-count": 1, "props": {"socket-id": i, "core-id": 0, "thread-id": 0}}
+                if i < self._cpus:
+                    slot['qom-path'] = f"/machine/unattached/device[{i}]"
+                slots.append(slot)
+            self._reply({"return": slots})
+
+        elif execute == 'device_add' and arguments.get('driver') == 'fake-x86_64-cpu':
+            self._cpus += 1
+            self._reply({"return": {}})
+
+        elif execute == 'x-fake-hang':  # never answered, like a hung QEMU
+            pass
+
+        elif execute == 'device_del':  # The guest releases the device immediately
+            self._reply({"return": {}})
+            self._event("DEVICE_DELETED", {"device": arguments['id']})
+
+        else:
+            self._reply({"return": {}})
+
+    def run(self):
+        if self._agent_path:
+            threading.Thread(target=self._agent_serve, daemon=True).start()
+
+        self._client, _ = self._server.accept()
+        self._send({"QMP": {"version": {"qemu": {"major": 0, "minor": 0, "micro": 0}, "package": "fake"}, "capabilities": []}})
+
+        while True:
+            try:
+                command = self._recv()
+            except OSError:
+                command = None
+
+            if command is None:  # QMP connection closed, keep running like QEMU does, until killed
+                while True:
+                    signal.pause()
+
+            self._command_id = command.get('id')
+            self._handle(command)
+
+
+if __name__ == "__main__":
+    FakeQEMU(sys.argv).run()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+Local stand-ins for the external dependencies of mmvmm: etcd, the tap device backend and QEMU itself.
+"""
+import os
+import sys
+import bisect
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mmvmm"))
+
+import etcd3  # noqa: E402
+import etcd3.etcdrpc  # noqa: E402
+import etcd3.transactions  # noqa: E402
+import etcd3.utils  # noqa: E402
+from etcd3.client import Transactions  # noqa: E402
+
+import vm  # noqa: E402
+import qmp  # noqa: E402
+import cgroup  # noqa: E402
+import control  # noqa: E402
+from objectstore import ObjectStore  # noqa: E402
+
+FAKE_QEMU_BINARY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_qemu.py")
+
+
+class _KeyMetadata(object):
+
+    def __init__(self, key: bytes, mod_revision: int):
+        self.key = key
+        self.mod_revision = mod_revision
+
+
+class _DeleteResponse(object):
+
+    def __init__(self, deleted: int):
+        self.deleted = deleted
+
+    def __bool__(self):
+        return True
+
+
+class _MemoryKV(etcd3.Etcd3Client):
+    """
+    In-memory replacement for the key-value calls of Etcd3Client used by ObjectStore.
+    Keys are kept sorted, so range operations are logarithmic like in etcd.
+    """
+
+    def __init__(self):  # pylint: disable=super-init-not-called
+        self._data = {}
+        self._keys = []  # sorted
+        self.revision = 0
+        self.transactions = Transactions()
+
+    @staticmethod
+    def _to_bytes(key) -> bytes:
+        return key.encode('utf-8') if isinstance(key, str) else key
+
+    def _set(self, key: bytes, value: bytes):
+        if key not in self._data:
+            bisect.insort(self._keys, key)
+
+        self._data[key] = (value, self.revision)
+
+    def _range(self, start: bytes, end: bytes) -> list:
+        return self._keys[bisect.bisect_left(self._keys, start):bisect.bisect_left(self._keys, end)]
+
+    def _delete_range(self, start: bytes, end: bytes) -> int:
+        low, high = bisect.bisect_left(self._keys, start), bisect.bisect_left(self._keys, end)
+        for key in self._keys[low:high]:
+            del self._data[key]
+
+        del self._keys[low:high]
+        return high - low
+
+    def put(self, key: str, value: bytes, *args, **kwargs):
+        self.revision += 1
+        self._set(self._to_bytes(key), value)
+
+    def get(self, key: str, *args, **kwargs):
+        key = self._to_bytes(key)
+        if key not in self._data:
+            return None, None
+
+        value, revision = self._data[key]
+        return value, _KeyMetadata(key, revision)
+
+    def get_prefix(self, key_prefix: str, *args, **kwargs):
+        prefix = self._to_bytes(key_prefix)
+        for key in self._range(prefix, etcd3.utils.increment_last_byte(prefix)):
+            value, revision = self._data[key]
+            yield value, _KeyMetadata(key, revision)
+
+    def get_prefix_response(self, key_prefix: str, *args, **kwargs):
+        prefix = self._to_bytes(key_prefix)
+        kvs = []
+        for key in self._range(prefix, etcd3.utils.increment_last_byte(prefix)):
+            value, revision = self._data[key]
+            kvs.append(SimpleNamespace(key=key, value=value, mod_revision=revision))
+
+        return SimpleNamespace(kvs=kvs, header=SimpleNamespace(revision=self.revision))
+
+    def delete_prefix(self, prefix: str):
+        prefix = self._to_bytes(prefix)
+        deleted = self._delete_range(prefix, etcd3.utils.increment_last_byte(prefix))
+
+        if deleted:
+            self.revision += 1
+
+        return _DeleteResponse(deleted)
+
+    _COMPARE_OPERATORS = {
+        etcd3.etcdrpc.Compare.EQUAL: lambda a, b: a == b,
+        etcd3.etcdrpc.Compare.NOT_EQUAL: lambda a, b: a != b,
+        etcd3.etcdrpc.Compare.LESS: lambda a, b: a < b,
+        etcd3.etcdrpc.Compare.GREATER: lambda a, b: a > b
+    }
+
+    def _compare(self, compare) -> bool:
+        if not isinstance(compare, etcd3.transactions.Mod):
+            raise NotImplementedError(f"Unsupported compare: {type(compare).__name__}")
+
+        key = self._to_bytes(compare.key)
+        if compare.range_end is None:
+            revisions = [self._data[key][1] if key in self._data else 0]
+        else:
+            revisions = [self._data[k][1] for k in self._range(key, self._to_bytes(compare.range_end))]
+
+        return all(self._COMPARE_OPERATORS[compare.op](revision, compare.value) for revision in revisions)
+
+    def transaction(self, compare, success=None, failure=None):
+        succeeded = all(self._compare(c) for c in compare)
+
+        self.revision += 1
+        for operation in (success if succeeded else failure) or []:
+            key = self._to_bytes(operation.key)
+
+            if isinstance(operation, etcd3.transactions.Put):
+                self._set(key, operation.value)
+
+            elif isinstance(operation, etcd3.transactions.Delete):
+                self._delete_range(key, self._to_bytes(operation.range_end) if operation.range_end else key + b'\x00')
+
+            else:
+                raise NotImplementedError(f"Unsupported operation: {type(operation).__name__}")
+
+        return succeeded, []
+
+    def delete(self, key: str, *args, **kwargs):
+        if not self._delete_range(self._to_bytes(key), self._to_bytes(key) + b'\x00'):
+            return False
+
+        self.revision += 1
+        return True
+
+
+class MemoryObjectStore(ObjectStore, _MemoryKV):
+    """
+    ObjectStore with it's etcd client replaced by an in-memory dictionary.
+    The encoding done by ObjectStore is kept, so it's cost is measured as well.
+    """
+    pass
+
+
+class FakeTAPDevice(object):
+    """
+    Same interface as TAPDevice, without touching the host's network configuration
+    """
+
+    _next_devid = 0
+
+    def __init__(self, master: str):
+        self._devname = f"faketap{FakeTAPDevice._next_devid}"
+        FakeTAPDevice._next_devid += 1
+        self._masterdevname = master
+
+    def update_master(self, master: str):
+        self._masterdevname = master
+
+    @property
+    def device(self) -> str:
+        return self._devname
+
+    @property
+    def master(self) -> str:
+        return self._masterdevname
+
+    def free(self):
+        pass
+
+
+def install_fakes(workdir: str):
+    """
+    Redirects mmvmm to the fake QEMU binary, the fake tap devices, and sockets and cgroups under workdir
+    """
+    os.makedirs(workdir, exist_ok=True)
+
+    vm.QEMU_BINARY = FAKE_QEMU_BINARY
+    vm.TAPDevice = FakeTAPDevice
+    qmp.SOCKET_DIR = workdir
+    cgroup.CGROUP_ROOT = os.path.join(workdir, "cgroup")
+    control.SocketCommandProvider.SOCKET_PATH = os.path.join(workdir, "control.sock")
+
+
+def make_description(index: int, nics: int = 1) -> dict:
+    return {
+        "hardware": {
+            "cpu": 1,
+            "ram": 128,
+            "boot": "c",
+            "network": [
+                {"mac": f"52:54:{(index >> 16) & 0xff:02x}:{(index >> 8) & 0xff:02x}:{index & 0xff:02x}:{n:02x}", "master": "br0"}
+                for n in range(nics)
+            ],
+            "media": [
+                {"type": "disk", "path": f"/var/lib/mmvmm/bench{index}.qcow2", "format": "qcow2"}
+            ]
+        },
+        "vnc": {"enabled": False},
+        "autostart": False
+    }
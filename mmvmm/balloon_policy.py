@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+import os
+import time
+import logging
+from threading import Thread, Event
+
+from exception import VMError
+
+
+class BalloonPolicy(Thread):
+    """
+    Reclaims memory from idle guests using their balloon device when the host's available memory drops below a watermark.
+    Memory is given back to the guests once the host recovers above the high watermark.
+    """
+
+    CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+    def __init__(self, vmmanager, low_watermark: int, high_watermark: int = None, interval: float = 10,
+                 step: int = 256, min_ratio: float = 0.25, idle_threshold: float = 0.05):
+        Thread.__init__(self, daemon=True)
+        self._logger = logging.getLogger("balloon")
+
+        self._vmmanager = vmmanager
+
+        self._low_watermark = low_watermark  # MByte
+        self._high_watermark = high_watermark or low_watermark * 2  # MByte
+        self._interval = interval
+        self._step = step  # MByte reclaimed from a single guest in one round
+        self._min_ratio = min_ratio  # Guests are never shrinked below this ratio of their configured ram
+        self._idle_threshold = idle_threshold  # CPU usage (1.0 = one full core) below which a guest considered idle
+
+        self._cpu_times = {}  # pid -> (timestamp, cpu seconds)
+
+        self._stop_event = Event()
+
+    @staticmethod
+    def _get_host_available_memory() -> int:
+        """
+        Returns the available memory of the host in MByte
+        """
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) // 1024
+
+        raise RuntimeError("MemAvailable not found in /proc/meminfo")
+
+    @staticmethod
+    def _get_process_cpu_time(pid: int) -> float:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            stat = f.read()
+
+        # The process name may contain spaces, so the fields after it are counted from the closing bracket
+        fields = stat[stat.rindex(')') + 2:].split()
+        return (int(fields[11]) + int(fields[12])) / BalloonPolicy.CLOCK_TICKS  # utime + stime
+
+    def _is_idle(self, pid: int) -> bool:
+        now = time.monotonic()
+        cpu_time = self._get_process_cpu_time(pid)
+
+        previous = self._cpu_times.get(pid)
+        self._cpu_times[pid] = (now, cpu_time)
+
+        if not previous or now <= previous[0]:
+            return False  # No sample yet
+
+        return (cpu_time - previous[1]) / (now - previous[0]) < self._idle_threshold
+
+    def _ballooned_vms(self) -> list:
+        vms = []
+        for vm in self._vmmanager.get_vms():
+            pid = vm.get_pid()
+            if pid and vm.has_balloon():
+                vms.append((vm, pid))
+
+        return vms
+
+    def _inflate(self, vms: list):
+        for vm, pid in vms:
+            try:
+                if not self._is_idle(pid):
+                    continue
+
+                current = vm.get_balloon()
+                target = max(int(vm.get_ram() * self._min_ratio), current - self._step)
+
+                if target < current:
+                    self._logger.info(f"Reclaiming memory from idle VM {vm.get_name()}: {current}MB -> {target}MB")
+                    vm.set_balloon(target)
+
+            except (VMError, ConnectionError, OSError) as e:
+                self._logger.debug(f"Could not balloon {vm.get_name()}: {str(e)}")
+
+    def _deflate(self, vms: list):
+        for vm, pid in vms:
+            try:
+                current = vm.get_balloon()
+                ram = vm.get_ram()
+
+                if current < ram:
+                    target = min(ram, current + self._step)
+                    self._logger.info(f"Giving back memory to VM {vm.get_name()}: {current}MB -> {target}MB")
+                    vm.set_balloon(target)
+
+            except (VMError, ConnectionError, OSError) as e:
+                self._logger.debug(f"Could not balloon {vm.get_name()}: {str(e)}")
+
+    def run(self):
+        self._logger.info(f"Balloon policy started (low watermark: {self._low_watermark}MB, high watermark: {self._high_watermark}MB)")
+
+        while not self._stop_event.wait(self._interval):
+
+            try:
+                available = self._get_host_available_memory()
+            except (OSError, RuntimeError) as e:
+                self._logger.error(f"Could not read host memory information: {str(e)}")
+                continue
+
+            vms = self._ballooned_vms()
+
+            # forget processes that are no longer running
+            pids = [pid for _, pid in vms]
+            self._cpu_times = {pid: sample for pid, sample in self._cpu_times.items() if pid in pids}
+
+            if available < self._low_watermark:
+                self._logger.debug(f"Host available memory is low: {available}MB")
+                self._inflate(vms)
+            elif available > self._high_watermark:
+                self._deflate(vms)
+            else:
+                # Keep sampling CPU usage, so idle detection is accurate when memory becomes low
+                for _, pid in vms:
+                    try:
+                        self._is_idle(pid)
+                    except OSError:
+                        pass
+
+    def stop(self):
+        self._stop_event.set()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+import os
+import logging
+
+CGROUP_ROOT = "/sys/fs/cgroup/mmvmm"  # None disables placing VMs into cgroups
+
+CONTROLLERS = ['cpu', 'memory', 'io']
+
+CPU_PERIOD = 100000  # usec
+
+
+class CGroup(object):
+    """
+    A cgroup v2 leaf holding the QEMU process of a single VM.
+    The root must not contain processes itself (cgroup v2 "no internal processes" rule), mmvmm should not run in it.
+    """
+
+    def __init__(self, name: str, root: str = None):
+        self._logger = logging.getLogger("cgroup")
+        self._root = root or CGROUP_ROOT
+        self._path = os.path.join(self._root, f"vm-{name}")
+
+    @staticmethod
+    def enabled() -> bool:
+        return bool(CGROUP_ROOT)
+
+    def get_path(self) -> str:
+        return self._path
+
+    def _write(self, filename: str, value: str, path: str = None):
+        with open(os.path.join(path or self._path, filename), "w") as f:
+            f.write(value)
+
+    def _read(self, filename: str) -> str:
+        try:
+            with open(os.path.join(self._path, filename), "r") as f:
+                return f.read()
+        except FileNotFoundError:  # The controller is not enabled
+            return None
+
+    def create(self):
+        os.makedirs(self._root, exist_ok=True)
+
+        # Enable the controllers for the leaves. Fails if the parent of the root does not have them enabled.
+        self._write("cgroup.subtree_control", ' '.join(f"+{controller}" for controller in CONTROLLERS), path=self._root)
+
+        os.makedirs(self._path, exist_ok=True)
+
+    def apply(self, resources: dict):
+        """
+        Writes the limits of a resources description. Can be called any time, the limits are applied immediately.
+        """
+        if resources['cpu_max']:
+            self._write("cpu.max", f"{resources['cpu_max'] * CPU_PERIOD // 100} {CPU_PERIOD}")
+        else:
+            self._write("cpu.max", f"max {CPU_PERIOD}")
+
+        self._write("cpu.weight", str(resources['cpu_weight']))
+        self._write("memory.max", str(resources['memory_max'] * 1024 * 1024) if resources['memory_max'] else "max")
+        self._write("memory.high", str(resources['memory_high'] * 1024 * 1024) if resources['memory_high'] else "max")
+        self._write("io.weight", f"default {resources['io_weight']}")
+
+    def get_procs_path(self) -> str:
+        return os.path.join(self._path, "cgroup.procs")
+
+    @staticmethod
+    def _parse_flat_keyed(content: str) -> dict:
+        result = {}
+        for line in content.splitlines():
+            key, _, value = line.partition(' ')
+            if value:
+                result[key] = int(value)
+
+        return result
+
+    def usage(self) -> dict:
+        """
+        Returns the resource usage accounted by the kernel: cpu time (usec), memory (bytes) and I/O per device
+        """
+        cpu_stat = self._read("cpu.stat")
+        memory_current = self._read("memory.current")
+        io_stat = self._read("io.stat")
+
+        io = {}
+        if io_stat:
+            for line in io_stat.splitlines():  # MAJ:MIN rbytes=... wbytes=... rios=... wios=... dbytes=... dios=...
+                device, *counters = line.split()
+                io[device] = {key: int(value) for key, _, value in (counter.partition('=') for counter in counters)}
+
+        io_total = {}
+        for counters in io.values():
+            for key, value in counters.items():
+                io_total[key] = io_total.get(key, 0) + value
+
+        return {
+            "cpu": self._parse_flat_keyed(cpu_stat) if cpu_stat else None,
+            "memory": int(memory_current) if memory_current else None,
+            "io": {"total": io_total, "devices": io}
+        }
+
+    def destroy(self):
+        try:
+            os.rmdir(self._path)  # Only succeeds once the QEMU process is gone
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            self._logger.warning(f"Could not remove cgroup {self._path}: {str(e)}")
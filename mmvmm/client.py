@@ -0,0 +1,717 @@
+#!/usr/bin/env python3
+"""
+Client of the mmvmm control socket, with a blocking (Client) and an asyncio (AsyncClient) API.
+
+Commands are newline delimited JSON frames, like SocketCommandProvider expects them. Every request carries an id,
+which the daemon echoes back, so several requests can be in flight on the same connection (pipelining).
+Connections are pooled and reused between commands. With a timeout, requests carry a deadline, and the daemon
+gives up on commands that could not finish in time (CommandTimeoutError). Connections exceeding their rate limit
+get OverloadedError. Background tools should pass a weight below 1, so interactive clients are served first.
+
+Usage: python3 client.py [--socket PATH] [--timeout SEC] [--vm NAME] <command> [arg=value ...]
+       python3 client.py [--socket PATH] subscribe [--vm NAME] [--type TYPE]
+
+Argument values are parsed as JSON where possible, otherwise passed as strings.
+"""
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import itertools
+from threading import Lock, BoundedSemaphore
+from collections import deque
+from contextlib import contextmanager
+
+SOCKET_PATH = "/run/mmvmm/control.sock"
+
+
+class CommandError(Exception):
+    """
+    The daemon executed the command, and reported an error
+    """
+
+    def __init__(self, cmd: str, target: str, error: str):
+        super().__init__(error)
+        self.cmd = cmd
+        self.target = target
+        self.error = error
+
+
+class CommandTimeoutError(CommandError):
+    """
+    The daemon gave up on the command, because it's deadline passed. It might have been partially executed.
+    """
+    pass
+
+
+class OverloadedError(CommandError):
+    """
+    The daemon rejected the command without executing it, because the connection exceeded it's rate limit or queue size
+    """
+    pass
+
+
+TIMEOUT_GRACE = 1  # sec, the client waits this much longer than the deadline, so the daemon can report the timeout
+
+
+def _encode(request_id: int, cmd: str, target: str, args: dict, timeout: float = None) -> bytes:
+    request = {"cmd": cmd, "target": target, "args": args or {}, "id": request_id}
+    if timeout:
+        request['deadline'] = time.time() + timeout
+
+    return json.dumps(request).encode('utf-8') + b"\n"
+
+
+def _session(name: str, weight: float) -> dict:
+    if name is None and weight is None:
+        return None
+
+    return {"name": name, "weight": weight}
+
+
+def _result(response: dict, cmd: str, target: str) -> object:
+    if not response.get('success'):
+        if response.get('overload'):
+            raise OverloadedError(cmd, target, response.get('error'))
+
+        raise (CommandTimeoutError if response.get('timeout') else CommandError)(cmd, target, response.get('error'))
+
+    return response.get('result')
+
+
+class _ManagerCommands(object):
+    """
+    Typed wrappers of the commands exposed by VMMAnager. The results come from call(), so they are awaitable in the asyncio client.
+    """
+
+    def call(self, cmd: str, target: str = None, args: dict = None) -> object:
+        raise NotImplementedError()
+
+    def vm(self, name: str) -> 'VMHandle':
+        return VMHandle(self, name)
+
+    def get_list(self) -> list:
+        return self.call("get_list")
+
+    def query(self, filters: dict = None, fields: list = None, limit: int = 100, cursor: str = None) -> dict:
+        return self.call("query", args={"filters": filters, "fields": fields, "limit": limit, "cursor": cursor})
+
+    def new(self, name: str, description: dict):
+        return self.call("new", args={"name": name, "description": description})
+
+    def clone(self, template: str, names: list, autostart: bool = False, parallel: int = 8) -> dict:
+        return self.call("clone", args={"template": template, "names": names, "autostart": autostart, "parallel": parallel})
+
+    def release_template(self, name: str):
+        return self.call("release_template", args={"name": name})
+
+    def delete(self, name: str):
+        return self.call("delete", args={"name": name})
+
+    def sync(self):
+        return self.call("sync")
+
+    def flush(self, timeout: float = None):
+        return self.call("flush", args={"timeout": timeout})
+
+    def migrate_storage(self) -> dict:
+        return self.call("migrate_storage")
+
+    def get_qos_classes(self) -> dict:
+        return self.call("get_qos_classes")
+
+    def set_qos_class(self, name: str, limits: dict):
+        return self.call("set_qos_class", args={"name": name, "limits": limits})
+
+    def delete_qos_class(self, name: str):
+        return self.call("delete_qos_class", args={"name": name})
+
+    def stats(self, prefix: str = None, spans: int = 0) -> dict:
+        return self.call("stats", args={"prefix": prefix, "spans": spans})
+
+    def set_tracing(self, enabled: bool, export: bool = False):
+        return self.call("set_tracing", args={"enabled": enabled, "export": export})
+
+    def set_fast_schema(self, enabled: bool):
+        return self.call("set_fast_schema", args={"enabled": enabled})
+
+
+class VMHandle(object):
+    """
+    Typed wrappers of the commands exposed by VM, sent through the client (or pipeline) it was created by
+    """
+
+    def __init__(self, owner: _ManagerCommands, name: str):
+        self._owner = owner
+        self.name = name
+
+    def call(self, cmd: str, args: dict = None) -> object:
+        return self._owner.call(cmd, self.name, args)
+
+    def start(self):
+        return self.call("start")
+
+    def poweroff(self):
+        return self.call("poweroff")
+
+    def terminate(self, kill: bool = False):
+        return self.call("terminate", {"kill": kill})
+
+    def reset(self):
+        return self.call("reset")
+
+    def pause(self):
+        return self.call("pause")
+
+    def cont(self):
+        return self.call("cont")
+
+    def is_running(self) -> bool:
+        return self.call("is_running")
+
+    def get_name(self) -> str:
+        return self.call("get_name")
+
+    def get_vnc_port(self) -> int:
+        return self.call("get_vnc_port")
+
+    def dump_description(self) -> dict:
+        return self.call("dump_description")
+
+    def update_description(self, new_description: dict) -> dict:
+        return self.call("update_description", {"new_description": new_description})
+
+    def get_pending_restart(self) -> list:
+        return self.call("get_pending_restart")
+
+    def set_balloon(self, target: int):
+        return self.call("set_balloon", {"target": target})
+
+    def get_balloon(self) -> int:
+        return self.call("get_balloon")
+
+    def get_readiness(self) -> dict:
+        return self.call("get_readiness")
+
+    def guest_ping(self):
+        return self.call("guest_ping")
+
+    def guest_fsfreeze(self, freeze: bool) -> int:
+        return self.call("guest_fsfreeze", {"freeze": freeze})
+
+    def guest_fsfreeze_status(self) -> str:
+        return self.call("guest_fsfreeze_status")
+
+    def set_io_throttle(self, index: int, throttle: dict = None, qos: str = None):
+        return self.call("set_io_throttle", {"index": index, "throttle": throttle, "qos": qos})
+
+    def get_io_throttle(self) -> list:
+        return self.call("get_io_throttle")
+
+    def set_resources(self, resources: dict):
+        return self.call("set_resources", {"resources": resources})
+
+    def get_usage(self) -> dict:
+        return self.call("get_usage")
+
+
+## BLOCKING API ##
+
+
+class Connection(object):
+    """
+    A single connection of the control socket. Not thread safe, the pool hands it out to one user at a time.
+    """
+
+    RECV_CHUNK = 65536
+
+    def __init__(self, path: str = SOCKET_PATH, timeout: float = None, session: dict = None):
+        self._timeout = timeout
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout + TIMEOUT_GRACE if timeout else None)
+        try:
+            self._sock.connect(path)
+        except OSError:
+            self._sock.close()
+            raise
+
+        self._buffer = b""
+        self._ids = itertools.count(1)
+        self._outstanding = deque()  # (id, cmd, target) of the requests sent, but not answered yet
+        self._early = {}  # id -> response received before the ones of earlier requests (e.g. rejected right away)
+        self.closed = False
+
+        if session:
+            try:
+                self.call("session", None, session)
+            except BaseException:
+                self.close()
+                raise
+
+    def send(self, cmd: str, target: str = None, args: dict = None):
+        request_id = next(self._ids)
+        self._sock.sendall(_encode(request_id, cmd, target, args, self._timeout))
+        self._outstanding.append((request_id, cmd, target))
+
+    def _read_frame(self) -> dict:
+        while b"\n" not in self._buffer:
+            chunk = self._sock.recv(self.RECV_CHUNK)
+            if not chunk:
+                raise ConnectionResetError("The daemon closed the connection")
+
+            self._buffer += chunk
+
+        frame, self._buffer = self._buffer.split(b"\n", 1)
+        return json.loads(frame.decode('utf-8'))
+
+    def receive(self) -> object:
+        """
+        Returns the result of the oldest outstanding request, or raises it's CommandError
+        """
+        request_id, cmd, target = self._outstanding.popleft()
+
+        response = self._early.pop(request_id, None)
+        while response is None:
+            frame = self._read_frame()
+            frame_id = frame.get('id', request_id)
+
+            if frame_id == request_id:
+                response = frame
+            elif any(frame_id == outstanding[0] for outstanding in self._outstanding):
+                self._early[frame_id] = frame
+            else:
+                raise ConnectionError(f"Response to unknown request {frame_id} received")
+
+        return _result(response, cmd, target)
+
+    def call(self, cmd: str, target: str = None, args: dict = None) -> object:
+        self.send(cmd, target, args)
+        return self.receive()
+
+    def execute_many(self, commands: list, window: int = 64) -> list:
+        """
+        Sends (cmd, target, args) tuples without waiting for each result. Returns the results in order,
+        failed commands are represented by their CommandError. At most window requests are in flight,
+        so neither side blocks on a full socket buffer while the other is writing too.
+        """
+        results = []
+        for cmd, target, args in commands:
+            if len(self._outstanding) >= window:
+                results.append(self._receive_safe())
+
+            self.send(cmd, target, args)
+
+        while self._outstanding:
+            results.append(self._receive_safe())
+
+        return results
+
+    def _receive_safe(self) -> object:
+        try:
+            return self.receive()
+        except CommandError as e:
+            return e
+
+    def is_idle(self) -> bool:
+        return not self._outstanding and not self._buffer and not self._early
+
+    def close(self):
+        self.closed = True
+        self._sock.close()
+
+
+class ConnectionPool(object):
+    """
+    Keeps idle connections for reuse, and limits the number of connections open at the same time
+    """
+
+    def __init__(self, path: str = SOCKET_PATH, size: int = 4, timeout: float = None, session: dict = None):
+        self._path = path
+        self._timeout = timeout
+        self._session = session
+        self._idle = []
+        self._lock = Lock()
+        self._slots = BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self, reused: list = None):
+        """
+        Lends a connection. It is closed instead of returned to the pool when the block raises anything but a CommandError.
+        When reused is given, it's only element tells whether the connection was taken from the pool.
+        """
+        self._slots.acquire()
+        try:
+            with self._lock:
+                connection = self._idle.pop() if self._idle else None
+
+            if reused is not None:
+                reused[:] = [connection is not None]
+
+            if connection is None:
+                connection = Connection(self._path, self._timeout, self._session)
+
+            try:
+                yield connection
+            except CommandError:
+                self._release(connection)
+                raise
+            except BaseException:
+                connection.close()
+                raise
+
+            self._release(connection)
+
+        finally:
+            self._slots.release()
+
+    def _release(self, connection: Connection):
+        if connection.closed or not connection.is_idle():
+            connection.close()
+            return
+
+        with self._lock:
+            self._idle.append(connection)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for connection in idle:
+            connection.close()
+
+
+class Client(_ManagerCommands):
+    """
+    Blocking client, safe to share between threads. Each command borrows a connection from the pool.
+    The name and weight (0-1] of the connections are reported to the daemon, see session in SocketCommandProvider.
+    """
+
+    def __init__(self, path: str = SOCKET_PATH, pool_size: int = 4, timeout: float = None, name: str = None, weight: float = None):
+        self._path = path
+        self._timeout = timeout
+        self._pool = ConnectionPool(path, pool_size, timeout, _session(name, weight))
+
+    def call(self, cmd: str, target: str = None, args: dict = None) -> object:
+        reused = []
+        with self._pool.connection(reused) as connection:
+            try:
+                connection.send(cmd, target, args)
+            except (BrokenPipeError, ConnectionResetError):
+                if not reused[0]:
+                    raise
+
+                connection.close()  # not returned to the pool
+            else:
+                return connection.receive()
+
+        # The daemon closed the idle connection (e.g. restarted) before the command was sent. Retried once on a new connection,
+        # commands are not retried otherwise, since they might have been executed already.
+        with self._pool.connection() as connection:
+            return connection.call(cmd, target, args)
+
+    def pipeline(self) -> 'Pipeline':
+        return Pipeline(self._pool)
+
+    def subscribe(self, filters: dict = None, resume_token: str = None, buffer: int = None) -> 'Subscription':
+        return Subscription(self._path, filters, resume_token, buffer)
+
+    def close(self):
+        self._pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class Pipeline(_ManagerCommands):
+    """
+    Collects commands, then sends them on a single connection without waiting for each result.
+    The wrappers return None, the results are returned by execute() in order.
+    """
+
+    def __init__(self, pool: ConnectionPool):
+        self._pool = pool
+        self._commands = []
+
+    def call(self, cmd: str, target: str = None, args: dict = None):
+        self._commands.append((cmd, target, args))
+
+    def execute(self, raise_on_error: bool = True) -> list:
+        """
+        Sends the collected commands. Failed commands are represented by their CommandError in the results,
+        or the first one is raised, after every command is executed.
+        """
+        commands, self._commands = self._commands, []
+        if not commands:
+            return []
+
+        with self._pool.connection() as connection:
+            results = connection.execute_many(commands)
+
+        if raise_on_error:
+            for result in results:
+                if isinstance(result, CommandError):
+                    raise result
+
+        return results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.execute()
+
+
+class Subscription(object):
+    """
+    Event stream on a dedicated connection. Iterate over it to receive the events.
+    """
+
+    def __init__(self, path: str, filters: dict = None, resume_token: str = None, buffer: int = None):
+        self._connection = Connection(path)
+
+        args = {"filters": filters or {}, "resume_token": resume_token}
+        if buffer:
+            args['buffer'] = buffer
+
+        self._connection.send("subscribe", None, args)
+        self.token = self._connection.receive()['token']
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> dict:
+        try:
+            return self._connection._read_frame()['event']
+        except ConnectionResetError:
+            raise StopIteration()
+
+    def close(self):
+        self._connection.close()
+
+
+## ASYNCIO API ##
+
+
+class AsyncConnection(object):
+    """
+    A control socket connection shared by any number of concurrent requests. Responses are matched to requests by id.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, timeout: float = None):
+        self._timeout = timeout
+        self._reader = reader
+        self._writer = writer
+        self._ids = itertools.count(1)
+        self._waiters = {}  # id -> (future, cmd, target)
+        self._reader_task = asyncio.ensure_future(self._read_loop())
+        self.closed = False
+
+    @classmethod
+    async def open(cls, path: str = SOCKET_PATH, timeout: float = None, session: dict = None) -> 'AsyncConnection':
+        reader, writer = await asyncio.open_unix_connection(path, limit=2 ** 24)  # results, like query pages, can be large
+        connection = cls(reader, writer, timeout)
+
+        if session:
+            try:
+                await connection.call("session", None, session)
+            except BaseException:
+                await connection.close()
+                raise
+
+        return connection
+
+    async def _read_loop(self):
+        error = ConnectionResetError("The daemon closed the connection")
+        try:
+            while True:
+                frame = await self._reader.readline()
+                if not frame:
+                    break
+
+                response = json.loads(frame.decode('utf-8'))
+                waiter = self._waiters.pop(response.get('id'), None)
+                if not waiter:
+                    continue
+
+                future, cmd, target = waiter
+                if future.done():  # cancelled by the caller
+                    continue
+
+                try:
+                    future.set_result(_result(response, cmd, target))
+                except CommandError as e:
+                    future.set_exception(e)
+
+        except (OSError, ValueError) as e:
+            error = e
+
+        finally:
+            self.closed = True
+            for future, _, _ in self._waiters.values():
+                if not future.done():
+                    future.set_exception(error)
+            self._waiters.clear()
+
+    async def call(self, cmd: str, target: str = None, args: dict = None) -> object:
+        if self.closed:
+            raise ConnectionResetError("The connection is closed")
+
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[request_id] = (future, cmd, target)
+
+        try:
+            self._writer.write(_encode(request_id, cmd, target, args, self._timeout))
+            await self._writer.drain()
+            return await future
+        finally:
+            self._waiters.pop(request_id, None)
+
+    def pending(self) -> int:
+        return len(self._waiters)
+
+    async def close(self):
+        self.closed = True
+        self._writer.close()
+        try:
+            await self._reader_task
+        except asyncio.CancelledError:
+            pass
+
+
+class AsyncClient(_ManagerCommands):
+    """
+    asyncio client. Concurrent commands are pipelined over up to pool_size connections, always picking the least busy one.
+    The typed wrappers return coroutines.
+    """
+
+    def __init__(self, path: str = SOCKET_PATH, pool_size: int = 4, timeout: float = None, name: str = None, weight: float = None):
+        self._path = path
+        self._pool_size = pool_size
+        self._timeout = timeout
+        self._session = _session(name, weight)
+        self._connections = []
+        self._opening = None
+
+    async def _connection(self) -> AsyncConnection:
+        self._connections = [connection for connection in self._connections if not connection.closed]
+
+        idle = [connection for connection in self._connections if not connection.pending()]
+        if idle:
+            return idle[0]
+
+        if len(self._connections) < self._pool_size:
+            if not self._opening:  # concurrent callers share the connection being opened
+                self._opening = asyncio.ensure_future(AsyncConnection.open(self._path, self._timeout, self._session))
+
+            opening = self._opening
+            try:
+                connection = await opening
+            finally:
+                if self._opening is opening:
+                    self._opening = None
+
+            if connection not in self._connections:
+                self._connections.append(connection)
+
+            return connection
+
+        return min(self._connections, key=lambda connection: connection.pending())
+
+    async def call(self, cmd: str, target: str = None, args: dict = None) -> object:
+        connection = await self._connection()
+
+        if self._timeout:
+            return await asyncio.wait_for(connection.call(cmd, target, args), self._timeout + TIMEOUT_GRACE)
+
+        return await connection.call(cmd, target, args)
+
+    async def subscribe(self, filters: dict = None, resume_token: str = None, buffer: int = None):
+        """
+        Async generator of events, on a dedicated connection
+        """
+        reader, writer = await asyncio.open_unix_connection(self._path, limit=2 ** 24)
+
+        args = {"filters": filters or {}, "resume_token": resume_token}
+        if buffer:
+            args['buffer'] = buffer
+
+        try:
+            writer.write(_encode(1, "subscribe", None, args))
+            await writer.drain()
+            _result(json.loads((await reader.readline()).decode('utf-8')), "subscribe", None)
+
+            while True:
+                frame = await reader.readline()
+                if not frame:
+                    return
+
+                yield json.loads(frame.decode('utf-8'))['event']
+        finally:
+            writer.close()
+
+    async def close(self):
+        connections, self._connections = self._connections, []
+        for connection in connections:
+            await connection.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+
+## CLI ##
+
+
+def _parse_arg(arg: str) -> tuple:
+    key, separator, value = arg.partition('=')
+    if not separator:
+        raise argparse.ArgumentTypeError(f"Arguments must be key=value pairs: {arg}")
+
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+
+def main():
+    parser = argparse.ArgumentParser(description="mmvmm control client")
+    parser.add_argument("--socket", default=SOCKET_PATH, help="Path of the control socket")
+    parser.add_argument("--timeout", type=float, help="Seconds the daemon may spend on the command")
+    parser.add_argument("--vm", help="Target VM of the command, or the VM to filter events of")
+    parser.add_argument("--type", action="append", help="Event type to subscribe to (subscribe only), can be repeated")
+    parser.add_argument("command", help="Command to execute, or subscribe to follow the events")
+    parser.add_argument("args", nargs="*", type=_parse_arg, help="Arguments as key=value, values are parsed as JSON if possible")
+    args = parser.parse_args()
+
+    with Client(args.socket, pool_size=1, timeout=args.timeout) as client:
+        if args.command == "subscribe":
+            subscription = client.subscribe({"vms": [args.vm] if args.vm else [], "types": args.type or []})
+            try:
+                for event in subscription:
+                    print(json.dumps(event), flush=True)
+            except KeyboardInterrupt:
+                pass
+            finally:
+                subscription.close()
+            return
+
+        try:
+            result = client.call(args.command, args.vm, dict(args.args))
+        except CommandError as e:
+            print(f"Error: {e.error}", file=sys.stderr)
+            sys.exit(1)
+
+    print(json.dumps(result, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
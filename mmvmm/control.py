@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import json
 import os
+import time
 import socket
 import select
 import logging
@@ -8,15 +9,100 @@ from bettersocket import BetterSocketIO
 from marshmallow.exceptions import ValidationError
 
 from vm_manager import VMMAnager
+from events import EventBus
 from schema import ControlCommandSchema
-from exception import UnknownVMError, UnknownCommandError
+from fastschema import CompiledSchema
+from tracing import Tracer
+from scheduler import FairScheduler
+from exception import UnknownVMError, UnknownCommandError, DeadlineExceededError
+
+
+class ControlConnection(object):
+    """
+    A client connection of the control socket. Reads frames in a non-blocking manner, and buffers the outgoing ones
+    (responses and events), so a client not reading them can not block the daemon.
+    """
+
+    RECV_CHUNK = 65536
+    MAX_OUTBUF = 64 * 1024 * 1024  # bytes, a client letting more unsent responses pile up is dropped
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.sock.setblocking(False)  # only flush() writes to this socket
+        self.sockio = BetterSocketIO(sock)
+        self.subscription = None
+        self.eof = False  # the client shut down it's sending side, the connection is kept until it's commands are answered
+
+        self._inbuf = b""
+        self._outbuf = bytearray()
+
+    def read_frames(self) -> list:
+        """
+        Called when the socket is readable. Returns all complete frames received. Sets eof at the end of the stream.
+        """
+        chunk = self.sock.recv(self.RECV_CHUNK)
+        if not chunk:
+            self.eof = True
+            return []
+
+        self._inbuf += chunk
+        *frames, self._inbuf = self._inbuf.split(b"\n")
+        return [frame for frame in frames if frame]
+
+    def wants_write(self) -> bool:
+        return bool(self._outbuf) or (self.subscription is not None and self.subscription.has_pending())
+
+    def send(self, data: dict) -> bool:
+        """
+        Queues a frame, and sends as much as possible without blocking. Returns False if the buffer grew over the limit.
+        """
+        self._outbuf += json.dumps(data).encode('utf-8') + b"\n"
+        if len(self._outbuf) > self.MAX_OUTBUF:
+            return False
+
+        self.flush()
+        return True
+
+    def flush(self):
+        """
+        Called when the socket is writable. Sends as much of the pending frames and events as possible without blocking.
+        """
+        while True:
+            if not self._outbuf:
+                event = self.subscription.pop() if self.subscription else None
+                if event is None:
+                    return
+
+                self._outbuf += json.dumps({"event": event}).encode('utf-8') + b"\n"
+
+            try:
+                sent = self.sock.send(self._outbuf)
+            except BlockingIOError:
+                return
+
+            del self._outbuf[:sent]
+
+            if self._outbuf:  # partially sent, the socket buffer is full
+                return
+
+    def subscribe(self, subscription, ack: dict):
+        self.subscription = subscription
+        self._outbuf += json.dumps(ack).encode('utf-8') + b"\n"
+
+    def close(self):
+        self.sockio.close()
 
 
 class SocketCommandProvider(object):
 
     SOCKET_PATH = "/run/mmvmm/control.sock"
 
-    def __init__(self):
+    MAX_SUBSCRIPTION_BUFFER = 10000
+
+    RATE_LIMIT = 1000  # commands/sec per connection, 0 disables
+    RATE_BURST = 2000
+
+    def __init__(self, event_bus: EventBus = None, rate_limit: float = None, rate_burst: float = None):
 
         try:
             os.unlink(self.SOCKET_PATH)
@@ -28,23 +114,159 @@ class SocketCommandProvider(object):
         self._server_sock.listen(5)
         os.chmod(self.SOCKET_PATH, 0o660)
 
-        self._client_sockios = []
+        self._connections = {}  # socket -> ControlConnection, select needs the sockets themselves
+        # received, but not yet returned commands
+        self._scheduler = FairScheduler(
+            self.RATE_LIMIT if rate_limit is None else rate_limit,
+            self.RATE_BURST if rate_burst is None else rate_burst
+        )
+
+        self._event_bus = event_bus
+        self._wakeup_r, self._wakeup_w = socket.socketpair()  # wakes up select when an event is queued for a subscriber
+        self._wakeup_w.setblocking(False)
 
         self._active = True
 
+    def _wakeup(self):
+        try:
+            self._wakeup_w.send(b"\0")
+        except (BlockingIOError, OSError):  # already woken up, or closed
+            pass
+
+    def _drop(self, connection: ControlConnection):
+        if connection.subscription:
+            self._event_bus.unsubscribe(connection.subscription)
+
+        self._scheduler.remove_flow(connection.sock)  # queued commands of the connection are discarded
+
+        connection.close()
+        del self._connections[connection.sock]
+
+    def _send(self, connection: ControlConnection, data: dict) -> bool:
+        """
+        Sends a frame without blocking. Returns False if the connection should be dropped.
+        """
+        try:
+            if connection.send(data):
+                return True
+
+            logging.warning("Control connection dropped: too many unread responses")
+        except OSError as e:  # The client went away
+            logging.debug(f"Could not send response: {str(e)}")
+
+        return False
+
+    def _subscribe(self, connection: ControlConnection, args: dict) -> bool:
+        """
+        Turns the connection into an event stream. Should be sent on a connection without outstanding commands.
+        args: {"filters": {"vms": [...], "types": [...], "events": [...]}, "resume_token": "...", "buffer": 1000}
+        """
+        if not self._event_bus:
+            return self._send(connection, {"success": False, "error": "Subscriptions are not available"})
+
+        filters = args.get('filters') or {}
+        buffer = args.get('buffer', 1000)
+
+        if not isinstance(filters, dict) or not isinstance(buffer, int) or buffer < 1 or \
+                not all(isinstance(filters.get(key) or [], list) for key in ('vms', 'types', 'events')):
+            return self._send(connection, {"success": False, "error": "Invalid subscription"})
+
+        subscription, token = self._event_bus.subscribe(filters, min(buffer, self.MAX_SUBSCRIPTION_BUFFER), self._wakeup, args.get('resume_token'))
+        connection.subscribe(subscription, {"success": True, "result": {"token": token}})
+        logging.debug("Control connection subscribed to events")
+        return True
+
+    def _handle_frame(self, connection: ControlConnection, rawdata: bytes) -> bool:  # returns: bool keep the connection
+
+        if connection.subscription:  # subscribed connections only receive
+            return True
+
+        try:
+            data = json.loads(rawdata.decode('utf-8'))
+        except (json.JSONDecodeError, UnicodeError) as e:  # JSON and Unicode exceptions
+            logging.error("Connection dropped. Reason: {}".format(str(e)))
+            return False
+
+        if isinstance(data, dict) and data.get('cmd') == 'subscribe' and not data.get('target'):
+            return self._subscribe(connection, data.get('args') or {})
+
+        def result_pusher(result: dict):
+            if connection.sock in self._connections and not self._send(connection, result):
+                self._drop(connection)
+
+        if isinstance(data, dict) and data.get('cmd') == 'session' and not data.get('target'):
+            return self._session(connection, data)
+
+        cmd = data.get('cmd') if isinstance(data, dict) and isinstance(data.get('cmd'), str) else ""
+        rejection = self._scheduler.enqueue(connection.sock, cmd, (data, result_pusher))
+
+        if rejection:  # answered right away, clients matching responses by id can tell which one was rejected
+            response = {"success": False, "error": f"Overloaded: {rejection.replace('_', ' ')}", "overload": True}
+            if isinstance(data, dict) and data.get('id') is not None:
+                response['id'] = data['id']
+
+            return self._send(connection, response)
+
+        return True
+
+    def _session(self, connection: ControlConnection, data: dict) -> bool:
+        """
+        Names the connection (shown in the stats), and optionally lowers it's weight, e.g. for background automation.
+        args: {"name": "...", "weight": 0.1}, the weight is between 0 and 1 (default).
+        """
+        args = data.get('args') or {}
+        name = args.get('name')
+        weight = args.get('weight')
+
+        response = {"success": True, "result": None}
+        if (name is not None and not isinstance(name, str)) or \
+                (weight is not None and (not isinstance(weight, (int, float)) or isinstance(weight, bool) or not 0 < weight <= 1)):
+            response = {"success": False, "error": "Invalid session settings"}
+        else:
+            self._scheduler.configure_flow(connection.sock, name, weight)
+
+        if data.get('id') is not None:
+            response['id'] = data['id']
+
+        return self._send(connection, response)
+
+    def stats(self) -> dict:
+        return dict(self._scheduler.stats(), subscriptions=sum(1 for connection in self._connections.values() if connection.subscription))
+
     def get_command_object(self) -> tuple:  # format: {"target" : "vm name", "cmd" : "command", "args" : {}}
 
-        cmd_obj = None
+        polled = False  # commands arrived while others were queued are read (without blocking) before picking the next one
+        while self._active and not (self._scheduler and polled):
 
-        while (not cmd_obj) and self._active:
+            # Connections closed by the client (at least for sending) are dropped once all their commands are answered.
+            # Subscriptions only send, they are dropped right away.
+            for connection in list(self._connections.values()):
+                if connection.eof and (connection.subscription or not (self._scheduler.queued(connection.sock) or connection.wants_write())):
+                    self._drop(connection)
 
-            rlist = [self._server_sock] + self._client_sockios
+            rlist = [self._server_sock, self._wakeup_r] + [sock for sock, connection in self._connections.items() if not connection.eof]
+            wlist = [sock for sock, connection in self._connections.items() if connection.wants_write()]
 
             try:
-                readables, _, _ = select.select(rlist, [], [])
+                readables, writables, _ = select.select(rlist, wlist, [], 0 if self._scheduler else None)
             except OSError:
                 continue
 
+            polled = True
+
+            if not self._active:  # closed while waiting
+                break
+
+            for writable in writables:
+                connection = self._connections.get(writable)
+                if not connection:
+                    continue
+
+                try:
+                    connection.flush()
+                except OSError:
+                    self._drop(connection)
+
             for readable in readables:
 
                 if readable is self._server_sock:
@@ -55,56 +277,56 @@ class SocketCommandProvider(object):
 
                     logging.debug("New control connection!")
 
-                    self._client_sockios.append(BetterSocketIO(new_client))
-
-                else:
-
-                    try:
+                    self._connections[new_client] = ControlConnection(new_client)
+                    self._scheduler.add_flow(new_client, f"connection{new_client.fileno()}")
 
-                        rawdata = readable.readframe()  # may return None... but it does not matter
+                elif readable is self._wakeup_r:
+                    self._wakeup_r.recv(4096)  # the subscribers with pending events are in wlist on the next round
 
-                    except (ConnectionResetError, BrokenPipeError):
-                        readable.close()
-                        self._client_sockios.remove(readable)
+                else:
+                    connection = self._connections.get(readable)
+                    if not connection:
                         continue
 
                     try:
-                        data = json.loads(rawdata.decode('utf-8'))
-                    except (json.JSONDecodeError, UnicodeError) as e:  # JSON and Unicode exceptions
-                        logging.error("Connection dropped. Reason: {}".format(str(e)))
-                        readable.close()
-                        self._client_sockios.remove(readable)
+                        frames = connection.read_frames()
+                    except BlockingIOError:
+                        continue
+                    except OSError:  # Including ConnectionResetError and BrokenPipeError
+                        self._drop(connection)
                         continue
 
-                    def result_pusher(result: dict):
-                        if readable:
-                            readable.sendframe(json.dumps(result).encode('utf-8'))
-
-                    cmd_obj = (data, result_pusher)
+                    for rawdata in frames:
+                        if not self._handle_frame(connection, rawdata):
+                            self._drop(connection)
+                            break
 
-        return cmd_obj
+        return self._scheduler.dequeue() if self._scheduler else None
 
     def close(self):
-        for client_sockio in self._client_sockios:
-            client_sockio.close()
+        self._active = False
+
+        for connection in list(self._connections.values()):
+            self._drop(connection)
 
         self._server_sock.close()
+        self._wakeup_r.close()
+        self._wakeup_w.close()
 
         try:
             os.unlink(self.SOCKET_PATH)
         except OSError:
             pass
 
-        self._active = False
-
 
 class SimpleCommandExecuter(object):
 
-    control_command_schema = ControlCommandSchema(many=False)
+    control_command_schema = CompiledSchema(ControlCommandSchema(many=False))
 
     def __init__(self, command_provider: SocketCommandProvider, vmmanager: VMMAnager):
         self._command_provider = command_provider
         self._vmmanager = vmmanager
+        self._vmmanager.add_stats_source("control", command_provider.stats)
         self._active = True
 
     def loop(self):
@@ -115,12 +337,21 @@ class SimpleCommandExecuter(object):
             if not self._active:  # ha a socket closed, akkor az vissza fog térni none-al, a push command meg fasságot küld a geciba
                 break
 
+            request_id = raw_cmd.get('id') if isinstance(raw_cmd, dict) else None
+            if request_id is not None:  # only clients sending ids get them back
+                result_pusher = self._with_id(result_pusher, request_id)
+
             try:
-                cmd = self.control_command_schema.load(raw_cmd)
+                with Tracer.span("control.validate"):
+                    cmd = self.control_command_schema.load(raw_cmd)
             except ValidationError as e:
                 logging.debug(f"Command schema validation failed: {str(e)}")
                 result_pusher({"success": False, "error": "Invalid command schema"})
                 continue
+            except Exception as e:  # a malformed frame must never take the daemon down
+                logging.exception(e)
+                result_pusher({"success": False, "error": "Invalid command schema"})
+                continue
 
             # execute the command
 
@@ -130,15 +361,31 @@ class SimpleCommandExecuter(object):
                 result = self._vmmanager.execute_command(
                     cmd['target'],
                     cmd['cmd'],
-                    cmd['args']
+                    cmd['args'],
+                    self._to_monotonic(cmd['deadline'])
                 )
 
                 result_pusher({"success": True, "result": result})
 
+            except DeadlineExceededError as e:  # reported distinctly, so clients can tell it apart from failures
+                logging.warning(f"Command {cmd['cmd']} timed out: {str(e)}")
+                result_pusher({"success": False, "error": str(e), "timeout": True})
+
             except Exception as e:
                 logging.exception(e)
                 result_pusher({"success": False, "error": str(e)})
 
+    @staticmethod
+    def _to_monotonic(deadline: float) -> float:
+        if deadline is None:
+            return None
+
+        return time.monotonic() + (deadline - time.time())
+
+    @staticmethod
+    def _with_id(result_pusher: callable, request_id: object) -> callable:
+        return lambda result: result_pusher(dict(result, id=request_id))
+
     def stop(self):
         self._active = False
         self._command_provider.close()
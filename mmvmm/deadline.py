@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+import time
+from threading import local
+from contextlib import contextmanager
+
+from exception import DeadlineExceededError
+
+
+class Deadline(object):
+    """
+    The deadline of the control command executed by the current thread (time.monotonic() based).
+    Blocking calls made on behalf of the command (lock acquisitions, QMP commands) wait at most until it,
+    and raise DeadlineExceededError once it passed. Threads without a deadline block as before.
+    """
+
+    _local = local()
+
+    @classmethod
+    def current(cls) -> float:
+        return getattr(cls._local, 'deadline', None)
+
+    @classmethod
+    @contextmanager
+    def scope(cls, deadline: float):
+        """
+        Sets the deadline for the block. Nested scopes can only shorten it.
+        """
+        previous = cls.current()
+        cls._local.deadline = deadline if previous is None or (deadline is not None and deadline < previous) else previous
+        try:
+            yield
+        finally:
+            cls._local.deadline = previous
+
+    @classmethod
+    @contextmanager
+    def suspended(cls):
+        """
+        Lifts the deadline for the block, for cleanup that has to finish even if the command is late (e.g. reverting changes)
+        """
+        previous = cls.current()
+        cls._local.deadline = None
+        try:
+            yield
+        finally:
+            cls._local.deadline = previous
+
+    @classmethod
+    def remaining(cls, what: str = None) -> float:
+        """
+        Returns the seconds left, or None if there is no deadline. Raises DeadlineExceededError if none is left.
+        """
+        deadline = cls.current()
+        if deadline is None:
+            return None
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceededError(what) if what else DeadlineExceededError()
+
+        return remaining
+
+    @classmethod
+    def timeout(cls, default: float = None, what: str = None) -> tuple:
+        """
+        Returns (timeout, limited by the deadline) for a blocking call, that would otherwise wait for default seconds (None: forever)
+        """
+        remaining = cls.remaining(what)
+        if remaining is not None and (default is None or remaining < default):
+            return remaining, True
+
+        return default, False
+
+    @classmethod
+    def check(cls, what: str = None):
+        cls.remaining(what)
+
+    @classmethod
+    @contextmanager
+    def acquire(cls, lock, what: str):
+        """
+        Acquires a lock, waiting at most until the deadline
+        """
+        remaining = cls.remaining(f"waiting for {what}")
+
+        if not lock.acquire(timeout=-1 if remaining is None else remaining):
+            raise DeadlineExceededError(f"waiting for {what}")
+
+        try:
+            yield
+        finally:
+            lock.release()
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+import os
+import subprocess
+
+QEMU_IMG_BINARY = "/usr/bin/qemu-img"
+
+
+class DiskImage(object):
+    """
+    This class issues qemu-img commands to manage disk images
+    """
+
+    @staticmethod
+    def create_overlay(backing_path: str, backing_format: str, path: str):
+        """
+        Creates a copy-on-write qcow2 overlay backed by an existing image.
+        Only the metadata of the backing image is read, so this takes constant time regardless of the image size.
+        Fails with FileExistsError if the path exists, the file is claimed exclusively before qemu-img writes it.
+        """
+        os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600))
+
+        try:
+            subprocess.check_call(
+                [QEMU_IMG_BINARY, 'create', '-q', '-f', 'qcow2', '-F', backing_format, '-b', backing_path, path],
+                stdout=subprocess.DEVNULL
+            )
+        except BaseException:
+            DiskImage.remove(path)
+            raise
+
+    @staticmethod
+    def remove(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
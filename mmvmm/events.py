@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+import os
+import time
+import logging
+from collections import deque, OrderedDict
+from threading import Lock
+
+
+class Subscription(object):
+    """
+    A bounded buffer of events for one subscriber.
+    When the buffer is full, a pending event superseded by the new one (same VM and kind) is dropped first,
+    otherwise the oldest pending event is dropped, and the number of dropped events is reported to the subscriber.
+    """
+
+    def __init__(self, filters: dict, max_pending: int, wakeup: callable):
+        self._vms = set(filters.get('vms') or [])
+        self._types = set(filters.get('types') or [])
+        self._events = set(filters.get('events') or [])
+
+        self._max_pending = max_pending
+        self._wakeup = wakeup
+
+        self._pending = OrderedDict()  # seq -> event
+        self._latest = {}  # coalescing key -> seq of the pending event
+        self._dropped = 0
+
+        self._lock = Lock()
+
+    def matches(self, event: dict) -> bool:
+        if self._vms and event['vm'] not in self._vms:
+            return False
+
+        if self._types and event['type'] not in self._types:
+            return False
+
+        if self._events and event['event'] not in self._events:
+            return False
+
+        return True
+
+    def push(self, event: dict, coalescing_key: tuple = None, force: bool = False):
+        if not force and not self.matches(event):  # forced events (like resync) are not subject to filters
+            return
+
+        with self._lock:
+            if len(self._pending) >= self._max_pending:
+                superseded = self._latest.pop(coalescing_key, None) if coalescing_key else None
+
+                if superseded is not None:
+                    del self._pending[superseded]
+                else:
+                    _, oldest = self._pending.popitem(last=False)
+                    self._forget(oldest)
+
+                self._dropped += 1
+
+            self._pending[event['seq']] = event
+            if coalescing_key:
+                self._latest[coalescing_key] = event['seq']
+
+        self._wakeup()
+
+    def _forget(self, event: dict):
+        key = EventBus.coalescing_key(event)
+        if key and self._latest.get(key) == event['seq']:
+            del self._latest[key]
+
+    def has_pending(self) -> bool:
+        return bool(self._pending) or bool(self._dropped)
+
+    def pop(self) -> dict:
+        """
+        Returns the next event to send, or None. Drops are reported before the events following them.
+        """
+        with self._lock:
+            if self._dropped:
+                dropped = self._dropped
+                self._dropped = 0
+                return {"type": "overflow", "vm": None, "event": "dropped", "data": {"count": dropped}}
+
+            if not self._pending:
+                return None
+
+            _, event = self._pending.popitem(last=False)
+            self._forget(event)
+            return event
+
+
+class EventBus(object):
+    """
+    Distributes VM events to subscriptions, and keeps the recent ones, so subscribers can resume after reconnecting.
+    """
+
+    HISTORY = 10000
+
+    def __init__(self, history: int = HISTORY):
+        self._logger = logging.getLogger("events")
+
+        self._epoch = os.urandom(4).hex()  # Tokens from an other run of the daemon can not be resumed
+        self._seq = 0
+        self._history = deque(maxlen=history)
+        self._subscriptions = []
+
+        self._lock = Lock()
+
+    @staticmethod
+    def coalescing_key(event: dict) -> tuple:
+        """
+        Events with the same key supersede each other, only the state after the latest one matters
+        """
+        if event['type'] in ('lifecycle', 'description'):
+            return event['vm'], event['type']
+
+        if event['type'] == 'qmp' and event['event'] in ('STOP', 'RESUME'):
+            return event['vm'], 'runstate'
+
+        return None
+
+    def _token(self, seq: int) -> str:
+        return f"{self._epoch}:{seq}"
+
+    def publish(self, event_type: str, vm: str, event: str, data: dict = None):
+        with self._lock:
+            self._seq += 1
+            published = {
+                "type": event_type,
+                "vm": vm,
+                "event": event,
+                "data": data or {},
+                "timestamp": time.time(),
+                "seq": self._seq,
+                "token": self._token(self._seq)
+            }
+            self._history.append(published)
+            subscriptions = list(self._subscriptions)
+
+        key = self.coalescing_key(published)
+        for subscription in subscriptions:
+            subscription.push(published, key)
+
+    def subscribe(self, filters: dict, max_pending: int, wakeup: callable, resume_token: str = None) -> tuple:
+        """
+        Creates a subscription. When a resume token is given, the events after it are queued first.
+        Returns the subscription and the token of the latest event.
+        If the events after the token are no longer available, a resync event is queued instead.
+        """
+        subscription = Subscription(filters, max_pending, wakeup)
+
+        with self._lock:
+            if resume_token is not None:
+                epoch, _, seq = str(resume_token).partition(':')
+
+                try:
+                    seq = int(seq)
+                except ValueError:
+                    seq = None
+
+                oldest = self._history[0]['seq'] if self._history else self._seq + 1
+
+                if epoch != self._epoch or seq is None or seq > self._seq or seq < oldest - 1:
+                    subscription.push({"type": "resync", "vm": None, "event": "resync", "data": {}, "seq": 0, "token": self._token(self._seq)}, force=True)
+                else:
+                    for event in self._history:
+                        if event['seq'] > seq:
+                            subscription.push(event, self.coalescing_key(event))
+
+            self._subscriptions.append(subscription)
+            return subscription, self._token(self._seq)
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            try:
+                self._subscriptions.remove(subscription)
+            except ValueError:
+                pass
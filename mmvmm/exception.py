@@ -35,3 +35,48 @@ class VMNotRunningError(VMError):
 
     def __str__(self):
         return "The virtual machine is not running"
+
+
+class VMQMPError(VMError):
+
+    def __str__(self):
+        if self.args:
+            return f"QMP command failed: {self.args[0]}"
+
+        return "QMP command failed"
+
+
+class VMGuestAgentError(VMError):
+
+    def __str__(self):
+        if self.args:
+            return f"Guest agent error: {self.args[0]}"
+
+        return "Guest agent error"
+
+
+class VMCGroupError(VMError):
+
+    def __str__(self):
+        if self.args:
+            return f"cgroup error: {self.args[0]}"
+
+        return "cgroup error"
+
+
+class VMTemplateError(VMError):
+
+    def __str__(self):
+        if self.args:
+            return f"Template error: {self.args[0]}"
+
+        return "Template error"
+
+
+class DeadlineExceededError(VMManagerError):
+
+    def __str__(self):
+        if self.args:
+            return f"Deadline exceeded: {self.args[0]}"
+
+        return "Deadline exceeded"
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+import os
+import math
+import logging
+
+from marshmallow import Schema, fields, RAISE
+from marshmallow import missing as marshmallow_missing
+from marshmallow.validate import Regexp, Length, OneOf, Range
+
+_MISSING = object()
+
+
+class _NotHandled(Exception):
+    """
+    Raised by the compiled fast path when the input is not handled by it (invalid or needs coercion).
+    The caller falls back to marshmallow in this case, which produces the proper result or error.
+    """
+    pass
+
+
+class _CompileError(Exception):
+    pass
+
+
+def _field_default(field: fields.Field, name: str, legacy_name: str):
+    # marshmallow renamed missing/default to load_default/dump_default in 3.13
+    value = getattr(field, name) if hasattr(field, name) else getattr(field, legacy_name)
+    return _MISSING if value is marshmallow_missing else value
+
+
+def _compile_validators(field: fields.Field) -> list:
+    checks = []
+    for validator in field.validators:
+
+        if isinstance(validator, OneOf):
+            choices = frozenset(validator.choices)
+            checks.append(lambda value, choices=choices: value in choices)
+
+        elif isinstance(validator, Regexp):
+            checks.append(lambda value, regex=validator.regex: regex.match(value) is not None)
+
+        elif isinstance(validator, Length):
+            if validator.equal is not None:
+                checks.append(lambda value, equal=validator.equal: len(value) == equal)
+            else:
+                checks.append(lambda value, lower=validator.min, upper=validator.max: (lower is None or len(value) >= lower) and (upper is None or len(value) <= upper))
+
+        elif isinstance(validator, Range):
+            min_inclusive = getattr(validator, 'min_inclusive', True)
+            max_inclusive = getattr(validator, 'max_inclusive', True)
+
+            def check(value, lower=validator.min, upper=validator.max, min_inclusive=min_inclusive, max_inclusive=max_inclusive):
+                if lower is not None and (value < lower if min_inclusive else value <= lower):
+                    return False
+
+                if upper is not None and (value > upper if max_inclusive else value >= upper):
+                    return False
+
+                return True
+
+            checks.append(check)
+
+        else:
+            raise _CompileError(f"Unsupported validator: {type(validator).__name__}")
+
+    return checks
+
+
+def _compile_field_loader(field: fields.Field):
+
+    if isinstance(field, fields.Nested):
+        nested_loader = _compile_schema_loader(field.schema)
+
+        if field.many:
+            def load_value(value):
+                if type(value) is not list:
+                    raise _NotHandled()
+                return [nested_loader(item) for item in value]
+        else:
+            load_value = nested_loader
+
+    elif isinstance(field, fields.List):
+        inner_loader = _compile_field_loader(field.inner)
+
+        def load_value(value):
+            if type(value) is not list:  # marshmallow also accepts other collections
+                raise _NotHandled()
+            return [inner_loader(item) for item in value]
+
+    elif isinstance(field, fields.String):
+        def load_value(value):
+            if type(value) is not str:  # marshmallow also decodes bytes
+                raise _NotHandled()
+            return value
+
+    elif isinstance(field, fields.Integer):
+        def load_value(value):
+            if type(value) is not int:  # marshmallow also coerces numeric strings and integral floats
+                raise _NotHandled()
+            return value
+
+    elif isinstance(field, fields.Float):
+        def load_value(value):
+            if type(value) is int:  # bool is excluded by the exact type check
+                try:
+                    return float(value)
+                except OverflowError:  # marshmallow reports it as too large
+                    raise _NotHandled()
+            if type(value) is not float or not math.isfinite(value):  # marshmallow also coerces numeric strings, and rejects nan and infinity
+                raise _NotHandled()
+            return value
+
+    elif isinstance(field, fields.Boolean):
+        def load_value(value):
+            if type(value) is not bool:  # marshmallow also accepts truthy and falsy strings and numbers
+                raise _NotHandled()
+            return value
+
+    elif type(field) is fields.Dict and not field.key_field and not field.value_field:
+        def load_value(value):
+            if type(value) is not dict:
+                raise _NotHandled()
+            return dict(value)
+
+    else:
+        raise _CompileError(f"Unsupported field: {type(field).__name__}")
+
+    checks = _compile_validators(field)
+    if not checks:
+        return load_value
+
+    def load_and_validate(value):
+        value = load_value(value)
+        for check in checks:
+            if not check(value):
+                raise _NotHandled()
+        return value
+
+    return load_and_validate
+
+
+def _compile_field_dumper(field: fields.Field):
+
+    if isinstance(field, fields.Nested):
+        nested_dumper = _compile_schema_dumper(field.schema)
+
+        if field.many:
+            def dump_value(value):
+                if type(value) is not list:
+                    raise _NotHandled()
+                return [nested_dumper(item) for item in value]
+
+            return dump_value
+        else:
+            return nested_dumper
+
+    elif isinstance(field, fields.List):
+        inner_dumper = _compile_field_dumper(field.inner)
+
+        def dump_value(value):
+            if type(value) is not list:
+                raise _NotHandled()
+            return [inner_dumper(item) for item in value]
+
+        return dump_value
+
+    elif isinstance(field, fields.String):
+        accepted_type = str
+
+    elif isinstance(field, fields.Integer):
+        accepted_type = int
+
+    elif isinstance(field, fields.Boolean):
+        accepted_type = bool
+
+    elif isinstance(field, fields.Float):
+        accepted_type = float
+
+    elif type(field) is fields.Dict and not field.key_field and not field.value_field:
+        def dump_value(value):
+            if type(value) is not dict:
+                raise _NotHandled()
+            return dict(value)
+
+        return dump_value
+
+    else:
+        raise _CompileError(f"Unsupported field: {type(field).__name__}")
+
+    def dump_value(value):
+        if type(value) is not accepted_type:
+            raise _NotHandled()
+        return value
+
+    return dump_value
+
+
+def _check_schema_compilable(schema: Schema):
+    if schema.unknown != RAISE:
+        raise _CompileError("Only schemas raising on unknown fields are supported")
+
+    if any(schema._hooks.values()):
+        raise _CompileError("Schemas with hooks are not supported")
+
+    for name, field in schema.fields.items():
+        if field.data_key not in (None, name) or field.attribute not in (None, name):
+            raise _CompileError("Renamed fields are not supported")
+
+        if field.load_only or field.dump_only:
+            raise _CompileError("Load-only and dump-only fields are not supported")
+
+
+def _compile_schema_loader(schema: Schema):
+    _check_schema_compilable(schema)
+
+    compiled_fields = []
+    for name, field in schema.fields.items():
+        compiled_fields.append((name, _compile_field_loader(field), field.required, field.allow_none, _field_default(field, 'load_default', 'missing')))
+
+    known_keys = frozenset(schema.fields.keys())
+
+    def load(data):
+        if type(data) is not dict or not known_keys.issuperset(data.keys()):
+            raise _NotHandled()
+
+        result = {}
+        for name, load_value, required, allow_none, missing in compiled_fields:
+            value = data.get(name, _MISSING)
+
+            if value is _MISSING:
+                if required:
+                    raise _NotHandled()
+
+                if missing is not _MISSING:
+                    result[name] = missing() if callable(missing) else missing
+
+            elif value is None:
+                if not allow_none:
+                    raise _NotHandled()
+                result[name] = None
+
+            else:
+                result[name] = load_value(value)
+
+        return result
+
+    return load
+
+
+def _compile_schema_dumper(schema: Schema):
+    _check_schema_compilable(schema)
+
+    compiled_fields = []
+    for name, field in schema.fields.items():
+        compiled_fields.append((name, _compile_field_dumper(field), _field_default(field, 'dump_default', 'default')))
+
+    def dump(obj):
+        if type(obj) is not dict:
+            raise _NotHandled()
+
+        result = {}
+        for name, dump_value, default in compiled_fields:
+            value = obj.get(name, _MISSING)
+
+            if value is _MISSING:
+                if default is _MISSING:
+                    continue
+                value = default() if callable(default) else default
+
+            result[name] = None if value is None else dump_value(value)
+
+        return result
+
+    return dump
+
+
+class CompiledSchema(object):
+    """
+    Wraps a marshmallow schema with a precompiled fast path for load and dump.
+    The fast path only accepts the exact types the schema produces; everything else (including every invalid input)
+    is passed to marshmallow, so the results and error messages are identical to the wrapped schema's.
+    """
+
+    enabled = os.environ.get("MMVMM_FAST_SCHEMA", "1") != "0"
+
+    def __init__(self, schema: Schema):
+        self._schema = schema
+
+        try:
+            if schema.many:
+                raise _CompileError("Schemas with many=True are not supported")
+
+            self._fast_load = _compile_schema_loader(schema)
+            self._fast_dump = _compile_schema_dumper(schema)
+        except _CompileError as e:
+            logging.getLogger("fastschema").warning(f"Could not compile {type(schema).__name__}: {str(e)}. Using marshmallow only.")
+            self._fast_load = None
+            self._fast_dump = None
+
+    @classmethod
+    def set_enabled(cls, enabled: bool):
+        cls.enabled = enabled
+
+    @property
+    def schema(self) -> Schema:
+        return self._schema
+
+    def load(self, data):
+        if CompiledSchema.enabled and self._fast_load:
+            try:
+                return self._fast_load(data)
+            except _NotHandled:
+                pass
+
+        return self._schema.load(data)
+
+    def dump(self, obj):
+        if CompiledSchema.enabled and self._fast_dump:
+            try:
+                return self._fast_dump(obj)
+            except _NotHandled:
+                pass
+
+        return self._schema.dump(obj)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+import os
+import time
+import json
+import random
+import string
+import socket
+import logging
+from threading import Thread, Lock
+
+import qmp
+from deadline import Deadline
+from exception import VMGuestAgentError, DeadlineExceededError
+
+
+class GuestAgent(Thread):
+    """
+    Client for the QEMU guest agent, reached through a virtio-serial channel exposed as a unix socket by QEMU.
+    The thread polls the agent with guest-ping until it first answers, which marks the guest ready.
+    """
+
+    CHANNEL_NAME = "org.qemu.guest_agent.0"
+
+    def __init__(self, upper_level_logger: logging.Logger, on_ready: callable = None, poll_interval: float = 1, timeout: float = 2):
+        self._logger = upper_level_logger.getChild('qga')
+        Thread.__init__(self, daemon=True)
+
+        self._socket_path = GuestAgent._create_socket_path()
+        self._socket = None
+        self._buffer = b""
+
+        self._on_ready = on_ready
+        self._poll_interval = poll_interval
+        self._timeout = timeout
+
+        self._active = True
+        self._ready = False
+        self._created = time.monotonic()
+        self._boot_to_ready = None  # seconds
+
+        self._lock = Lock()  # one request at a time
+
+    @staticmethod
+    def _create_socket_path():
+        while True:
+            sock_path = os.path.join(qmp.SOCKET_DIR, "qga_" + ''.join(random.choice(string.ascii_lowercase) for i in range(12)) + ".sock")
+            if not os.path.exists(sock_path):
+                return sock_path
+
+    def get_sock_path(self) -> str:
+        return self._socket_path
+
+    def get_qemu_args(self) -> list:
+        return [
+            '-chardev', f"socket,path={self._socket_path},server=on,wait=off,id=qga0",
+            '-device', 'virtio-serial',
+            '-device', f"virtserialport,chardev=qga0,name={self.CHANNEL_NAME}"
+        ]
+
+    def _disconnect(self):
+        if self._socket:
+            self._socket.close()
+            self._socket = None
+            self._buffer = b""
+
+    def _connect(self, deadline: float):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(max(deadline - time.monotonic(), 0.001))
+        try:
+            sock.connect(self._socket_path)
+        except OSError:
+            sock.close()
+            raise
+
+        self._socket = sock
+        self._buffer = b""
+
+    def _send(self, cmd: dict):
+        self._socket.sendall(json.dumps(cmd).encode('utf-8') + b"\n")
+
+    def _recv(self, deadline: float) -> dict:
+        while b"\n" not in self._buffer:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout()
+
+            self._socket.settimeout(remaining)
+            chunk = self._socket.recv(4096)
+            if not chunk:
+                raise ConnectionResetError()
+
+            self._buffer += chunk
+
+        line, self._buffer = self._buffer.split(b"\n", 1)
+        line = line.lstrip(b"\xff")  # guest-sync-delimited responses start with a 0xff byte
+        return json.loads(line.decode('utf-8')) if line.strip() else self._recv(deadline)
+
+    def _sync(self, deadline: float):
+        """
+        Discards stale responses (e.g. of an earlier timed out request) left in the channel
+        """
+        sync_id = random.randint(1, 2 ** 31)
+        self._send({"execute": "guest-sync", "arguments": {"id": sync_id}})
+
+        while True:
+            response = self._recv(deadline)
+            if response.get('return') == sync_id:
+                return
+
+    def execute(self, command: str, arguments: dict = None, expect_response: bool = True, timeout: float = None) -> object:
+        """
+        Executes a guest agent command. Raises VMGuestAgentError when the agent is unreachable or reports an error.
+        Raises DeadlineExceededError if the deadline of the current command passed while waiting.
+        """
+        cmd = {"execute": command}
+        if arguments:
+            cmd['arguments'] = arguments
+
+        with Deadline.acquire(self._lock, "the guest agent"):
+            # After the lock, so the time spent waiting for it is not granted again
+            timeout, limited_by_deadline = Deadline.timeout(timeout or self._timeout, f"guest agent command {command}")
+            deadline = time.monotonic() + timeout
+
+            try:
+                if not self._socket:
+                    self._connect(deadline)
+
+                self._sync(deadline)
+                self._send(cmd)
+
+                if not expect_response:  # e.g. guest-shutdown does not answer on success
+                    return None
+
+                response = self._recv(deadline)
+
+            except (OSError, ValueError) as e:  # including timeouts and malformed responses
+                self._disconnect()
+                if limited_by_deadline and isinstance(e, socket.timeout):
+                    raise DeadlineExceededError(f"guest agent command {command}")
+
+                raise VMGuestAgentError(f"Guest agent unreachable: {str(e) or type(e).__name__}")
+
+        if "error" in response:
+            raise VMGuestAgentError(response['error'].get('desc', response['error'].get('class')))
+
+        return response.get('return')
+
+    def ping(self, timeout: float = None):
+        self.execute("guest-ping", timeout=timeout)
+
+    def shutdown(self, mode: str = "powerdown"):
+        self.execute("guest-shutdown", {"mode": mode}, expect_response=False)
+
+    def fsfreeze(self, freeze: bool) -> int:
+        """
+        Freezes or thaws the guest filesystems. Returns the number of affected filesystems
+        """
+        return self.execute("guest-fsfreeze-freeze" if freeze else "guest-fsfreeze-thaw", timeout=max(self._timeout, 30))
+
+    def fsfreeze_status(self) -> str:
+        return self.execute("guest-fsfreeze-status")
+
+    def is_ready(self) -> bool:
+        return self._ready
+
+    def get_boot_to_ready(self) -> float:
+        return self._boot_to_ready
+
+    def run(self):
+        while self._active and not self._ready:
+            try:
+                self.ping()
+            except VMGuestAgentError:
+                time.sleep(self._poll_interval)
+                continue
+
+            self._boot_to_ready = time.monotonic() - self._created
+            self._ready = True
+            self._logger.info(f"Guest agent answered, guest is ready after {self._boot_to_ready:.1f}sec")
+
+            if self._on_ready:
+                self._on_ready(self._boot_to_ready)
+
+    def disconnect(self):
+        self._active = False
+
+        with self._lock:
+            self._disconnect()
+
+        if os.path.exists(self._socket_path):
+            try:
+                os.remove(self._socket_path)
+            except OSError:
+                pass
@@ -6,20 +6,50 @@ import signal
 from objectstore import ObjectStore
 from vm_manager import VMMAnager
 from control import SocketCommandProvider, SimpleCommandExecuter
+from balloon_policy import BalloonPolicy
+import cgroup
+from fastschema import CompiledSchema
+from tracing import Tracer
 
 
 def main():
     logging.basicConfig(filename="", format="%(asctime)s - %(name)s [%(levelname)s]: %(message)s", level=logging.DEBUG if '--debug' in sys.argv else logging.INFO)
     logging.info("Starting Marcsello's Magical Virtual Machine Manager...")
     os.makedirs("/run/mmvmm", mode=0o770, exist_ok=True)
+
+    if '--no-fast-schema' in sys.argv:
+        CompiledSchema.set_enabled(False)
+
+    if "MMVMM_CGROUP_ROOT" in os.environ:  # Empty disables placing VMs into cgroups
+        cgroup.CGROUP_ROOT = os.environ["MMVMM_CGROUP_ROOT"] or None
+
+    if '--tracing' in sys.argv or Tracer.export_path:
+        Tracer.configure(True, export=bool(Tracer.export_path))
+
     objectstore = ObjectStore(
         port=os.environ.get("ETCD_PORT", 2379),
         host=os.environ.get("ETCD_HOST", 'localhost'),
         user=os.environ.get("ETCD_USER"),
-        password=os.environ.get("ETCD_PASSWORD")
+        password=os.environ.get("ETCD_PASSWORD"),
+        write_format=os.environ.get("MMVMM_STORAGE_FORMAT", 'compact')  # 'flat' keeps the store readable by older versions
     )
-    vmmanager = VMMAnager(objectstore)
-    command_executer = SimpleCommandExecuter(SocketCommandProvider(), vmmanager)
+    vmmanager = VMMAnager(objectstore, snapshot_path=os.environ.get("MMVMM_SNAPSHOT_PATH", "/var/lib/mmvmm/snapshot") or None)  # Empty disables the snapshot
+
+    balloon_policy = None
+    if os.environ.get("BALLOON_LOW_WATERMARK"):
+        balloon_policy = BalloonPolicy(
+            vmmanager,
+            low_watermark=int(os.environ["BALLOON_LOW_WATERMARK"]),
+            high_watermark=int(os.environ["BALLOON_HIGH_WATERMARK"]) if os.environ.get("BALLOON_HIGH_WATERMARK") else None
+        )
+        balloon_policy.start()
+
+    command_provider = SocketCommandProvider(
+        vmmanager.get_event_bus(),
+        rate_limit=float(os.environ["MMVMM_CONTROL_RATE"]) if os.environ.get("MMVMM_CONTROL_RATE") else None,  # per connection, 0 disables
+        rate_burst=float(os.environ["MMVMM_CONTROL_BURST"]) if os.environ.get("MMVMM_CONTROL_BURST") else None
+    )
+    command_executer = SimpleCommandExecuter(command_provider, vmmanager)
 
     # register signal handlers
     def signal_handler(signum, frame):
@@ -39,6 +69,9 @@ def main():
     logging.info("Shutting down MMVMM...")
     signal.signal(signal.SIGTERM, signal.SIG_IGN)
     signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if balloon_policy:
+        balloon_policy.stop()
+
     vmmanager.close()
 
 
@@ -1,15 +1,80 @@
 #!/usr/bin/env python3
 import etcd3
+import etcd3.utils
+import json
+import zlib
 import jsonplus
 from morph import flatten, unflatten
 import os.path
 
+from tracing import Tracer
+
 
 class ObjectStore(etcd3.Etcd3Client):
+    """
+    Stores JSON objects under etcd keys. Two storage formats are understood:
+
+    - flat: the object is exploded with morph.flatten into one key per leaf, each encoded with jsonplus (the original layout)
+    - compact: the whole object is kept under it's own key, as a versioned header followed by JSON, zlib compressed if large
+
+    Both formats are read, new writes use the configured one. Writing an object in one format removes it's keys of the other.
+    """
+
+    MAX_TXN_OPS = 128  # etcd's default limit of operations in a single transaction
+
+    FORMATS = ['compact', 'flat']
+
+    COMPACT_MAGIC = b"\x00MV"  # flat leaves are JSON text, they never start with a NUL byte
+    COMPACT_VERSION = 1
+    CODEC_JSON = 0
+    CODEC_ZLIB = 1
+
+    COMPRESS_THRESHOLD = 256  # bytes, smaller payloads are not worth compressing
+
+    def __init__(self, *args, write_format: str = 'compact', compress: bool = True, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        if write_format not in self.FORMATS:
+            raise ValueError(f"Unknown storage format: {write_format}")
+
+        self._write_format = write_format
+        self._compress = compress
+
+    def get_write_format(self) -> str:
+        return self._write_format
+
+    def _encode_compact(self, value: object) -> bytes:
+        payload = json.dumps(value, separators=(',', ':')).encode('utf-8')
+        codec = self.CODEC_JSON
 
-    def _put_encoded(self, key: str, value: object):
-        encoded_value = jsonplus.dumps(value).encode('utf-8')
-        super().put(key, encoded_value)
+        if self._compress and len(payload) >= self.COMPRESS_THRESHOLD:
+            payload = zlib.compress(payload)
+            codec = self.CODEC_ZLIB
+
+        return self.COMPACT_MAGIC + bytes((self.COMPACT_VERSION, codec)) + payload
+
+    @classmethod
+    def _is_compact(cls, encoded_value: bytes) -> bool:
+        return encoded_value.startswith(cls.COMPACT_MAGIC)
+
+    @classmethod
+    def _decode(cls, encoded_value: bytes) -> object:
+        if not cls._is_compact(encoded_value):
+            return jsonplus.loads(encoded_value.decode('utf-8'))
+
+        header_length = len(cls.COMPACT_MAGIC) + 2
+        version, codec = encoded_value[len(cls.COMPACT_MAGIC):header_length]
+
+        if version != cls.COMPACT_VERSION:
+            raise ValueError(f"Unsupported storage format version: {version}")
+
+        payload = encoded_value[header_length:]
+        if codec == cls.CODEC_ZLIB:
+            payload = zlib.decompress(payload)
+        elif codec != cls.CODEC_JSON:
+            raise ValueError(f"Unsupported storage codec: {codec}")
+
+        return json.loads(payload)
 
     def _get_encoded(self, key: str) -> object:
         encoded_value = super().get(key)[0]
@@ -17,27 +82,164 @@ class ObjectStore(etcd3.Etcd3Client):
         if encoded_value is None:
             return None
 
-        return jsonplus.loads(encoded_value.decode('utf-8'))
+        return self._decode(encoded_value)
 
     def put(self, basekey: str, value: object):
 
-        if isinstance(value, dict):
-            for key, value in flatten(value, separator='/').items():
-                self._put_encoded(os.path.join(basekey, str(key)), value)
-        else:
-            self._put_encoded(basekey, value)
+        with Tracer.span("objectstore.put", key=basekey):
+            self.write_batch([(basekey, value)])
 
     def get(self, key: str) -> object:
-        return self._get_encoded(key)
+        with Tracer.span("objectstore.get", key=key):
+            return self._get_encoded(key)
+
+    @staticmethod
+    def _group(basekey: str, kvs) -> dict:
+        """
+        Groups the keys under a prefix by object. Returns name -> [latest modification revision, compact value, flat leaves]
+        """
+        objects = {}
+        start = len(basekey.rstrip('/')) + 1
+        for kv in kvs:
+            name, _, leaf_key = kv.key.decode('utf-8')[start:].partition('/')
+
+            entry = objects.get(name)
+            if entry is None:
+                entry = objects[name] = [0, None, []]
+
+            entry[0] = max(entry[0], kv.mod_revision)
+
+            if not leaf_key and ObjectStore._is_compact(kv.value):
+                entry[1] = kv.value
+            else:
+                entry[2].append((leaf_key, kv.value))
+
+        return objects
+
+    @classmethod
+    def _decode_object(cls, entry: list) -> object:
+        _, compact_value, leaves = entry
+
+        if compact_value is not None:
+            return cls._decode(compact_value)
+
+        if len(leaves) == 1 and not leaves[0][0]:  # not a dict, stored under the key of the object
+            return cls._decode(leaves[0][1])
+
+        return unflatten({leaf_key: jsonplus.loads(encoded_value.decode('utf-8')) for leaf_key, encoded_value in leaves}, separator='/')
+
+    def get_prefix(self, basekey: str) -> dict:
+        with Tracer.span("objectstore.get_prefix", key=basekey):
+            response = super().get_prefix_response(basekey)
+            return {name: self._decode_object(entry) for name, entry in self._group(basekey, response.kvs).items()}
+
+    def get_prefix_since(self, basekey: str, revision: int = 0) -> tuple:
+        """
+        Reads the objects under a prefix, but decodes only the ones modified after the given revision.
+        Returns (changed objects, names of all objects, the revision of the read).
+        """
+        with Tracer.span("objectstore.get_prefix_since", key=basekey, revision=revision):
+            response = super().get_prefix_response(basekey)
+            objects = self._group(basekey, response.kvs)
+
+            changed = {name: self._decode_object(entry) for name, entry in objects.items() if entry[0] > revision}
+            return changed, set(objects.keys()), response.header.revision
+
+    def delete_prefix(self, prefix: str):
+        with Tracer.span("objectstore.delete_prefix", key=prefix):
+            return super().delete_prefix(prefix)
+
+    def _replace_operations(self, basekey: str, value: object, write_format: str = None) -> list:
+        """
+        Returns the operations replacing an object, including the removal of it's keys in the other format.
+        Only the gaps between the new keys are deleted, because etcd rejects transactions where a put overlaps a deleted range.
+        """
+        prefix = etcd3.utils.to_bytes(basekey.rstrip('/') + '/')
+        object_key = etcd3.utils.to_bytes(basekey)
+        write_format = write_format or self._write_format
+
+        if value is None:
+            encoded = {}
+        elif write_format == 'compact':
+            encoded = {object_key: self._encode_compact(value)}
+        elif isinstance(value, dict):
+            encoded = {etcd3.utils.to_bytes(os.path.join(basekey, str(key))): jsonplus.dumps(leaf).encode('utf-8') for key, leaf in flatten(value, separator='/').items()}
+        else:
+            encoded = {object_key: jsonplus.dumps(value).encode('utf-8')}
+
+        operations = []
+        if object_key not in encoded:
+            operations.append(self.transactions.delete(object_key))
+
+        gap_start = prefix
+        for key in sorted(encoded.keys()):
+            if key.startswith(prefix):
+                if gap_start < key:
+                    operations.append(self.transactions.delete(gap_start, range_end=key))
+                gap_start = key + b'\x00'
+
+            operations.append(self.transactions.put(key, encoded[key]))
+
+        operations.append(self.transactions.delete(gap_start, range_end=etcd3.utils.increment_last_byte(prefix)))
+        return operations
+
+    def migrate(self, basekey: str) -> dict:
+        """
+        Rewrites the objects under a prefix stored in the flat format into the compact one, while the store is in use.
+        Each object is rewritten in a transaction that fails if any of it's keys changed since it was read,
+        those are counted as conflicts and left alone (run again to migrate them).
+        """
+        with Tracer.span("objectstore.migrate", key=basekey):
+            response = super().get_prefix_response(basekey)
+            revision = response.header.revision
+
+            result = {"migrated": 0, "conflicts": 0, "compact": 0, "failed": {}}
+            for name, entry in self._group(basekey, response.kvs).items():
+                if entry[1] is not None and not entry[2]:
+                    result['compact'] += 1
+                    continue
+
+                object_key = os.path.join(basekey, name)
+                prefix = etcd3.utils.to_bytes(object_key + '/')
+
+                try:
+                    value = self._decode_object(entry)
+                except ValueError as e:
+                    result['failed'][name] = str(e)
+                    continue
+
+                succeeded, _ = self.transaction(
+                    compare=[
+                        self.transactions.mod(object_key) < revision + 1,
+                        self.transactions.mod(prefix, etcd3.utils.increment_last_byte(prefix)) < revision + 1
+                    ],
+                    success=self._replace_operations(object_key, value, 'compact'),
+                    failure=[]
+                )
+
+                result['migrated' if succeeded else 'conflicts'] += 1
+
+            return result
 
-    def get_prefix(self, basekey: str) -> list:
-        encoded_values = super().get_prefix(basekey)
-        flat_dict = {}
-        for encoded_value in encoded_values:
-            decoded_value = jsonplus.loads(encoded_value[0].decode('utf-8'))
-            flat_dict[os.path.relpath(encoded_value[1].key.decode('utf-8'), start=basekey)] = decoded_value
+    def write_batch(self, items: list):
+        """
+        Writes (key, value) pairs in as few transactions as possible, a None value deletes the object.
+        Each object is replaced atomically, unless it alone needs more operations than a transaction can hold.
+        """
+        with Tracer.span("objectstore.write_batch", objects=len(items)):
+            transaction = []
+            for basekey, value in items:
+                operations = self._replace_operations(basekey, value)
 
-        return unflatten(flat_dict, separator='/')
+                if transaction and len(transaction) + len(operations) > self.MAX_TXN_OPS:
+                    self.transaction(compare=[], success=transaction)
+                    transaction = []
 
+                while len(operations) > self.MAX_TXN_OPS:
+                    self.transaction(compare=[], success=operations[:self.MAX_TXN_OPS])
+                    operations = operations[self.MAX_TXN_OPS:]
 
+                transaction += operations
 
+            if transaction:
+                self.transaction(compare=[], success=transaction)
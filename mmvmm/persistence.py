@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+import time
+import logging
+from threading import Thread, Condition
+
+from objectstore import ObjectStore
+from tracing import Tracer
+
+
+class PersistenceQueue(Thread):
+    """
+    Write-behind queue between the manager and the object store.
+    Pending writes of the same key are collapsed to the latest value, and written in batched transactions
+    after a short delay, or immediately when enough writes are pending. Failed batches are retried.
+    """
+
+    def __init__(self, objectstore: ObjectStore, interval: float = 0.05, batch_size: int = 64, retry_interval: float = 1, on_stored: callable = None):
+        Thread.__init__(self, daemon=True)
+        self._logger = logging.getLogger("persistence")
+
+        self._objectstore = objectstore
+        self._interval = interval  # sec, how long a write may wait for others to be batched with
+        self._batch_size = batch_size  # number of keys that triggers an immediate flush
+        self._retry_interval = retry_interval
+        self._on_stored = on_stored  # called from the writer thread after each stored batch
+
+        self._pending = {}  # key -> value, None means delete
+        self._in_flight = {}  # the batch being written
+        self._enqueued = 0  # Sequence number of the latest write
+        self._written = 0  # Every write up to this sequence number is stored
+        self._pending_since = None
+        self._flush_requested = False
+
+        self._active = True
+        self._cond = Condition()
+
+        self._stats = {"writes": 0, "coalesced": 0, "batches": 0, "stored": 0, "errors": 0}
+
+    def save(self, key: str, value: object):
+        self._enqueue(key, value)
+
+    def delete(self, key: str):
+        self._enqueue(key, None)
+
+    def _enqueue(self, key: str, value: object):
+        with self._cond:
+            if not self._active:
+                raise RuntimeError("The persistence queue is closed")
+
+            if key in self._pending:
+                self._stats['coalesced'] += 1
+
+            self._pending[key] = value
+            self._enqueued += 1
+            self._stats['writes'] += 1
+
+            if self._pending_since is None:
+                self._pending_since = time.monotonic()
+
+            if len(self._pending) == 1 or len(self._pending) >= self._batch_size:  # the writer starts timing the batch, or writes it
+                self._cond.notify_all()
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        Barrier, waits until every write enqueued before the call is stored. Returns False on timeout.
+        """
+        with self._cond:
+            target = self._enqueued
+            self._flush_requested = True
+            self._cond.notify_all()
+
+            return self._cond.wait_for(lambda: self._written >= target, timeout)
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._pending)
+
+    def pending_keys(self, prefix: str = "") -> set:
+        """
+        Returns the keys with writes not stored yet, including the ones being written
+        """
+        with self._cond:
+            return {key for key in list(self._pending) + list(self._in_flight) if key.startswith(prefix)}
+
+    def stats(self) -> dict:
+        with self._cond:
+            return dict(self._stats, pending=len(self._pending))
+
+    def _should_write(self) -> bool:
+        if not self._pending:
+            return False
+
+        if self._flush_requested or not self._active or len(self._pending) >= self._batch_size:
+            return True
+
+        return time.monotonic() - self._pending_since >= self._interval
+
+    def _wait_timeout(self) -> float:
+        if not self._pending:
+            return None
+
+        return max(0.0, self._interval - (time.monotonic() - self._pending_since))
+
+    def run(self):
+        while True:
+            with self._cond:
+                while self._active and not self._should_write():
+                    self._cond.wait(self._wait_timeout())
+
+                if not self._pending:  # closed and drained
+                    self._flush_requested = False
+                    self._cond.notify_all()
+                    return
+
+                batch = self._pending
+                target = self._enqueued
+                self._in_flight = batch
+                self._pending = {}
+                self._pending_since = None
+                self._flush_requested = False
+
+            try:
+                with Tracer.span("persistence.write", keys=len(batch)):
+                    self._objectstore.write_batch(list(batch.items()))
+
+            except Exception as e:
+                self._logger.error(f"Could not store {len(batch)} pending writes: {str(e)}. Retrying...")
+
+                with self._cond:
+                    self._stats['errors'] += 1
+                    self._in_flight = {}
+
+                    for key, value in batch.items():  # Newer writes of the same key supersede the failed ones
+                        if key not in self._pending:
+                            self._pending[key] = value
+
+                    if self._pending_since is None:
+                        self._pending_since = time.monotonic()
+
+                    self._cond.wait(self._retry_interval)
+
+                continue
+
+            with self._cond:
+                self._written = target  # Everything enqueued before the batch was taken is either in it, or stored earlier
+                self._in_flight = {}
+                self._stats['batches'] += 1
+                self._stats['stored'] += len(batch)
+                self._cond.notify_all()
+
+            if self._on_stored:
+                try:
+                    self._on_stored()
+                except Exception as e:
+                    self._logger.error(f"Error in stored callback: {str(e)}")
+
+    def close(self, timeout: float = None):
+        """
+        Stops accepting writes, and waits until the pending ones are stored
+        """
+        with self._cond:
+            self._active = False
+            self._cond.notify_all()
+
+        self.join(timeout)
+
+        if self.is_alive():
+            self._logger.error(f"Could not store {self.pending()} pending writes before closing!")
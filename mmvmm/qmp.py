@@ -5,17 +5,24 @@ import socket
 import json
 import random
 import string
-from threading import Thread, Lock
-import queue
+import itertools
+from threading import Thread, Lock, Condition
 
 import logging
 
 from bettersocket import BetterSocketIO
 from utils import JSONSocketWrapper
+from tracing import Tracer
+from deadline import Deadline
+from exception import DeadlineExceededError
+
+SOCKET_DIR = "/run/mmvmm"
 
 
 class QMPMonitor(Thread):
 
+    COMMAND_TIMEOUT = 30  # sec, a command not answered in time is considered lost, so a hung QEMU can not block it's callers forever
+
     def __init__(self, upper_level_logger: logging.Logger):
         self._logger = upper_level_logger.getChild('qmp')
         Thread.__init__(self)
@@ -29,7 +36,10 @@ class QMPMonitor(Thread):
         self._online = False  # Became true when the QMP connection is negotiated
 
         self._command_sender_lock = Lock()
-        self._response_queue = queue.Queue(1)  # one element only, this is a thread safe class
+        self._response_cond = Condition()
+        self._command_ids = itertools.count(1)
+        self._waiting_for = None  # id of the command waiting for a response, late responses of earlier ones are dropped
+        self._response = None
 
         self._event_listeners = {}
 
@@ -37,7 +47,7 @@ class QMPMonitor(Thread):
     def _create_socket_path():
         matches = 0
         while True:
-            sock_path = os.path.join("/run", "mmvmm", "qmp_" + ''.join(random.choice(string.ascii_lowercase) for i in range(12 + matches)) + ".sock")
+            sock_path = os.path.join(SOCKET_DIR, "qmp_" + ''.join(random.choice(string.ascii_lowercase) for i in range(12 + matches)) + ".sock")
             if os.path.exists(sock_path):
                 matches += 1
             else:
@@ -70,7 +80,7 @@ class QMPMonitor(Thread):
         if cleanup and os.path.exists(self._socket_path):  # useful when using SIGKILL on QEMU
             os.remove(self._socket_path)
 
-    def run(self):
+    def _handshake(self) -> bool:  # returns: bool connected and negotiated
         # connect
 
         retries = 5  # Only retries if the socket is not present
@@ -87,29 +97,36 @@ class QMPMonitor(Thread):
                 retries -= 1
                 if retries == 0:
                     self._logger.error("Couldn't connect after 5 attempts")
-                    return
+                    return False
                 else:
                     self._logger.debug("Failed to connect. Retrying...")
 
             except ConnectionRefusedError:  # The socket is there... but it refuses connection... probably QEMU crashed or something. Returning unconditionally
                 self._logger.error("Connection refused while connecting. (vm crashed?)")
-                return
+                return False
 
             except OSError as e:
                 self._logger.error(f"Could not connect: {str(e)}")
-                return
+                return False
 
         if not connected:  # probably active turned to false
-            return
+            return False
 
         # negotiate
 
         if not self._negotiation():
             self._logger.warning(f"Negotiation failed with QMP protocol on: {self._socket_path}")
             self._socket.close()
-            return
+            return False
         else:
             self._logger.debug("Negotiated!")
+            return True
+
+    def run(self):
+
+        with Tracer.span("qmp.handshake", logger=self._logger.name):
+            if not self._handshake():
+                return
 
         # run
         # from now on, this thread simply functions as a reciever thread for the issued commands
@@ -134,23 +151,31 @@ class QMPMonitor(Thread):
                 event = data['event']
                 self._logger.debug(f"Event happened: {event}")
 
-                if event in self._event_listeners.keys():
-                    self._event_listeners[event](data['data'])
+                for listener in self._event_listeners.get('*', []) + self._event_listeners.get(event, []):
+                    listener(event, data.get('data', {}))
 
-            elif "return" in data:
-                self._logger.debug("Command successful")
-                self._response_queue.put(data)  # this also signals the thread to continue, and also blocks this thread if the previous response is not processed yet
+            elif "return" in data or "error" in data:
+                if "error" in data:
+                    self._logger.error(f"Command returned error: {data['error']['class']}")
+                else:
+                    self._logger.debug("Command successful")
 
-            elif "error" in data:
-                self._logger.error(f"Command returned error: {data['error']['class']}")
-                self._response_queue.put(data)
+                with self._response_cond:
+                    if data.get('id') == self._waiting_for:
+                        self._response = data
+                        self._response_cond.notify_all()
+                    else:
+                        self._logger.warning(f"Dropping late response to command {data.get('id')}")
 
             else:
                 self._logger.warning("Unknown message recieved")
 
         # active became false:
 
-        self._online = False
+        with self._response_cond:
+            self._online = False
+            self._response_cond.notify_all()  # the command waiting for a response fails
+
         self._socket.close()
 
         self._logger.debug("Session closed")
@@ -162,30 +187,56 @@ class QMPMonitor(Thread):
     def send_command(self, cmd: dict, _timeout: float = None):
         """
         This function sends a command to the QMP and waits it's response.
+        Returns None if QMP disconnected, or the response did not arrive in time (_timeout, or COMMAND_TIMEOUT by default).
+        Raises DeadlineExceededError if the deadline of the current command passed while waiting.
         """
 
-        with self._command_sender_lock:
+        with Tracer.span("qmp.command", execute=cmd.get('execute', '')), Deadline.acquire(self._command_sender_lock, "QMP"):
 
             if not self._online:  # this is moved inside the locked area to ensure that if a command caused QMP to disconnect, others waiting for the lock will fail
                 raise ConnectionError("QMP is offline")
 
-            try:
-                self._jsonsock.send_json(cmd)
-            except (BrokenPipeError, OSError):  # The pipe have borked
-                self._logger.debug("Error while sending command. (VM crashed?)")
-                self._online = False
-                return None
+            timeout, limited_by_deadline = Deadline.timeout(_timeout or self.COMMAND_TIMEOUT, f"QMP command {cmd.get('execute')}")
+
+            command_id = next(self._command_ids)
+            with self._response_cond:
+                self._waiting_for = command_id
+                self._response = None
 
             try:
-                return self._response_queue.get(timeout=_timeout)
+                try:
+                    self._jsonsock.send_json(dict(cmd, id=command_id))  # QEMU echoes the id in the response
+                except (BrokenPipeError, OSError):  # The pipe have borked
+                    self._logger.debug("Error while sending command. (VM crashed?)")
+                    self._online = False
+                    return None
 
-            except Queue.Empty:  # there was no response
-                return None
+                with self._response_cond:
+                    if self._response_cond.wait_for(lambda: self._response is not None or not self._online, timeout):
+                        return self._response  # None if QMP went offline
+
+            finally:
+                with self._response_cond:
+                    self._waiting_for = None
+                    self._response = None
+
+            # there was no response in time
+            self._logger.warning(f"No response to {cmd.get('execute')} in {timeout:.1f}sec")
+            if limited_by_deadline:
+                raise DeadlineExceededError(f"QMP command {cmd.get('execute')}")
+
+            return None
 
     def register_event_listener(self, event: str, listener: callable):  # Event handlers should return quickly, not to halt the thread
         """
-        Register callable objects to be called when a QMP event occours. 
+        Register callable objects to be called with (event, data) when a QMP event occours. Use '*' to listen to all events.
         
         Events are called from the reciever thread, so they should not be long-running
         """
-        self._event_listeners[event] = listener
+        self._event_listeners.setdefault(event, []).append(listener)
+
+    def unregister_event_listener(self, event: str, listener: callable):
+        try:
+            self._event_listeners.get(event, []).remove(listener)
+        except ValueError:
+            pass
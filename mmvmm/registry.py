@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+import bisect
+from threading import RLock
+
+from vm import VM
+
+
+class VMRegistry(object):
+    """
+    Keeps the VMs by name, along with secondary indexes that are updated incrementally when a VM is added, removed,
+    started, stopped or it's description changes.
+    """
+
+    INDEXED_KEYS = ['autostart', 'master', 'disk', 'tag']
+
+    def __init__(self, listener: callable = None):
+        self._listener = listener  # Called with the events of the registered VMs, after the indexes are updated
+
+        self._vms = {}
+        self._sorted_names = []  # for cursor based pagination
+
+        self._indexes = {key: {} for key in self.INDEXED_KEYS}  # key -> value -> set of names
+        self._index_keys = {}  # name -> the values the VM is indexed by, needed for removal
+        self._running = set()  # names of VMs reported running by their last start/stop event
+
+        self._lock = RLock()
+
+    def _index(self, name: str, index_keys: dict):
+        for key in self.INDEXED_KEYS:
+            values = index_keys[key] if isinstance(index_keys[key], set) else {index_keys[key]}
+            for value in values:
+                self._indexes[key].setdefault(value, set()).add(name)
+
+        self._index_keys[name] = index_keys
+
+    def _unindex(self, name: str):
+        index_keys = self._index_keys.pop(name, None)
+        if not index_keys:
+            return
+
+        for key in self.INDEXED_KEYS:
+            values = index_keys[key] if isinstance(index_keys[key], set) else {index_keys[key]}
+            for value in values:
+                names = self._indexes[key].get(value)
+                if names is not None:
+                    names.discard(name)
+                    if not names:
+                        del self._indexes[key][value]
+
+    def _on_vm_event(self, vm: VM, event: str, data: dict):
+        name = vm.get_name()
+
+        if event == 'description':
+            index_keys = vm.get_index_keys()
+
+        with self._lock:
+            if name not in self._vms:
+                return
+
+            if event == 'started':
+                self._running.add(name)
+            elif event == 'stopped':
+                self._running.discard(name)
+            elif event == 'description':
+                self._unindex(name)
+                self._index(name, index_keys)
+
+        if self._listener:
+            self._listener(vm, event, data)
+
+    def add(self, vm: VM):
+        name = vm.get_name()
+        index_keys = vm.get_index_keys()  # collected before locking, VM locks are never taken inside the registry lock
+        running = vm.is_running()
+
+        with self._lock:
+            if name in self._vms:
+                raise KeyError("A virtual machine with this name already exists...")
+
+            self._vms[name] = vm
+            bisect.insort(self._sorted_names, name)
+            self._index(name, index_keys)
+
+            if running:
+                self._running.add(name)
+
+        vm.add_listener(self._on_vm_event)
+
+    def add_many(self, vms: list):
+        """
+        Adds VMs in bulk, sorting the names only once
+        """
+        prepared = [(vm, vm.get_name(), vm.get_index_keys(), vm.is_running()) for vm in vms]
+
+        with self._lock:
+            for vm, name, index_keys, running in prepared:
+                if name in self._vms:
+                    raise KeyError("A virtual machine with this name already exists...")
+
+                self._vms[name] = vm
+                self._index(name, index_keys)
+
+                if running:
+                    self._running.add(name)
+
+            self._sorted_names = sorted(self._vms.keys())
+
+        for vm, _, _, _ in prepared:
+            vm.add_listener(self._on_vm_event)
+
+    def remove(self, name: str) -> VM:
+        with self._lock:
+            vm = self._vms.pop(name)
+            del self._sorted_names[bisect.bisect_left(self._sorted_names, name)]
+            self._unindex(name)
+            self._running.discard(name)
+
+        vm.remove_listener(self._on_vm_event)
+        return vm
+
+    def get(self, name: str) -> VM:
+        return self._vms[name]  # raises KeyError
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._vms
+
+    def __len__(self) -> int:
+        return len(self._vms)
+
+    def names(self) -> list:
+        with self._lock:
+            return list(self._sorted_names)
+
+    def vms(self) -> list:
+        with self._lock:
+            return [self._vms[name] for name in self._sorted_names]
+
+    def _candidates(self, filters: dict) -> set:
+        """
+        Returns the names matching the indexed filters, or None if there are no indexed filters
+        """
+        sets = []
+        for key, value in filters.items():
+            if key == 'running':
+                if value:  # Stopped VMs are not narrowed by the index, a crashed QEMU leaves it's VM in the running set
+                    sets.append(self._running)
+
+            elif key in self.INDEXED_KEYS:
+                values = value if isinstance(value, list) else [value]  # lists match all values
+                for single_value in values:
+                    sets.append(self._indexes[key].get(single_value, set()))
+
+            else:
+                raise KeyError(f"Unknown filter: {key}")
+
+        if not sets:
+            return None
+
+        sets.sort(key=len)
+        result = set(sets[0])
+        for other in sets[1:]:
+            result &= other
+            if not result:
+                break
+
+        return result
+
+    def query(self, filters: dict = None, cursor: str = None, limit: int = None) -> tuple:
+        """
+        Returns the VMs matching all filters, ordered by name, starting after the cursor (a name).
+        Returns a (vms, next_cursor) tuple, next_cursor is None when there are no more results.
+        """
+        filters = filters or {}
+
+        with self._lock:
+            candidates = self._candidates(filters)
+
+            start = bisect.bisect_right(self._sorted_names, cursor) if cursor else 0
+
+            if candidates is None:
+                names = self._sorted_names[start:]
+            elif len(candidates) < len(self._sorted_names) - start:
+                names = sorted(name for name in candidates if not cursor or name > cursor)
+            else:
+                names = [name for name in self._sorted_names[start:] if name in candidates]
+
+            vms = [self._vms[name] for name in names]
+
+        # The running state index is updated by events, but a crashed QEMU does not send one.
+        if 'running' in filters:
+            vms = [vm for vm in vms if vm.is_running() == bool(filters['running'])]
+
+        if limit is not None and len(vms) > limit:
+            return vms[:limit], vms[limit - 1].get_name()
+
+        return vms, None
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+import time
+from collections import deque
+
+# Lifecycle commands are served first, read-only ones last
+PRIORITY_LIFECYCLE = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_READ = 2
+
+PRIORITY_NAMES = {PRIORITY_LIFECYCLE: "lifecycle", PRIORITY_DEFAULT: "default", PRIORITY_READ: "read"}
+
+LIFECYCLE_COMMANDS = {'start', 'poweroff', 'terminate', 'reset', 'pause', 'cont'}
+READ_COMMANDS = {'query', 'stats'}
+READ_PREFIXES = ('get_', 'is_', 'dump_')
+
+
+def command_priority(cmd: str) -> int:
+    if cmd in LIFECYCLE_COMMANDS:
+        return PRIORITY_LIFECYCLE
+
+    if cmd in READ_COMMANDS or cmd.startswith(READ_PREFIXES):
+        return PRIORITY_READ
+
+    return PRIORITY_DEFAULT
+
+
+class TokenBucket(object):
+    """
+    Allows rate commands per second on average, and bursts of up to burst commands
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+
+    def take(self) -> bool:
+        now = time.monotonic()
+        self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+        if self._tokens < 1:
+            return False
+
+        self._tokens -= 1
+        return True
+
+
+class Flow(object):
+    """
+    The queued commands of one connection. They are served in order, so responses of a connection are never reordered.
+    """
+
+    def __init__(self, name: str, weight: float):
+        self.name = name
+        self.weight = weight
+        self.queue = deque()  # (priority, item)
+        self.finish = 0.0  # virtual finish time of the head command
+        self.last_finish = 0.0
+        self.dispatched = 0
+        self.rejected = 0
+
+
+class FairScheduler(object):
+    """
+    Admission control and weighted fair queuing between connections (flows).
+    The flow whose head command has the highest priority is served first. Among equal priorities the one with the
+    smallest virtual finish time wins, so each flow gets a share proportional to it's weight, no matter how much it queues.
+    Not thread safe, used from the command loop only.
+    """
+
+    def __init__(self, rate: float = 0, burst: float = 0, max_queued_per_flow: int = 128, max_queued: int = 10000):
+        self._rate = rate  # commands/sec per flow, 0 disables rate limiting
+        self._burst = burst or rate
+        self._max_queued_per_flow = max_queued_per_flow
+        self._max_queued = max_queued
+
+        self._flows = {}  # key -> Flow
+        self._buckets = {}  # key -> TokenBucket
+        self._virtual_time = 0.0
+        self._queued = 0
+
+        self._stats = {"dispatched": 0, "rejected": {"rate_limited": 0, "flow_queue_full": 0, "queue_full": 0}}
+        self._dispatched_by_priority = {name: 0 for name in PRIORITY_NAMES.values()}
+
+    def add_flow(self, key: object, name: str, weight: float = 1.0):
+        self._flows[key] = Flow(name, weight)
+        if self._rate:
+            self._buckets[key] = TokenBucket(self._rate, self._burst)
+
+    def configure_flow(self, key: object, name: str = None, weight: float = None):
+        flow = self._flows[key]
+        if name:
+            flow.name = name
+        if weight:
+            flow.weight = weight
+
+    def remove_flow(self, key: object) -> list:
+        """
+        Forgets a flow, returns the items still queued
+        """
+        flow = self._flows.pop(key)
+        self._buckets.pop(key, None)
+        self._queued -= len(flow.queue)
+        return [item for _, item in flow.queue]
+
+    def queued(self, key: object) -> int:
+        return len(self._flows[key].queue)
+
+    def _start_head(self, flow: Flow):
+        flow.finish = max(self._virtual_time, flow.last_finish) + 1 / flow.weight
+
+    def enqueue(self, key: object, cmd: str, item: object) -> str:
+        """
+        Queues an item. Returns None if admitted, otherwise the reason of the rejection.
+        """
+        flow = self._flows[key]
+
+        reason = None
+        if key in self._buckets and not self._buckets[key].take():
+            reason = "rate_limited"
+        elif len(flow.queue) >= self._max_queued_per_flow:
+            reason = "flow_queue_full"
+        elif self._queued >= self._max_queued:
+            reason = "queue_full"
+
+        if reason:
+            flow.rejected += 1
+            self._stats['rejected'][reason] += 1
+            return reason
+
+        flow.queue.append((command_priority(cmd), item))
+        self._queued += 1
+
+        if len(flow.queue) == 1:
+            self._start_head(flow)
+
+        return None
+
+    def __bool__(self):
+        return self._queued > 0
+
+    def dequeue(self) -> object:
+        best = None
+        for flow in self._flows.values():
+            if not flow.queue:
+                continue
+
+            if best is None or (flow.queue[0][0], flow.finish) < (best.queue[0][0], best.finish):
+                best = flow
+
+        if best is None:
+            return None
+
+        priority, item = best.queue.popleft()
+        self._queued -= 1
+
+        self._virtual_time = max(self._virtual_time, best.finish - 1 / best.weight)  # the start time of the served command
+        best.last_finish = best.finish
+        best.dispatched += 1
+        if best.queue:
+            self._start_head(best)
+
+        self._stats['dispatched'] += 1
+        self._dispatched_by_priority[PRIORITY_NAMES[priority]] += 1
+        return item
+
+    def stats(self) -> dict:
+        depths = {name: 0 for name in PRIORITY_NAMES.values()}
+        for flow in self._flows.values():
+            for priority, _ in flow.queue:
+                depths[PRIORITY_NAMES[priority]] += 1
+
+        return {
+            "rate": self._rate,
+            "burst": self._burst,
+            "connections": len(self._flows),
+            "queued": self._queued,
+            "queued_by_priority": depths,
+            "max_flow_queued": max((len(flow.queue) for flow in self._flows.values()), default=0),
+            "dispatched": self._stats['dispatched'],
+            "dispatched_by_priority": dict(self._dispatched_by_priority),
+            "rejected": dict(self._stats['rejected']),
+            "flows": [
+                {"name": flow.name, "weight": flow.weight, "queued": len(flow.queue), "dispatched": flow.dispatched, "rejected": flow.rejected}
+                for flow in self._flows.values()
+            ]
+        }
@@ -5,11 +5,32 @@ from marshmallow.validate import Regexp, Length, OneOf, Range
 from marshmallow import RAISE
 
 
+class ThrottleDescriptionSchema(Schema):
+    # Limits of QEMU's I/O throttling (0 means unlimited), the names are the same as the arguments of block_set_io_throttle
+    bps = fields.Int(validate=Range(min=0), default=0, missing=0)  # Byte/sec
+    bps_rd = fields.Int(validate=Range(min=0), default=0, missing=0)
+    bps_wr = fields.Int(validate=Range(min=0), default=0, missing=0)
+    iops = fields.Int(validate=Range(min=0), default=0, missing=0)
+    iops_rd = fields.Int(validate=Range(min=0), default=0, missing=0)
+    iops_wr = fields.Int(validate=Range(min=0), default=0, missing=0)
+
+    # Burst limits, each one needs the corresponding limit above to be set
+    bps_max = fields.Int(validate=Range(min=0), default=0, missing=0)
+    bps_rd_max = fields.Int(validate=Range(min=0), default=0, missing=0)
+    bps_wr_max = fields.Int(validate=Range(min=0), default=0, missing=0)
+    iops_max = fields.Int(validate=Range(min=0), default=0, missing=0)
+    iops_rd_max = fields.Int(validate=Range(min=0), default=0, missing=0)
+    iops_wr_max = fields.Int(validate=Range(min=0), default=0, missing=0)
+    burst_length = fields.Int(validate=Range(min=1), default=1, missing=1)  # sec
+
+
 class MediaDescriptionSchema(Schema):
     type = fields.Str(validate=OneOf(['disk', 'cdrom']), required=True)
     path = fields.Str(validate=Regexp('^\/+[^\\0]+$'), required=True)  # Only absolute path allowed
     format = fields.Str(validate=OneOf(['raw', 'qcow2']), required=True)
     readonly = fields.Boolean(default=False, missing=False)
+    throttle = fields.Nested(ThrottleDescriptionSchema, many=False, allow_none=True, default=None, missing=None)  # Limits of this drive only
+    qos = fields.Str(validate=Regexp("^[a-z]+[a-z0-9]*$"), allow_none=True, default=None, missing=None)  # Name of a QoS class, overrides throttle
 
 
 class NICDesciptionSchema(Schema):
@@ -18,11 +39,41 @@ class NICDesciptionSchema(Schema):
     master = fields.Str(allow_none=False, required=True)
 
 
+class MemoryDescriptionSchema(Schema):
+    backend = fields.Str(validate=OneOf(['default', 'hugepages', 'memfd']), default='default', missing='default')
+    hugepages_path = fields.Str(validate=Regexp('^\/+[^\\0]+$'), default='/dev/hugepages', missing='/dev/hugepages')  # Only used by the hugepages backend
+    share = fields.Boolean(default=False, missing=False)
+    merge = fields.Boolean(default=False, missing=False)  # KSM, opt-in
+    prealloc = fields.Boolean(default=False, missing=False)
+    balloon = fields.Boolean(default=False, missing=False)
+    free_page_reporting = fields.Boolean(default=False, missing=False)  # Only used when balloon is enabled
+
+
+_memory_defaults = MemoryDescriptionSchema().load({})  # loading it once is way cheaper than on every missing memory description
+
+
+class ResourcesDescriptionSchema(Schema):
+    # Limits of the VM's cgroup
+    cpu_max = fields.Int(validate=Range(min=1), allow_none=True, default=None, missing=None)  # Percent of one host CPU, None means unlimited
+    cpu_weight = fields.Int(validate=Range(min=1, max=10000), default=100, missing=100)
+    memory_max = fields.Int(validate=Range(min=1), allow_none=True, default=None, missing=None)  # MByte, QEMU gets OOM killed above this
+    memory_high = fields.Int(validate=Range(min=1), allow_none=True, default=None, missing=None)  # MByte, reclaimed and throttled above this
+    io_weight = fields.Int(validate=Range(min=1, max=10000), default=100, missing=100)
+
+
+_resources_defaults = ResourcesDescriptionSchema().load({})
+
+
 class VMHardwareDescriptionSchema(Schema):
     cpu = fields.Int(validate=Range(min=1), required=True)  # Cpu SMP count
     ram = fields.Int(validate=Range(min=1), required=True)  # MByte
+    max_cpu = fields.Int(validate=Range(min=1), allow_none=True, default=None, missing=None)  # Allows hotplugging vCPUs up to this count
+    max_ram = fields.Int(validate=Range(min=1), allow_none=True, default=None, missing=None)  # MByte, allows hotplugging memory up to this size
+    memory = fields.Nested(MemoryDescriptionSchema, many=False, missing=lambda: dict(_memory_defaults))
     boot = fields.Str(validate=OneOf(['c', 'n', 'd']), default='d', missing='d')
     rtc_utc = fields.Boolean(default=True, missing=True)
+    guest_agent = fields.Boolean(default=False, missing=False)  # virtio-serial channel for the QEMU guest agent
+    resources = fields.Nested(ResourcesDescriptionSchema, many=False, missing=lambda: dict(_resources_defaults))
 
     network = fields.Nested(NICDesciptionSchema, many=True, required=True)
     media = fields.Nested(MediaDescriptionSchema, many=True, required=True)
@@ -36,6 +87,9 @@ class VMDescriptionSchema(Schema):
     hardware = fields.Nested(VMHardwareDescriptionSchema, many=False, required=True)
     vnc = fields.Nested(VNCDescription, many=False, required=True)
     autostart = fields.Boolean(default=False, missing=False)
+    tags = fields.List(fields.Str(validate=Length(min=1, max=64)), default=list, missing=list)
+    template = fields.Boolean(default=False, missing=False)  # The disks back the overlays of clones, it can not be started
+    clone_of = fields.Str(allow_none=True, default=None, missing=None)  # The template the disks of this VM are backed by
 
     class Meta:
         unknown = RAISE
@@ -48,10 +102,19 @@ class VMNameSchema(Schema):
             unknown = RAISE
 
 
+class QoSClassNameSchema(Schema):
+        name = fields.Str(validate=[Length(min=1, max=42), Regexp("^[a-z]+[a-z0-9]*$")])
+
+        class Meta:
+            unknown = RAISE
+
+
 class ControlCommandSchema(Schema):
         cmd = fields.Str(validate=Length(min=1), required=True, allow_none=False)
         args = fields.Dict(missing={})
         target = fields.Str(allow_none=True, missing=None)
+        id = fields.Int(allow_none=True, missing=None)  # echoed in the response, so pipelining clients can match them
+        deadline = fields.Float(allow_none=True, missing=None)  # unix timestamp, the command fails with a timeout error after it
 
         class Meta:
             unknown = RAISE
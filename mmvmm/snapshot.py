@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+import os
+import mmap
+import json
+import zlib
+import struct
+import logging
+
+from tracing import Tracer
+
+
+class DescriptionSnapshot(object):
+    """
+    Local copy of the stored VM descriptions, along with the etcd revision they were read at.
+    Kept in a single checksummed file, which is replaced atomically, so a crash never leaves a torn snapshot behind.
+
+    Layout: header (magic, version, flags, revision, payload length, crc32 of the payload), then the JSON payload.
+    """
+
+    MAGIC = b"MMVMMSNP"
+    VERSION = 1
+    FLAG_COMPRESSED = 1
+
+    _header = struct.Struct("<8sIIQQI")
+
+    def __init__(self, path: str, compress: bool = True):
+        self._logger = logging.getLogger("snapshot")
+        self._path = path
+        self._compress = compress
+
+    def get_path(self) -> str:
+        return self._path
+
+    def write(self, revision: int, descriptions: dict, qos_classes: dict, dirty: list):
+        """
+        Stores the descriptions read at the given revision. Dirty VMs have local changes that are not stored in etcd yet.
+        """
+        with Tracer.span("snapshot.write", vms=len(descriptions)):
+            payload = json.dumps({"descriptions": descriptions, "qos": qos_classes, "dirty": dirty}, separators=(',', ':')).encode('utf-8')
+
+            flags = 0
+            if self._compress:
+                payload = zlib.compress(payload, 1)  # fast, descriptions compress well anyway
+                flags |= self.FLAG_COMPRESSED
+
+            header = self._header.pack(self.MAGIC, self.VERSION, flags, revision, len(payload), zlib.crc32(payload))
+
+            directory = os.path.dirname(os.path.abspath(self._path))
+            os.makedirs(directory, exist_ok=True)
+
+            temp_path = f"{self._path}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(header)
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.replace(temp_path, self._path)
+
+            directory_fd = os.open(directory, os.O_RDONLY)  # make the rename durable
+            try:
+                os.fsync(directory_fd)
+            finally:
+                os.close(directory_fd)
+
+    def read(self) -> tuple:
+        """
+        Returns (revision, descriptions, qos_classes, dirty), or None if there is no valid snapshot
+        """
+        try:
+            with open(self._path, "rb") as f, Tracer.span("snapshot.read"):
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    return self._parse(mapped)
+
+        except FileNotFoundError:
+            return None
+
+        except (OSError, ValueError, zlib.error) as e:  # ValueError includes JSON errors and mapping an empty file
+            self._logger.warning(f"Ignoring unreadable snapshot {self._path}: {str(e)}")
+            return None
+
+    def _parse(self, mapped: mmap.mmap) -> tuple:
+        if len(mapped) < self._header.size:
+            raise ValueError("Truncated header")
+
+        magic, version, flags, revision, length, checksum = self._header.unpack_from(mapped, 0)
+
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError("Not a snapshot, or written by an other version")
+
+        if len(mapped) != self._header.size + length:
+            raise ValueError("Truncated payload")
+
+        payload = mapped[self._header.size:]
+        if zlib.crc32(payload) != checksum:
+            raise ValueError("Checksum mismatch")
+
+        if flags & self.FLAG_COMPRESSED:
+            payload = zlib.decompress(payload)
+
+        content = json.loads(payload)
+        return revision, content['descriptions'], content['qos'], content['dirty']
+
+    def remove(self):
+        try:
+            os.remove(self._path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+import os
+import time
+import select
+import signal
+import threading
+import subprocess
+
+from exception import VMCGroupError
+
+# Joins the cgroup (procs file in $1) and execs the rest of the arguments. The pid stays the same across exec,
+# so the process is accounted to the cgroup from it's first allocation on.
+JOIN_CGROUP_FAILED = 125
+JOIN_CGROUP_SCRIPT = f'echo $$ > "$1" || exit {JOIN_CGROUP_FAILED}; shift; exec "$@"'
+SHELL_BINARY = "/bin/sh"
+JOIN_CGROUP_TIMEOUT = 5  # sec, the shell has to join the cgroup in this time
+
+
+class SpawnedProcess(object):
+    """
+    A child process started by spawn(). Provides the parts of subprocess.Popen mmvmm uses.
+    With a pidfd, waiting for the exit needs no polling, and signals can not hit an other process reusing the pid.
+    """
+
+    def __init__(self, args: list, pid: int, pidfd: int = None):
+        self.args = args
+        self.pid = pid
+        self.pidfd = pidfd
+        self.returncode = None
+        self._lock = threading.Lock()
+
+    def fileno(self) -> int:
+        """
+        The pidfd, readable once the process exited. None if pidfds are not available.
+        """
+        return self.pidfd
+
+    def poll(self) -> int:
+        with self._lock:
+            if self.returncode is None:
+                try:
+                    pid, status = os.waitpid(self.pid, os.WNOHANG)
+                except ChildProcessError:  # Reaped by someone else, same as Popen does
+                    self.returncode = 0
+                else:
+                    if pid == self.pid:
+                        self.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+
+            return self.returncode
+
+    def wait(self, timeout: float = None) -> int:
+        """
+        Waits for the process to exit, and returns it's exit code. Raises subprocess.TimeoutExpired like Popen.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = 0.0005
+
+        while self.poll() is None:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                raise subprocess.TimeoutExpired(self.args, timeout)
+
+            if self.pidfd is not None:
+                select.select([self.pidfd], [], [], remaining)
+            else:
+                delay = min(delay * 2, 0.05)
+                time.sleep(delay if remaining is None else min(delay, remaining))
+
+        return self.returncode
+
+    def send_signal(self, sig: int):
+        if self.poll() is not None:  # Already reaped, the pid may belong to an other process by now
+            return
+
+        try:
+            if self.pidfd is not None:
+                signal.pidfd_send_signal(self.pidfd, sig)
+            else:
+                os.kill(self.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+    def __del__(self):
+        # Closed only here, so no thread can be waiting on it, or have it's number reused under it
+        if self.pidfd is not None:
+            os.close(self.pidfd)
+            self.pidfd = None
+
+
+def _inheritable_fds() -> list:
+    fds = []
+    for entry in os.listdir("/proc/self/fd"):
+        fd = int(entry)
+        if fd <= 2:
+            continue
+
+        try:
+            if os.get_inheritable(fd):
+                fds.append(fd)
+        except OSError:  # Closed in the meantime, like the one listdir used
+            pass
+
+    return fds
+
+
+def _in_cgroup(pid: int, cgroup_procs: str) -> bool:
+    try:
+        with open(cgroup_procs, "r") as f:
+            return str(pid) in f.read().split()
+    except OSError:
+        return False
+
+
+def _wait_joined(process: SpawnedProcess, cgroup_procs: str):
+    """
+    Waits until the wrapper joined the cgroup (or exited). Raises VMCGroupError if it could not join, in this case
+    args[0] was not run at all.
+    """
+    deadline = time.monotonic() + JOIN_CGROUP_TIMEOUT
+    delay = 0.0005
+
+    while not _in_cgroup(process.pid, cgroup_procs):
+        try:
+            returncode = process.wait(delay)
+        except subprocess.TimeoutExpired:
+            if time.monotonic() >= deadline:
+                process.kill()
+                process.wait()
+                raise VMCGroupError(f"Could not join {cgroup_procs} in time")
+
+            delay = min(delay * 2, 0.05)
+            continue
+
+        if returncode == JOIN_CGROUP_FAILED:
+            raise VMCGroupError(f"Could not join {cgroup_procs}")
+
+        return  # exited after the join (or exec failed), reported by the process itself
+
+
+def spawn(args: list, pidfd: bool = False, env: dict = None, cgroup_procs: str = None) -> SpawnedProcess:
+    """
+    Starts args[0] (absolute path) in a new process group, so signals sent to mmvmm's group (e.g. Ctrl+C) do not reach it.
+
+    Uses posix_spawn, which glibc implements with vfork semantics: the cost does not grow with the memory of the daemon,
+    and no Python code runs in the child between fork and exec, which is unsafe in a threaded process (preexec_fn is).
+    Only stdin, stdout and stderr are inherited, other inheritable fds are closed in the child.
+    The signals Python ignores are reset to default, and no signal is blocked, same as Popen does.
+
+    With cgroup_procs (the cgroup.procs file of a cgroup v2), the child joins the cgroup before it execs args[0],
+    through a small shell wrapper, as clone3(CLONE_INTO_CGROUP) is not available from Python. This returns once
+    the child joined, if it could not, VMCGroupError is raised and args[0] is not run.
+    """
+    command = args
+    if cgroup_procs:
+        command = [SHELL_BINARY, "-c", JOIN_CGROUP_SCRIPT, "mmvmm-spawn", cgroup_procs] + list(args)
+
+    # glibc ignores close actions of fds closed by an other thread meanwhile
+    file_actions = [(os.POSIX_SPAWN_CLOSE, fd) for fd in _inheritable_fds()]
+
+    pid = os.posix_spawn(
+        command[0], command, os.environ if env is None else env,
+        file_actions=file_actions,
+        setpgroup=0,
+        setsigmask=(),
+        setsigdef=(signal.SIGPIPE, signal.SIGXFSZ)
+    )
+
+    process = SpawnedProcess(args, pid)
+
+    if pidfd and hasattr(os, "pidfd_open"):
+        try:
+            process.pidfd = os.pidfd_open(pid)
+        except OSError:  # Linux older than 5.3. The child is not reaped yet, so the pid could not have been reused.
+            pass
+
+    if cgroup_procs:
+        _wait_joined(process, cgroup_procs)
+
+    return process
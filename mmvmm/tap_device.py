@@ -2,6 +2,8 @@
 import subprocess
 from threading import RLock
 
+from tracing import traced
+
 
 class TAPDevice(object):
     """
@@ -13,6 +15,7 @@ class TAPDevice(object):
 
     _global_network_lock = RLock()  # protects the _allocated_device_ids list, and the adding and removing of tap devices
 
+    @traced("tap.create")
     def __init__(self, master: str):
 
         self._active = True
@@ -39,6 +42,7 @@ class TAPDevice(object):
                 self.free()
                 raise
 
+    @traced("tap.update_master")
     def update_master(self, master: str):  # This raises exception if master is not available
         if not self._active:
             raise RuntimeError("Device is no longer available")
@@ -61,6 +65,7 @@ class TAPDevice(object):
 
         return self._masterdevname
 
+    @traced("tap.free")
     def free(self):
         """
         Free up the tap device. 
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import bisect
+import logging
+import functools
+from collections import deque
+from threading import local, Lock
+
+
+class LatencyHistogram(object):
+    """
+    Fixed bucket latency histogram (milliseconds)
+    """
+
+    BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000]
+
+    def __init__(self):
+        self._counts = [0] * (len(self.BUCKETS) + 1)  # The last one is the overflow bucket
+        self._count = 0
+        self._sum = 0.0
+        self._min = None
+        self._max = None
+
+    def record(self, value: float):
+        self._counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self._count += 1
+        self._sum += value
+
+        if self._min is None or value < self._min:
+            self._min = value
+
+        if self._max is None or value > self._max:
+            self._max = value
+
+    def percentile(self, percentile: float) -> float:
+        """
+        Returns the upper bound of the bucket containing the given percentile (the maximum for the overflow bucket)
+        """
+        if not self._count:
+            return None
+
+        threshold = self._count * percentile / 100
+        cumulative = 0
+        for i, count in enumerate(self._counts):
+            cumulative += count
+            if cumulative >= threshold:
+                return min(self.BUCKETS[i], self._max) if i < len(self.BUCKETS) else self._max
+
+        return self._max
+
+    def dump(self) -> dict:
+        return {
+            "count": self._count,
+            "sum": self._sum,
+            "min": self._min,
+            "max": self._max,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "buckets": {str(bound): count for bound, count in zip(self.BUCKETS + ["inf"], self._counts)}
+        }
+
+
+class Span(object):
+
+    def __init__(self, name: str, trace_id: str, parent_id: str, attributes: dict):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.error = None
+
+        self.start_time = time.time_ns()
+        self._started = time.perf_counter()
+        self.end_time = None
+        self.duration = None  # ms
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        Tracer._push(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.duration = (time.perf_counter() - self._started) * 1000
+        self.end_time = time.time_ns()
+
+        if exc_type:
+            self.error = f"{exc_type.__name__}: {str(exc_val)}"
+
+        Tracer._pop(self)
+        return False
+
+    @staticmethod
+    def _attribute_value(value) -> dict:
+        if isinstance(value, bool):
+            return {"boolValue": value}
+        elif isinstance(value, int):
+            return {"intValue": str(value)}
+        elif isinstance(value, float):
+            return {"doubleValue": value}
+        else:
+            return {"stringValue": str(value)}
+
+    def to_otel(self) -> dict:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,  # SPAN_KIND_INTERNAL
+            "startTimeUnixNano": str(self.start_time),
+            "endTimeUnixNano": str(self.end_time),
+            "attributes": [{"key": key, "value": self._attribute_value(value)} for key, value in self.attributes.items()],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1}
+        }
+
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+
+        return span
+
+
+class _NullSpan(object):
+    """
+    Returned when tracing is disabled. Does nothing, so the instrumented code pays only for a flag check.
+    """
+
+    def set_attribute(self, key: str, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+class Tracer(object):
+    """
+    Collects spans and per span name latency histograms.
+    Finished spans can be exported as OpenTelemetry (OTLP JSON) compatible lines to a local file.
+    """
+
+    enabled = os.environ.get("MMVMM_TRACING", "0") == "1"
+    export_path = os.environ.get("MMVMM_TRACE_FILE") or None  # configuration only, the control socket can not change it
+
+    RECENT_SPANS = 1000
+
+    _null_span = _NullSpan()
+    _local = local()
+    _lock = Lock()  # protects the histograms, the recent spans and the export file
+
+    _histograms = {}
+    _recent_spans = deque(maxlen=RECENT_SPANS)
+    _export_file = None
+
+    _logger = logging.getLogger("tracing")
+
+    @classmethod
+    def configure(cls, enabled: bool, export: bool = False):
+        """
+        Enables or disables tracing, and exporting the spans to the configured export_path
+        """
+        if export and not cls.export_path:
+            raise ValueError("No trace export file is configured (MMVMM_TRACE_FILE)")
+
+        with cls._lock:
+            if cls._export_file:
+                cls._export_file.close()
+                cls._export_file = None
+
+            if export:
+                cls._export_file = open(cls.export_path, "a")
+
+            cls.enabled = enabled
+
+        cls._logger.info(f"Tracing {'enabled' if enabled else 'disabled'}" + (f", exporting to {cls.export_path}" if export else ""))
+
+    @classmethod
+    def span(cls, name: str, **attributes):
+        if not cls.enabled:
+            return cls._null_span
+
+        stack = getattr(cls._local, 'stack', None)
+        if stack:
+            parent = stack[-1]
+            return Span(name, parent.trace_id, parent.span_id, attributes)
+        else:
+            return Span(name, os.urandom(16).hex(), None, attributes)
+
+    @classmethod
+    def _push(cls, span: Span):
+        if not hasattr(cls._local, 'stack'):
+            cls._local.stack = []
+
+        cls._local.stack.append(span)
+
+    @classmethod
+    def _pop(cls, span: Span):
+        stack = cls._local.stack
+        if stack and stack[-1] is span:
+            stack.pop()
+
+        with cls._lock:
+            if span.name not in cls._histograms:
+                cls._histograms[span.name] = LatencyHistogram()
+
+            cls._histograms[span.name].record(span.duration)
+            cls._recent_spans.append(span)
+
+            if cls._export_file:
+                try:
+                    cls._export_file.write(json.dumps(cls._export_batch([span])) + "\n")
+                    cls._export_file.flush()
+                except OSError as e:
+                    cls._logger.error(f"Could not export span: {str(e)}")
+
+    @staticmethod
+    def _export_batch(spans: list) -> dict:
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "mmvmm"}}]},
+                "scopeSpans": [{
+                    "scope": {"name": "mmvmm"},
+                    "spans": [span.to_otel() for span in spans]
+                }]
+            }]
+        }
+
+    @classmethod
+    def stats(cls, prefix: str = None) -> dict:
+        with cls._lock:
+            return {
+                name: histogram.dump()
+                for name, histogram in sorted(cls._histograms.items())
+                if not prefix or name.startswith(prefix)
+            }
+
+    @classmethod
+    def recent_spans(cls, limit: int = 100) -> list:
+        with cls._lock:
+            spans = list(cls._recent_spans)[-limit:] if limit > 0 else []
+
+        return cls._export_batch(spans)
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls._histograms = {}
+            cls._recent_spans.clear()
+
+
+def traced(name: str):
+    """
+    Decorator, wraps every call of the function in a span
+    """
+    def decorator(func):
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not Tracer.enabled:
+                return func(*args, **kwargs)
+
+            with Tracer.span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -2,6 +2,8 @@
 # TODO: This module could use a LOT of work
 from bettersocket import BetterSocketIO
 import json
+import random
+from collections.abc import MutableMapping
 
 
 class JSONSocketWrapper(object):
@@ -19,3 +21,43 @@ class JSONSocketWrapper(object):
             return json.loads(data.decode('utf-8'))
 
         return None
+
+
+class SwappableDict(MutableMapping):
+    """
+    A dict shared by reference, whose whole content can be replaced in a single step
+    """
+
+    def __init__(self):
+        self._data = {}
+
+    def replace(self, data: dict):
+        self._data = data
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+
+    def __delitem__(self, key):
+        del self._data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+
+def generate_mac_address(reserved: set) -> str:
+    """
+    Generates a random locally administered MAC address in QEMU's range (52:54:00:xx:xx:xx) that is not in reserved
+    """
+    while True:
+        mac = "52:54:00:" + ":".join(f"{random.randint(0, 255):02x}" for _ in range(3))
+        if mac not in reserved:
+            return mac
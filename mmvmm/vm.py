@@ -2,64 +2,152 @@
 import subprocess
 import logging
 import copy
-import os
-import time
+import threading
 
-from schema import VMDescriptionSchema, VMNameSchema
+from schema import VMDescriptionSchema, VMNameSchema, ThrottleDescriptionSchema, ResourcesDescriptionSchema
+from fastschema import CompiledSchema
 from expose import ExposedClass, exposed, transformational
-from exception import VMRunningError, VMNotRunningError
+from exception import VMRunningError, VMNotRunningError, VMQMPError, VMGuestAgentError, VMCGroupError, VMTemplateError
 from threading import RLock
 
 from tap_device import TAPDevice
 from qmp import QMPMonitor
+from guest_agent import GuestAgent
+from cgroup import CGroup
 from vnc import VNCAllocator
+from tracing import Tracer
+from deadline import Deadline
+from spawn import spawn
 
 QEMU_BINARY = "/usr/bin/qemu-system-x86_64"
 
 
 class VM(ExposedClass):
 
-    description_schema = VMDescriptionSchema(many=False)
-    name_schema = VMNameSchema(many=False)  # From the few bad solutions this is the least worse
+    description_schema = CompiledSchema(VMDescriptionSchema(many=False))
+    name_schema = CompiledSchema(VMNameSchema(many=False))  # From the few bad solutions this is the least worse
+    throttle_schema = CompiledSchema(ThrottleDescriptionSchema(many=False))
+    resources_schema = CompiledSchema(ResourcesDescriptionSchema(many=False))
 
-    def __init__(self, name: str, description: dict):
+    # Throttle limit -> the name of the QEMU option (-drive throttling.<name>)
+    THROTTLE_OPTIONS = {
+        'bps': 'bps-total', 'bps_rd': 'bps-read', 'bps_wr': 'bps-write',
+        'iops': 'iops-total', 'iops_rd': 'iops-read', 'iops_wr': 'iops-write'
+    }
+
+    MEMORY_SLOTS = 16  # DIMM slots for memory hotplug
+    UNPLUG_TIMEOUT = 10  # sec, the guest has to release unplugged devices
+
+    def __init__(self, name: str, description: dict, validated: bool = False, qos_classes: dict = None):
         self._logger = logging.getLogger("vm")
 
-        self._description = self.description_schema.load(description)
-        self._name = self.name_schema.load({'name': name})['name']
+        if validated:  # Already loaded by VM.validate()
+            self._description = description
+            self._name = name
+        else:
+            self._name, self._description = self.validate(name, description)
+
         self._logger = logging.getLogger("vm").getChild(name)
 
         self._qmp = None
-        self._tapdevs = []
+        self._agent = None
+        self._cgroup = None
+        self._tapdevs = {}  # mac -> TAPDevice
+
+        self._running_hardware = None  # The hardware QEMU was started with, plus the changes applied live since then
+        self._boot_vnc = None
+        self._hotplugged = {"cpu": 0, "dimm": 0, "disk": set()}
+        self._pending_restart = []  # Changes of the description that are applied on the next start only
 
         self._process = None
         self._vnc_port = None
 
+        self._listeners = []
+
+        self._qos_classes = qos_classes if qos_classes is not None else {}  # Shared with the manager, name -> throttle limits
+
         self._lock = RLock()
 
-    @staticmethod
-    def _preexec():  # do not forward signals (Like. SIGINT, SIGTERM)
-        os.setpgrp()
+    def _locked(self):
+        """
+        Acquires the lock of the VM, waiting at most until the deadline of the command being executed
+        """
+        return Deadline.acquire(self._lock, f"the lock of VM {self._name}")
+
+    @classmethod
+    def validate(cls, name: str, description: dict) -> tuple:
+        """
+        Validates and loads a name and a description. The result can be passed to the constructor with validated=True
+        """
+        description = cls.description_schema.load(description)
+        cls._check_description(description)
+        return cls.name_schema.load({'name': name})['name'], description
+
+    @classmethod
+    def _check_description(cls, description: dict):
+        hardware_description = description['hardware']
+
+        if hardware_description['max_cpu'] and hardware_description['max_cpu'] < hardware_description['cpu']:
+            raise ValueError("max_cpu can not be lower than cpu")
+
+        if hardware_description['max_ram'] and hardware_description['max_ram'] < hardware_description['ram']:
+            raise ValueError("max_ram can not be lower than ram")
+
+        for media in hardware_description['media']:
+            if media['throttle']:
+                cls.check_throttle(media['throttle'])
+
+    def add_listener(self, listener: callable):
+        """
+        Register callable objects to be called with (vm, event, data) when the VM is started ('started'), stopped ('stopped'),
+        it's description changes ('description') or a QMP event is received ('qmp', data: {"event": ..., "data": ...}).
+
+        Listeners may be called from the QMP reciever thread, so they should not be long-running
+        """
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener: callable):
+        try:
+            self._listeners.remove(listener)
+        except ValueError:
+            pass
+
+    def _notify(self, event: str, data: dict = None):
+        for listener in list(self._listeners):
+            try:
+                listener(self, event, data)
+            except Exception as e:
+                self._logger.error(f"Listener failed on {event} event: {str(e)}")
 
     def _poweroff_cleanup(self, timeout: int = 5):
 
         if self.is_running():
             self._logger.info(f"Qemu process still running. Delaying cleanup. (max. {timeout}sec)")
-            wait_started = time.time()
-            while self.is_running():
-                time.sleep(1)
-                if (time.time() - wait_started) > 5:
-                    self._logger.warning("Cleanup delay expired. Killing Qemu!")
-                    self._process.kill()
+            try:
+                self._process.wait(timeout)  # returns as soon as QEMU exits, no polling with a pidfd
+            except subprocess.TimeoutExpired:
+                self._logger.warning("Cleanup delay expired. Killing Qemu!")
+                self._process.kill()
+                self._process.wait()
 
         self._logger.debug("Cleaning up...")
-        for tapdev in self._tapdevs:
+        for tapdev in self._tapdevs.values():
             tapdev.free()
 
-        self._tapdevs = []
+        self._tapdevs = {}
         self._qmp.disconnect()  # Fun fact: This will be called from the qmp process
         self._qmp = None
 
+        if self._agent:
+            self._agent.disconnect()
+            self._agent = None
+
+        if self._cgroup:
+            self._cgroup.destroy()
+            self._cgroup = None
+
+        self._notify('stopped')
+
     def _enforce_vm_state(self, running: bool):
 
         if running != self.is_running():
@@ -68,8 +156,449 @@ class VM(ExposedClass):
             else:
                 raise VMNotRunningError()
 
+    def _qmp_execute(self, command: str, arguments: dict = None) -> object:
+        """
+        Sends a command to the QMP and returns it's return value. Raises VMQMPError if QEMU reports an error.
+        """
+        cmd = {"execute": command}
+        if arguments:
+            cmd['arguments'] = arguments
+
+        response = self._qmp.send_command(cmd)
+
+        if response is None:
+            raise VMQMPError("No response")
+
+        if "error" in response:
+            raise VMQMPError(response['error'].get('desc', response['error']['class']))
+
+        return response['return']
+
+    @staticmethod
+    def _on_off(value: bool) -> str:
+        return 'on' if value else 'off'
+
+    def _memory_args(self, hardware_desciption: dict) -> list:
+        memory_description = hardware_desciption['memory']
+        ram = hardware_desciption['ram']
+
+        if hardware_desciption['max_ram']:  # Leave room for hotplugged DIMMs
+            args = ['-m', f"{ram},slots={self.MEMORY_SLOTS},maxmem={hardware_desciption['max_ram']}M"]
+        else:
+            args = ['-m', str(ram)]
+
+        if memory_description['backend'] == 'default':
+            args += ['-machine', f"mem-merge={self._on_off(memory_description['merge'])}"]
+
+            if memory_description['prealloc']:
+                args += ['-mem-prealloc']
+
+        else:
+            if memory_description['backend'] == 'hugepages':
+                backend = f"memory-backend-file,mem-path={memory_description['hugepages_path'].replace(',', ',,')}"
+            else:  # memfd
+                backend = "memory-backend-memfd"
+
+            args += ['-object', f"{backend},id=mem0,size={ram}M,share={self._on_off(memory_description['share'])},merge={self._on_off(memory_description['merge'])},prealloc={self._on_off(memory_description['prealloc'])}"]
+            args += ['-machine', 'memory-backend=mem0']
+
+        if memory_description['balloon']:
+            args += ['-device', f"virtio-balloon-pci,id=balloon0,free-page-reporting={self._on_off(memory_description['free_page_reporting'])}"]
+
+        return args
+
+    @staticmethod
+    def check_throttle(limits: dict):
+        """
+        Checks the constraints of loaded throttle limits that QEMU would only report when applying them
+        """
+        for limit in VM.THROTTLE_OPTIONS.keys():
+            if limits[f"{limit}_max"] and limits[f"{limit}_max"] < limits[limit]:
+                raise ValueError(f"{limit}_max can not be lower than {limit}")
+
+            if limits[f"{limit}_max"] and not limits[limit]:
+                raise ValueError(f"{limit}_max requires {limit} to be set")
+
+        for total in ('bps', 'iops'):  # QEMU refuses a total limit together with it's read/write split
+            if limits[total] and (limits[f"{total}_rd"] or limits[f"{total}_wr"]):
+                raise ValueError(f"{total} can not be combined with {total}_rd or {total}_wr")
+
+    def _throttle_of(self, media: dict) -> tuple:
+        """
+        Returns the throttle limits and the throttle group name of a drive. Both are None for unthrottled drives.
+        """
+        if media['qos']:
+            try:
+                return self._qos_classes[media['qos']], f"qos-{media['qos']}"
+            except KeyError:
+                raise KeyError(f"Unknown QoS class: {media['qos']}")
+
+        if media['throttle']:
+            return media['throttle'], None
+
+        return None, None
+
+    @classmethod
+    def _throttle_options(cls, limits: dict, prefix: str) -> str:
+        options = []
+        for limit, option in cls.THROTTLE_OPTIONS.items():
+            if limits[limit]:
+                options.append(f"{prefix}{option}={limits[limit]}")
+
+            if limits[f"{limit}_max"]:
+                options.append(f"{prefix}{option}-max={limits[f'{limit}_max']}")
+                options.append(f"{prefix}{option}-max-length={limits['burst_length']}")
+
+        return ','.join(options)
+
+    def _media_args(self, hardware_desciption: dict) -> list:
+        args = []
+
+        for i, media in enumerate(hardware_desciption['media']):
+            drive = f"id=drive{i},media={media['type']},format={media['format']},file={media['path'].replace(',',',,')},read-only={self._on_off(media['readonly'])}"
+
+            limits, group = self._throttle_of(media)
+            options = self._throttle_options(limits, "throttling.") if limits else ""
+            if options:
+                drive += "," + options
+
+                # A drive only joins a group if it has limits of it's own, so each member carries the limits of the class
+                if group:
+                    drive += f",throttling.group={group}"
+
+            args += ['-drive', drive]
+
+        return args
+
+    def _apply_throttle(self, index: int, media: dict = None):
+        media = media or self._description['hardware']['media'][index]
+        limits, group = self._throttle_of(media)
+        limits = limits or self.throttle_schema.load({})  # all zero, turns off throttling
+
+        if index in self._hotplugged['disk']:  # Hotplugged disks have no legacy drive name, only the device id
+            arguments = {"id": f"disk{index}"}
+        else:
+            arguments = {"device": f"drive{index}"}
+
+        for limit in self.THROTTLE_OPTIONS.keys():
+            arguments[limit] = limits[limit]
+
+            if limits[f"{limit}_max"]:
+                arguments[f"{limit}_max"] = limits[f"{limit}_max"]
+                arguments[f"{limit}_max_length"] = limits['burst_length']
+
+        # Drives with their own limits get a group of their own (named after the drive, as QEMU does),
+        # otherwise a drive leaving a QoS class would stay in it's group, and change the limits of the other members.
+        arguments['group'] = group or arguments.get('id') or arguments['device']
+
+        self._qmp_execute("block_set_io_throttle", arguments)
+
+    @staticmethod
+    def _nic_ids(mac: str) -> tuple:
+        """
+        Returns the netdev and device ids of a NIC. These are derived from the MAC, so they stay the same when other NICs are unplugged.
+        """
+        suffix = mac.lower().replace(':', '')
+        return f"net{suffix}", f"nic{suffix}"
+
+    def _device_del(self, device_id: str) -> bool:
+        """
+        Unplugs a device and waits for the guest to release it. Returns False if the guest did not release it in time.
+        """
+        deleted = threading.Event()
+
+        def on_deleted(event: str, data: dict):
+            if data.get('device') == device_id:
+                deleted.set()
+
+        self._qmp.register_event_listener('DEVICE_DELETED', on_deleted)
+        try:
+            self._qmp_execute("device_del", {"id": device_id})
+            return deleted.wait(Deadline.timeout(self.UNPLUG_TIMEOUT)[0])
+        finally:
+            self._qmp.unregister_event_listener('DEVICE_DELETED', on_deleted)
+
+    def _hotplug_nic(self, nic: dict) -> callable:
+        mac = nic['mac'].lower()
+        netdevid, deviceid = self._nic_ids(mac)
+
+        tapdev = TAPDevice(nic['master'])
+        try:
+            self._qmp_execute("netdev_add", {"type": "tap", "id": netdevid, "ifname": tapdev.device, "script": "no", "downscript": "no"})
+            try:
+                self._qmp_execute("device_add", {"driver": nic['model'], "id": deviceid, "netdev": netdevid, "mac": nic['mac']})
+            except Exception:
+                with Deadline.suspended():  # cleaned up even if the deadline just passed
+                    self._qmp_execute("netdev_del", {"id": netdevid})
+                raise
+        except Exception:
+            tapdev.free()
+            raise
+
+        self._tapdevs[mac] = tapdev
+        return lambda: self._unplug_nic(mac)
+
+    def _unplug_nic(self, mac: str) -> bool:
+        netdevid, deviceid = self._nic_ids(mac)
+
+        if not self._device_del(deviceid):
+            return False
+
+        self._qmp_execute("netdev_del", {"id": netdevid})
+        self._tapdevs.pop(mac).free()
+        return True
+
+    def _hotplug_disk(self, index: int, media: dict) -> callable:
+        node = f"hotdrive{index}"
+
+        self._qmp_execute("blockdev-add", {
+            "driver": media['format'],
+            "node-name": node,
+            "read-only": media['readonly'],
+            "file": {"driver": "file", "filename": media['path']}
+        })
+
+        try:
+            self._qmp_execute("device_add", {"driver": "virtio-blk-pci", "id": f"disk{index}", "drive": node})
+        except Exception:
+            with Deadline.suspended():  # cleaned up even if the deadline just passed
+                self._qmp_execute("blockdev-del", {"node-name": node})
+            raise
+
+        self._hotplugged['disk'].add(index)
+
+        def undo():
+            if self._device_del(f"disk{index}"):
+                self._qmp_execute("blockdev-del", {"node-name": node})
+                self._hotplugged['disk'].discard(index)
+
+        try:
+            if media['throttle'] or media['qos']:
+                self._apply_throttle(index, media)
+        except Exception:
+            with Deadline.suspended():
+                undo()
+            raise
+
+        return undo
+
+    def _hotplug_cpus(self, count: int) -> callable:
+        free_slots = [slot for slot in self._qmp_execute("query-hotpluggable-cpus") if not slot.get('qom-path')]
+        if len(free_slots) < count:
+            raise VMQMPError(f"Only {len(free_slots)} free vCPU slots")
+
+        added = []
+
+        def undo():
+            for device_id in reversed(added):
+                self._device_del(device_id)
+
+        try:
+            for slot in free_slots[:count]:
+                device_id = f"cpu{self._hotplugged['cpu']}"
+                self._qmp_execute("device_add", dict(slot['props'], driver=slot['type'], id=device_id))
+                self._hotplugged['cpu'] += 1
+                added.append(device_id)
+        except Exception:
+            with Deadline.suspended():
+                undo()
+            raise
+
+        return undo
+
+    def _hotplug_memory(self, size: int) -> callable:
+        memory_description = self._running_hardware['memory']
+        dimm = self._hotplugged['dimm']
+        backend_id = f"memdimm{dimm}"
+
+        backend = {"qom-type": "memory-backend-ram", "id": backend_id, "size": size * 1024 * 1024}
+        if memory_description['backend'] == 'hugepages':
+            backend.update({"qom-type": "memory-backend-file", "mem-path": memory_description['hugepages_path']})
+        elif memory_description['backend'] == 'memfd':
+            backend['qom-type'] = "memory-backend-memfd"
+
+        if memory_description['backend'] != 'default':
+            backend.update({"share": memory_description['share'], "merge": memory_description['merge'], "prealloc": memory_description['prealloc']})
+
+        self._qmp_execute("object-add", backend)
+        try:
+            self._qmp_execute("device_add", {"driver": "pc-dimm", "id": f"dimm{dimm}", "memdev": backend_id})
+        except Exception:
+            with Deadline.suspended():
+                self._qmp_execute("object-del", {"id": backend_id})
+            raise
+
+        self._hotplugged['dimm'] += 1
+
+        def undo():
+            if self._device_del(f"dimm{dimm}"):
+                self._qmp_execute("object-del", {"id": backend_id})
+
+        return undo
+
+    def _attached_media(self, index: int, media: dict) -> dict:
+        """
+        Returns the running model of the drive at index, if it is the drive of the description, not one replaced or
+        removed by a change pending restart. Otherwise returns None.
+        """
+        attached = self._running_hardware['media']
+        if index < len(attached) and attached[index] and all(attached[index][key] == media[key] for key in ('type', 'path', 'format', 'readonly')):
+            return attached[index]
+
+        return None
+
+    def _apply_live(self, description: dict) -> dict:
+        """
+        Applies the differences between the hardware QEMU runs with and a new description using QMP hotplug.
+        Changes that can not be applied to the running VM are collected as pending-restart. As the running hardware is
+        tracked apart from the description, this is the complete list, earlier pending changes may have been reverted.
+        If anything fails, the changes applied so far are reverted (as far as possible) and the error is raised.
+        """
+        running = copy.deepcopy(self._running_hardware)  # stored only if everything succeeds
+        new = description['hardware']
+
+        applied = []
+        pending = []
+        undo = []  # callables reverting the applied changes
+        unplug = []  # (description, mac, callable) unplugs are done last, they can not be reverted
+
+        try:
+            # NICs are identified by their MAC
+            running_nics = {nic['mac'].lower(): nic for nic in running['network']}
+            new_nics = {nic['mac'].lower(): nic for nic in new['network']}
+
+            for mac, nic in new_nics.items():
+                if mac not in running_nics:
+                    undo.append(self._hotplug_nic(nic))
+                    running['network'].append(copy.deepcopy(nic))
+                    applied.append(f"network {mac}: added")
+
+                elif nic['model'] != running_nics[mac]['model']:
+                    pending.append(f"network {mac}: model changed")
+
+                elif nic['master'] != running_nics[mac]['master']:
+                    old_master = running_nics[mac]['master']
+                    self._tapdevs[mac].update_master(nic['master'])
+                    undo.append(lambda tapdev=self._tapdevs[mac], master=old_master: tapdev.update_master(master))
+                    running_nics[mac]['master'] = nic['master']
+                    applied.append(f"network {mac}: master changed")
+
+            for mac in running_nics.keys():
+                if mac not in new_nics:
+                    unplug.append((f"network {mac}: removed", mac, lambda mac=mac: self._unplug_nic(mac)))
+
+            # Media are identified by their position. Removed drives stay attached until the next start, so they are
+            # kept in the running model, and a drive added at their position is pending-restart as well.
+            for index in range(max(len(running['media']), len(new['media']))):
+                old_media = running['media'][index] if index < len(running['media']) else None
+                new_media = new['media'][index] if index < len(new['media']) else None
+
+                if not new_media:
+                    if old_media:
+                        pending.append(f"media {index}: removed")
+                    continue
+
+                if not old_media:
+                    if new_media['type'] == 'disk':
+                        undo.append(self._hotplug_disk(index, new_media))
+                        running['media'] += [None] * (index + 1 - len(running['media']))  # pending cdroms before it
+                        running['media'][index] = copy.deepcopy(new_media)
+                        applied.append(f"media {index}: disk added")
+                    else:
+                        pending.append(f"media {index}: cdrom added")
+                    continue
+
+                if old_media['type'] == new_media['type'] == 'cdrom' and (old_media['path'], old_media['format']) != (new_media['path'], new_media['format']):
+                    self._qmp_execute("blockdev-change-medium", {"device": f"drive{index}", "filename": new_media['path'], "format": new_media['format']})
+                    undo.append(lambda index=index, media=copy.deepcopy(old_media): self._qmp_execute("blockdev-change-medium", {"device": f"drive{index}", "filename": media['path'], "format": media['format']}))
+                    old_media['path'], old_media['format'] = new_media['path'], new_media['format']
+                    applied.append(f"media {index}: medium changed")
+
+                elif any(old_media[key] != new_media[key] for key in ('type', 'path', 'format', 'readonly')):
+                    pending.append(f"media {index}: drive changed")
+                    continue
+
+                if (old_media['throttle'], old_media['qos']) != (new_media['throttle'], new_media['qos']):
+                    self._apply_throttle(index, new_media)
+                    undo.append(lambda index=index, media=copy.deepcopy(old_media): self._apply_throttle(index, media))
+                    old_media['throttle'], old_media['qos'] = copy.deepcopy(new_media['throttle']), new_media['qos']
+                    applied.append(f"media {index}: throttle changed")
+
+            # vCPUs and memory can only be added, up to the maximum QEMU was started with
+            if new['cpu'] > running['cpu'] and running['max_cpu'] and new['cpu'] <= running['max_cpu']:
+                undo.append(self._hotplug_cpus(new['cpu'] - running['cpu']))
+                applied.append(f"cpu: {running['cpu']} -> {new['cpu']}")
+                running['cpu'] = new['cpu']
+            elif new['cpu'] != running['cpu']:
+                pending.append(f"cpu: {running['cpu']} -> {new['cpu']}")
+
+            if new['ram'] > running['ram'] and running['max_ram'] and new['ram'] <= running['max_ram'] and self._hotplugged['dimm'] < self.MEMORY_SLOTS:
+                undo.append(self._hotplug_memory(new['ram'] - running['ram']))
+                applied.append(f"ram: {running['ram']} -> {new['ram']}")
+                running['ram'] = new['ram']
+            elif new['ram'] != running['ram']:
+                pending.append(f"ram: {running['ram']} -> {new['ram']}")
+
+            if new['resources'] != running['resources'] and self._cgroup:
+                self._cgroup.apply(new['resources'])
+                undo.append(lambda resources=running['resources']: self._cgroup.apply(resources))
+                running['resources'] = copy.deepcopy(new['resources'])
+                applied.append("resources changed")
+
+            for key in ('memory', 'boot', 'rtc_utc', 'guest_agent', 'max_cpu', 'max_ram'):
+                if new[key] != running[key]:
+                    pending.append(f"{key} changed")
+
+            if description['vnc'] != self._boot_vnc:
+                pending.append("vnc changed")
+
+        except Exception:
+            with Deadline.suspended():  # a late command is reverted all the same
+                for revert in reversed(undo):
+                    try:
+                        revert()
+                    except Exception as e:
+                        self._logger.error(f"Could not revert a live change: {str(e)}")
+            raise
+
+        for change, mac, func in unplug:
+            try:
+                released = func()
+            except Exception as e:
+                self._logger.warning(f"Could not unplug a device ({change}): {str(e)}")
+                released = False
+
+            if released:
+                running['network'] = [nic for nic in running['network'] if nic['mac'].lower() != mac]
+                applied.append(change)
+            else:  # The device is dropped on the next start anyway
+                pending.append(change)
+
+        self._running_hardware = running
+        return {"applied": applied, "pending_restart": pending}
+
+    def _prepare_cgroup(self) -> CGroup:
+        """
+        Creates the cgroup of the VM with it's limits, QEMU joins it before it allocates anything (see spawn).
+        Returns None if cgroups are disabled or it could not be created.
+        """
+        if not CGroup.enabled():
+            return None
+
+        with Tracer.span("vm.start.cgroup"):
+            cgroup = CGroup(self._name)
+            try:
+                cgroup.create()
+                cgroup.apply(self._description['hardware']['resources'])
+            except OSError as e:  # The VM is still usable without resource isolation
+                self._logger.warning(f"Could not create cgroup {cgroup.get_path()} for the VM: {str(e)}")
+                cgroup.destroy()
+                return None
+
+            return cgroup
+
     def destroy(self):
-        with self._lock:
+        with self._locked():
             if self.is_running():
                 raise VMRunningError("Can not destory running VM")
 
@@ -77,8 +606,8 @@ class VM(ExposedClass):
         """
         Starts the VM, if it's marked as autostart. Otherwise does nothing.
         """
-        with self._lock:
-            if self._description['autostart']:
+        with self._locked():
+            if self._description['autostart'] and not self._description['template']:
                 try:
                     self.start()
                 except VMRunningError:
@@ -87,9 +616,12 @@ class VM(ExposedClass):
     @exposed
     @transformational
     def start(self):
-        with self._lock:
+        with self._locked(), Tracer.span("vm.start", vm=self._name):
             self._enforce_vm_state(False)
 
+            if self._description['template']:  # QEMU would write the disks the overlays of the clones are backed by
+                raise VMTemplateError("Templates can not be started")
+
             self._logger.info("Starting VM...")
 
             # The VM is not running. It's safe to kill off the QMP Monitor
@@ -110,12 +642,13 @@ class VM(ExposedClass):
             args += ['-name', self._name]
 
             # setup VNC
-            if self._description['vnc']['enabled']:
-                self._vnc_port = VNCAllocator.get_free_vnc_port()
-                self._logger.debug(f"bindig VNC to :{self._vnc_port}")
-            else:
-                self._vnc_port = None
-                self._logger.warning("Couldn't allocate a free port for VNC")
+            with Tracer.span("vm.start.vnc"):
+                if self._description['vnc']['enabled']:
+                    self._vnc_port = VNCAllocator.get_free_vnc_port()
+                    self._logger.debug(f"bindig VNC to :{self._vnc_port}")
+                else:
+                    self._vnc_port = None
+                    self._logger.warning("Couldn't allocate a free port for VNC")
 
             if self._vnc_port:
                 args += ['-vnc', f":{self._vnc_port}"]
@@ -124,15 +657,25 @@ class VM(ExposedClass):
 
              # Create QMP monitor
             self._qmp = QMPMonitor(self._logger)
-            self._qmp.register_event_listener('SHUTDOWN', lambda data: self._poweroff_cleanup())  # meh
+            self._qmp.register_event_listener('SHUTDOWN', lambda event, data: self._poweroff_cleanup())  # meh
+            self._qmp.register_event_listener('*', lambda event, data: self._notify('qmp', {"event": event, "data": data}))
 
             args += ['-qmp', f"unix:{self._qmp.get_sock_path()},server,nowait"]
 
+            # Create guest agent channel
+            if self._description['hardware']['guest_agent']:
+                self._agent = GuestAgent(self._logger, on_ready=lambda boot_to_ready: self._notify('ready', {"boot_to_ready": boot_to_ready}))
+                args += self._agent.get_qemu_args()
+
             # === Virtual Hardware Setup ===
             hardware_desciption = self._description['hardware']
 
-            args += ['-m', str(hardware_desciption['ram'])]
-            args += ['-smp', str(hardware_desciption['cpu'])]
+            args += self._memory_args(hardware_desciption)
+            if hardware_desciption['max_cpu']:  # Leave room for hotplugged vCPUs
+                args += ['-smp', f"{hardware_desciption['cpu']},maxcpus={hardware_desciption['max_cpu']}"]
+            else:
+                args += ['-smp', str(hardware_desciption['cpu'])]
+
             args += ['-boot', str(hardware_desciption['boot'])]
 
             # stup RTC
@@ -143,32 +686,65 @@ class VM(ExposedClass):
                 args += ['base=localtime']
 
             # add media
-            for media in hardware_desciption['media']:
-                args += ['-drive', f"media={media['type']},format={media['format']},file={media['path'].replace(',',',,')},read-only={'on' if media['readonly'] else 'off'}"]
+            args += self._media_args(hardware_desciption)
 
             # add nic
-            for network in hardware_desciption['network']:
-                tapdev = TAPDevice(network['master'])
-                self._tapdevs.append(tapdev)
+            with Tracer.span("vm.start.network"):
+                for network in hardware_desciption['network']:
+                    tapdev = TAPDevice(network['master'])
+                    self._tapdevs[network['mac'].lower()] = tapdev
+
+                    netdevid, deviceid = self._nic_ids(network['mac'])
 
-                netdevid = f"{self._name}net{len(self._tapdevs)-1}"
+                    args += ['-netdev', f"tap,id={netdevid},ifname={tapdev.device},script=no,downscript=no"]
+                    args += ['-device', f"{network['model']},netdev={netdevid},mac={network['mac']},id={deviceid}"]
 
-                args += ['-netdev', f"tap,id={netdevid},ifname={tapdev.device},script=no,downscript=no"]
-                args += ['-device', f"{network['model']},netdev={netdevid},mac={network['mac']}"]
+            self._running_hardware = copy.deepcopy(hardware_desciption)
+            self._boot_vnc = copy.deepcopy(self._description['vnc'])
+            self._hotplugged = {"cpu": 0, "dimm": 0, "disk": set()}
+            self._pending_restart = []
 
             # === Everything prepared... launch the QEMU process ===
 
             self._logger.debug(f"Executing command {' '.join(args)}")
-            self._process = subprocess.Popen(args, preexec_fn=VM._preexec)  # start the qemu process itself
+            cgroup = self._prepare_cgroup()
+            with Tracer.span("vm.start.spawn"):
+                try:  # start the qemu process itself, in it's own process group and cgroup
+                    self._process = spawn(args, pidfd=True, cgroup_procs=cgroup.get_procs_path() if cgroup else None)
+                except VMCGroupError as e:  # The VM is still usable without resource isolation
+                    self._logger.warning(f"Could not place the VM into cgroup {cgroup.get_path()}: {str(e)}")
+                    cgroup.destroy()
+                    cgroup = None
+                    self._process = spawn(args, pidfd=True)
+                except Exception:
+                    if cgroup:
+                        cgroup.destroy()
+                    raise
+
+            self._cgroup = cgroup
+
             self._qmp.start()  # Start the QMP monitor
 
+            if self._agent:
+                self._agent.start()  # Start polling the guest agent for readiness
+
+            self._notify('started')
+
     @exposed
     def poweroff(self):
-        with self._lock:
+        with self._locked():
             self._enforce_vm_state(True)
 
             self._logger.info("Powering off VM...")
 
+            # The guest agent shuts down the guest reliably and fast, but the cleanup relies on the SHUTDOWN event from QMP
+            if self._agent and self._agent.is_ready() and self._qmp.is_online():
+                try:
+                    self._agent.shutdown()
+                    return
+                except VMGuestAgentError as e:
+                    self._logger.warning(f"Could not shut down the VM using the guest agent: {str(e)}. Using ACPI instead...")
+
             try:
                 self._qmp.send_command({"execute": "system_powerdown"})
             except ConnectionError:  # There was a QMP connection error... Sending SIGTERM to process instead
@@ -177,7 +753,7 @@ class VM(ExposedClass):
 
     @exposed
     def terminate(self, kill=False):
-        with self._lock:
+        with self._locked():
             self._enforce_vm_state(True)
 
             self._logger.warning("VM is being terminated...")
@@ -191,39 +767,260 @@ class VM(ExposedClass):
 
     @exposed
     def reset(self):
-        with self._lock:
+        with self._locked():
             self._enforce_vm_state(True)
             self._logger.info("Resetting VM...")
             self._qmp.send_command({"execute": "system_reset"})
 
     @exposed
     def pause(self):
-        with self._lock:
+        with self._locked():
             self._enforce_vm_state(True)
             self._logger.info("Pausing VM...")
             self._qmp.send_command({"execute": "stop"})
 
     @exposed
     def cont(self):  # continue
-        with self._lock:
+        with self._locked():
             self._enforce_vm_state(True)
             self._logger.info("Continuing VM...")
             self._qmp.send_command({"execute": "cont"})
 
+    @exposed
+    def set_balloon(self, target: int):
+        """
+        Sets the logical size of the guest's memory (in MByte) using the balloon device
+        """
+        with self._locked():
+            self._enforce_vm_state(True)
+
+            if not self._description['hardware']['memory']['balloon']:
+                raise VMQMPError("No balloon device configured")
+
+            target = max(1, min(int(target), self._description['hardware']['ram']))
+            self._logger.debug(f"Setting balloon target to {target}MB")
+            self._qmp_execute("balloon", {"value": target * 1024 * 1024})
+
+    @exposed
+    def get_balloon(self) -> int:
+        """
+        Returns the logical size of the guest's memory (in MByte) reported by the balloon device
+        """
+        with self._locked():
+            self._enforce_vm_state(True)
+
+            if not self._description['hardware']['memory']['balloon']:
+                raise VMQMPError("No balloon device configured")
+
+            return self._qmp_execute("query-balloon")['actual'] // (1024 * 1024)
+
+    def _get_agent(self) -> GuestAgent:
+        self._enforce_vm_state(True)
+
+        if not self._agent:
+            raise VMGuestAgentError("No guest agent configured")
+
+        return self._agent
+
+    @exposed
+    def get_readiness(self) -> dict:
+        """
+        Returns whether the guest agent answered since the VM was started, and how long it took (in seconds)
+        """
+        with self._locked():
+            if not self._agent or not self.is_running():
+                return {"agent": self._description['hardware']['guest_agent'], "ready": False, "boot_to_ready": None}
+
+            return {"agent": True, "ready": self._agent.is_ready(), "boot_to_ready": self._agent.get_boot_to_ready()}
+
+    @exposed
+    def guest_ping(self):
+        with self._locked():
+            self._get_agent().ping()
+
+    @exposed
+    def guest_fsfreeze(self, freeze: bool) -> int:
+        """
+        Freezes (or thaws) the guest's filesystems, e.g. for consistent disk snapshots
+        """
+        with self._locked():
+            return self._get_agent().fsfreeze(bool(freeze))
+
+    @exposed
+    def guest_fsfreeze_status(self) -> str:
+        with self._locked():
+            return self._get_agent().fsfreeze_status()
+
+    @exposed
+    @transformational
+    def set_io_throttle(self, index: int, throttle: dict = None, qos: str = None):
+        """
+        Sets the I/O limits of a drive, either by it's own limits (throttle) or by a QoS class (qos).
+        Passing neither removes the limits. Applied immediately if the VM is running.
+        """
+        with self._locked():
+            media_list = self._description['hardware']['media']
+            if not 0 <= int(index) < len(media_list):
+                raise IndexError("No such drive")
+
+            if throttle is not None:
+                throttle = self.throttle_schema.load(throttle)
+                self.check_throttle(throttle)
+
+            if qos is not None and qos not in self._qos_classes:
+                raise KeyError(f"Unknown QoS class: {qos}")
+
+            media = media_list[int(index)]
+            previous = media['throttle'], media['qos']
+            media['throttle'], media['qos'] = (None, qos) if qos else (throttle, None)
+
+            # A drive replaced or removed pending restart is not the one the limits are meant for
+            attached = self._attached_media(int(index), media) if self.is_running() else None
+            if attached:
+                try:
+                    self._apply_throttle(int(index))
+                except Exception:
+                    media['throttle'], media['qos'] = previous
+                    raise
+
+                attached['throttle'], attached['qos'] = copy.deepcopy(media['throttle']), media['qos']
+
+            self._notify('description')
+
+    @exposed
+    def get_io_throttle(self) -> list:
+        """
+        Returns the effective I/O limits of each drive (None for unthrottled drives)
+        """
+        with self._locked():
+            result = []
+            for media in self._description['hardware']['media']:
+                try:
+                    limits, group = self._throttle_of(media)
+                except KeyError:
+                    limits, group = None, None
+
+                result.append({"path": media['path'], "qos": media['qos'], "group": group, "limits": dict(limits) if limits else None})
+
+            return result
+
+    @exposed
+    @transformational
+    def set_resources(self, resources: dict):
+        """
+        Sets the cgroup limits of the VM. Applied immediately if the VM is running.
+        """
+        with self._locked():
+            resources = self.resources_schema.load(resources)
+
+            if self._cgroup and self.is_running():
+                try:
+                    self._cgroup.apply(resources)
+                except OSError as e:
+                    raise VMCGroupError(str(e))
+
+            self._description['hardware']['resources'] = resources
+            self._notify('description')
+
+    @exposed
+    def get_usage(self) -> dict:
+        """
+        Returns the resource usage of the VM as accounted by it's cgroup
+        """
+        with self._locked():
+            self._enforce_vm_state(True)
+
+            if not self._cgroup:
+                raise VMCGroupError("The VM is not in a cgroup")
+
+            try:
+                return self._cgroup.usage()
+            except OSError as e:
+                raise VMCGroupError(str(e))
+
+    def is_template(self) -> bool:
+        with self._locked():
+            return self._description['template']
+
+    def set_template(self, template: bool):
+        """
+        Marks the VM as a template (or releases it). Templates can not be started, and their disks can not be changed.
+        """
+        with self._locked():
+            if template:
+                self._enforce_vm_state(False)
+
+            if self._description['template'] != template:
+                self._description['template'] = template
+                self._notify('description')
+
+    @staticmethod
+    def _disks_of(description: dict) -> list:
+        return [(media['type'], media['path'], media['format'], media['readonly']) for media in description['hardware']['media']]
+
+    def in_cgroup(self) -> bool:
+        with self._locked():
+            return self._cgroup is not None
+
+    def uses_qos_class(self, name: str) -> bool:
+        with self._locked():
+            return any(media['qos'] == name for media in self._description['hardware']['media'])
+
+    def apply_qos_class(self, name: str):
+        """
+        Applies the changed limits of a QoS class to the drives using it. Does nothing if the VM is not running.
+        """
+        with self._locked():
+            if not self.is_running():
+                return
+
+            # Every member is set: drives only join the group once it has limits, e.g. not if the class was unlimited at start
+            for index, media in enumerate(self._running_hardware['media']):
+                if media and media['qos'] == name:
+                    self._apply_throttle(index, media)
+
+    def has_balloon(self) -> bool:
+        with self._locked():
+            return self._description['hardware']['memory']['balloon']
+
+    def get_ram(self) -> int:
+        with self._locked():
+            return self._description['hardware']['ram']
+
+    def get_pid(self) -> int:
+        with self._locked():
+            if not self.is_running():
+                return None
+
+            return self._process.pid
+
+    def get_index_keys(self) -> dict:
+        """
+        Returns the values the VM registry indexes this VM by
+        """
+        with self._locked():
+            hardware_description = self._description['hardware']
+            return {
+                "autostart": self._description['autostart'],
+                "master": {network['master'] for network in hardware_description['network']},
+                "disk": {media['path'] for media in hardware_description['media']},
+                "tag": set(self._description['tags'])
+            }
+
     @exposed
     def get_name(self) -> str:
-        with self._lock:
-            return self._name
+        # The name never changes, so no locking needed. This also makes it safe to call from event listeners
+        return self._name
 
     @exposed
     def get_vnc_port(self) -> int:
-        with self._lock:
+        with self._locked():
             self._enforce_vm_state(True)
             return self._vnc_port
 
     @exposed
     def is_running(self) -> bool:
-        with self._lock:
+        with self._locked():
             if not self._process:
                 return False
 
@@ -232,17 +1029,53 @@ class VM(ExposedClass):
 
     @exposed
     def dump_description(self) -> dict:
-        with self._lock:
+        with self._locked():
             return self.description_schema.dump(self._description)
 
+    @exposed
+    def get_pending_restart(self) -> list:
+        """
+        Returns the changes of the description that were not applied to the running VM
+        """
+        with self._locked():
+            return list(self._pending_restart) if self.is_running() else []
+
     @exposed
     @transformational
-    def update_description(self, new_description: dict):
+    def update_description(self, new_description: dict) -> dict:
         """
-        Replaces the current description with the supplied one
+        Replaces the current description with the supplied one.
+        If the VM is running, the differences are applied live where possible, the rest is reported as pending-restart.
         """
-        with self._lock:
-            self._enforce_vm_state(False)
+        with self._locked():
+            description = self.description_schema.load(new_description)
+            self._check_description(description)
+
+            if self._description['template']:  # released by the manager, once no clone depends on it
+                if not description['template']:
+                    raise VMTemplateError("The template can only be released with release_template")
+
+                if self._disks_of(description) != self._disks_of(self._description):
+                    raise VMTemplateError("The disks of a template can not be changed")
+
+            elif description['template']:
+                self._enforce_vm_state(False)
+
+            for media in description['hardware']['media']:
+                if media['qos'] and media['qos'] not in self._qos_classes:
+                    raise KeyError(f"Unknown QoS class: {media['qos']}")
+
+            if self.is_running():
+                with Tracer.span("vm.apply_live", vm=self._name):
+                    result = self._apply_live(description)
+
+                self._pending_restart = result['pending_restart']
+                self._logger.info(f"Description updated live, applied: {len(result['applied'])}, pending restart: {len(result['pending_restart'])}")
+            else:
+                result = {"applied": [], "pending_restart": []}
+
+            self._description = description
+            self._notify('description')
 
-            self._description = self.description_schema.load(new_description)
+            return result
 
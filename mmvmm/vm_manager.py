@@ -1,56 +1,288 @@
 #!/usr/bin/env python3
+import os
+import copy
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from vm import VM
+from registry import VMRegistry
+from events import EventBus
 from objectstore import ObjectStore
+from persistence import PersistenceQueue
+from snapshot import DescriptionSnapshot
+from disk_image import DiskImage
+from utils import generate_mac_address, SwappableDict
+from fastschema import CompiledSchema
+from tracing import Tracer, LatencyHistogram
+from schema import QoSClassNameSchema
 
-from exception import UnknownCommandError, UnknownVMError, VMNotRunningError, VMRunningError
+from exception import UnknownCommandError, UnknownVMError, VMNotRunningError, VMRunningError, VMTemplateError, DeadlineExceededError
+from deadline import Deadline
 
 from expose import ExposedClass, exposed, transformational
 
 import time
+from threading import Thread, Lock, RLock
 
 
 class VMMAnager(ExposedClass):  # TODO: Split this into two classes
 
-    def __init__(self, objectstore: ObjectStore):
+    QUERY_FIELDS = {
+        "name": lambda vm: vm.get_name(),
+        "running": lambda vm: vm.is_running(),
+        "vnc_port": lambda vm: vm.get_vnc_port() if vm.is_running() else None,
+        "description": lambda vm: vm.dump_description(),
+        "usage": lambda vm: vm.get_usage() if vm.is_running() and vm.in_cgroup() else None
+    }
+
+    PUBLISHED_QMP_EVENTS = ['SHUTDOWN', 'RESET', 'STOP', 'RESUME', 'BLOCK_IO_ERROR']
+
+    FLUSH_TIMEOUT = 30  # sec, commands needing durability fail after this, their writes stay queued
+
+    SNAPSHOT_INTERVAL = 60  # sec, the snapshot is refreshed at most this often after writes
+
+    CATCH_UP_MAX_DELAY = 60  # sec, between retries while etcd is unreachable
+
+    def __init__(self, objectstore: ObjectStore, snapshot_path: str = None):
         self._logger = logging.getLogger("manager")
 
-        self._vms = []
-        self._vm_map = {}
+        self._events = EventBus()
+        self._boot_to_ready = LatencyHistogram()  # milliseconds
+        self._registry = VMRegistry(self._on_vm_event)
 
         self._objectstore = objectstore
+        self._persistence = PersistenceQueue(objectstore, on_stored=self._on_stored)
+        self._load_time = None
 
-        self._load()
+        self._qos_classes = SwappableDict()  # name -> throttle limits, shared with the VMs
+        self._lock = RLock()  # serializes the commands with the catch-up, which changes the registry and the QoS classes
+        self._qos_name_schema = CompiledSchema(QoSClassNameSchema(many=False))
 
-    def _rebuild_map(self):
-        self._vm_map = {vm.get_name(): vm for vm in self._vms}
+        self._snapshot = DescriptionSnapshot(snapshot_path) if snapshot_path else None
+        self._snapshot_lock = Lock()
+        self._snapshot_written = 0  # monotonic time of the last snapshot write
+        self._revision = None  # etcd revision the descriptions were last read at, snapshots are taken at this revision
+        self._unsynced = set()  # VMs changed locally in an earlier run, but not stored in etcd yet
+        self._catch_up_thread = None
+        self._catch_up_time = None
+        self._conflicts = 0
 
-    def _load(self):
+        self._stats_sources = {}  # name -> callable returning the stats of other components
+
+        self._timeouts = {"expired": 0, "cancelled": 0, "commands": {}}  # expired: late before started, cancelled: gave up while running
+
+        snapshot = self._snapshot.read() if self._snapshot else None
+        if snapshot:
+            self._load_snapshot(*snapshot)
+        else:
+            self._load_qos_classes()
+            self._load()
+            self._write_snapshot()
 
-        descriptions = self._objectstore.get_prefix('/virtualmachines')
+        self._persistence.start()
 
+        if snapshot:  # Everything is usable already, the changes made while we were away are loaded in the background
+            self._catch_up_thread = Thread(target=self._catch_up, daemon=True)
+            self._catch_up_thread.start()
+
+    def _on_vm_event(self, vm: VM, event: str, data: dict):
+        if event in ('started', 'stopped'):
+            self._events.publish('lifecycle', vm.get_name(), event)
+
+        elif event == 'ready':
+            self._boot_to_ready.record(data['boot_to_ready'] * 1000)
+            self._events.publish('lifecycle', vm.get_name(), event, data)
+
+        elif event == 'description':
+            self._events.publish('description', vm.get_name(), 'changed', {"description": vm.dump_description()})
+
+        elif event == 'qmp' and data['event'] in self.PUBLISHED_QMP_EVENTS:
+            self._events.publish('qmp', vm.get_name(), data['event'], data['data'])
+
+    def _load_descriptions(self, descriptions: dict, skip: set = frozenset()) -> int:
+        """
+        Registers VMs from stored descriptions in bulk. The descriptions are not saved back, since they came from the store.
+        Invalid descriptions are skipped. Returns the number of loaded VMs.
+        """
+        vms = []
         for name, description in descriptions.items():
+            if name in skip:
+                continue
 
             try:
-                self.new(name, description)
+                name, description = VM.validate(name, description)
             except Exception as e:
-                self._logger.error(f"Something went wrong while loading virtual machine {description['name'] if 'name' in description else 'UNKNOWN'}: {str(e)} - VM skipped!")
+                self._logger.error(f"Something went wrong while loading virtual machine {name}: {str(e)} - VM skipped!")
+                continue
+
+            vms.append(VM(name, description, validated=True, qos_classes=self._qos_classes))
+
+        self._registry.add_many(vms)
+        return len(vms)
+
+    def _load(self):
+        started = time.perf_counter()
+
+        with Tracer.span("manager.load"):
+            descriptions, _, self._revision = self._objectstore.get_prefix_since('/virtualmachines')
+            loaded = self._load_descriptions(descriptions)
+
+        self._load_time = time.perf_counter() - started
+        self._logger.info(f"Loaded {loaded} virtual machines in {self._load_time:.3f}sec ({len(descriptions) - loaded} skipped)")
+
+    def _load_snapshot(self, revision: int, descriptions: dict, qos_classes: dict, dirty: list):
+        started = time.perf_counter()
+
+        with Tracer.span("manager.load_snapshot"):
+            self._set_qos_classes(qos_classes)
+            loaded = self._load_descriptions(descriptions)
+
+        self._revision = revision
+        self._unsynced = set(dirty)
+
+        self._load_time = time.perf_counter() - started
+        self._logger.info(
+            f"Loaded {loaded} virtual machines from the snapshot at revision {revision} in {self._load_time:.3f}sec "
+            f"({len(descriptions) - loaded} skipped, {len(dirty)} not stored yet)"
+        )
+
+    def _write_snapshot(self):
+        """
+        Stores the current descriptions locally. VMs with writes still pending are marked, so they are stored after a restart.
+        """
+        if not self._snapshot or self._revision is None:
+            return
+
+        with self._snapshot_lock:
+            dirty = {key.split('/')[-1] for key in self._persistence.pending_keys('/virtualmachines/')} | self._unsynced
+
+            try:
+                self._snapshot.write(
+                    self._revision,
+                    {vm.get_name(): vm.dump_description() for vm in self._registry.vms()},
+                    self.get_qos_classes(),
+                    sorted(dirty)
+                )
+            except OSError as e:
+                self._logger.error(f"Could not write snapshot {self._snapshot.get_path()}: {str(e)}")
+                return
+
+            self._snapshot_written = time.monotonic()
+
+    def _on_stored(self):
+        if self._snapshot and time.monotonic() - self._snapshot_written >= self.SNAPSHOT_INTERVAL:
+            self._write_snapshot()
+
+    def _catch_up(self):
+        """
+        Loads the changes made in etcd since the snapshot was taken, retrying until etcd is reachable.
+        VMs changed both in etcd and locally are conflicts: the local version is kept (and stored), the event carries the etcd one.
+        """
+        started = time.perf_counter()
+        delay = 1
+        while True:
+            try:
+                qos_classes = self._objectstore.get_prefix('/qos')
+                changed, names, revision = self._objectstore.get_prefix_since('/virtualmachines', self._revision)
+                break
+            except Exception as e:
+                self._logger.warning(f"Could not catch up with etcd: {str(e)}. Retrying in {delay}sec...")
+                time.sleep(delay)
+                delay = min(delay * 2, self.CATCH_UP_MAX_DELAY)
+
+        with self._lock, Tracer.span("manager.catch_up", changed=len(changed)):
+            self._set_qos_classes(qos_classes)  # etcd is authoritative for these
+
+            pending = {key.split('/')[-1] for key in self._persistence.pending_keys('/virtualmachines/')}
+            dirty = self._unsynced | pending
+            deleted = {name for name in self._registry.names() if name not in names and name not in dirty}  # dirty ones may be created locally
+
+            for name in set(changed.keys()) | deleted:
+                if name in dirty:
+                    self._conflict(name, changed.get(name), "changed locally as well")
+                else:
+                    self._apply_remote(name, changed.get(name))
+
+            for name in self._unsynced:  # Local changes of the earlier run, etcd has not seen them yet
+                if name in self._registry:
+                    self._save(self._registry.get(name))
+                else:
+                    self._persistence.delete(f"/virtualmachines/{name}")
+
+            self._unsynced = set()
+            self._revision = revision
+
+        self._catch_up_time = time.perf_counter() - started
+        self._logger.info(f"Caught up with etcd at revision {revision} in {self._catch_up_time:.3f}sec ({len(changed)} changed, {len(deleted)} deleted)")
+        self._events.publish('registry', None, 'caught_up', {"revision": revision})
+
+        self._write_snapshot()
+
+    def _apply_remote(self, name: str, description: dict):
+        """
+        Applies a description changed in etcd. None means the VM was deleted there.
+        """
+        if name not in self._registry:
+            if description is not None and self._load_descriptions({name: description}):
+                self._events.publish('registry', name, 'created')
+            return
+
+        vm = self._registry.get(name)
+        try:
+            if description is None:
+                vm.destroy()
+                self._registry.remove(name)
+                self._events.publish('registry', name, 'deleted')
+            elif vm.dump_description() != description:  # e.g. our own writes since the snapshot
+                vm.update_description(description)  # applied live if running
+        except Exception as e:
+            self._conflict(name, description, str(e))
+
+    def _conflict(self, name: str, description: dict, reason: str):
+        self._conflicts += 1
+        self._logger.warning(f"Conflicting changes of {name} while etcd was unreachable ({reason}), keeping the local version")
+        self._events.publish('registry', name, 'conflict', {"reason": reason, "remote_description": description})
+
+    def _set_qos_classes(self, qos_classes: dict):
+        loaded = {}
+        for name, limits in qos_classes.items():
+            try:
+                limits = VM.throttle_schema.load(limits)
+                VM.check_throttle(limits)
+            except Exception as e:
+                self._logger.error(f"Something went wrong while loading QoS class {name}: {str(e)} - class skipped!")
+                continue
+
+            loaded[name] = limits
+
+        self._qos_classes.replace(loaded)  # in one step, the VMs share it
+
+    def _load_qos_classes(self):
+        self._set_qos_classes(self._objectstore.get_prefix('/qos'))
 
     def _save(self, vm: VM):
-        description = vm.dump_description()
-        self._objectstore.delete_prefix(f"/virtualmachines/{vm.get_name()}/")  # ugly fix
-        self._objectstore.put(f"/virtualmachines/{vm.get_name()}", description)
+        with Tracer.span("manager.save", vm=vm.get_name()):
+            self._persistence.save(f"/virtualmachines/{vm.get_name()}", vm.dump_description())  # written behind, in batches
+
+    def _flush(self, timeout: float = None):
+        timeout, limited_by_deadline = Deadline.timeout(timeout, "storing the pending writes")
+
+        if not self._persistence.flush(timeout):
+            if limited_by_deadline:
+                raise DeadlineExceededError("storing the pending writes")
+
+            raise TimeoutError(f"{self._persistence.pending()} pending writes could not be stored in time")
 
     def _save_all(self):
 
-        for vm in self._vms:
+        for vm in self._registry.vms():
             self._save(vm)
 
     ## PUBLIC ##
 
     def close(self, forced: bool = False, timeout: int = 60):
         at_least_one_powered_on = False
-        for vm in self._vms:
+        vms = self._registry.vms()
+        for vm in vms:
             try:
 
                 if forced:
@@ -73,7 +305,7 @@ class VMMAnager(ExposedClass):  # TODO: Split this into two classes
 
                 if (time.time() - wait_started) > timeout:
                     self._logger.warning("Waiting for shutdown time expired. Killing VMs forcefully...")
-                    for vm in self._vms:
+                    for vm in vms:
 
                         try:
                             vm.terminate(kill=True)
@@ -83,78 +315,371 @@ class VMMAnager(ExposedClass):  # TODO: Split this into two classes
                     break
                 else:
                     at_least_one_powered_on = False
-                    for vm in self._vms:
+                    for vm in vms:
                         if vm.is_running():
                             at_least_one_powered_on = True
 
-        self._vms = []
+        self._persistence.close(timeout)  # Store the pending writes, including the ones made by the VMs powering off
+        self._write_snapshot()
+
+        self._registry = VMRegistry(self._on_vm_event)
 
     def autostart(self):
         """
         Start all VMs marked as autostart.
         """
         self._logger.info("Starting all VMs marked as autostart.")
-        for vm in self._vms:
-            vm.autostart()
+        with self._lock:
+            for vm in self._registry.query({'autostart': True})[0]:
+                vm.autostart()
+
+    def get_vms(self) -> list:
+        return self._registry.vms()
+
+    def get_event_bus(self) -> EventBus:
+        return self._events
+
+    def add_stats_source(self, name: str, source: callable):
+        """
+        Includes the result of source() in the stats, under the given name
+        """
+        self._stats_sources[name] = source
+
+    @exposed
+    def set_fast_schema(self, enabled: bool):
+        """
+        Enables or disables the precompiled schema validation fast path
+        """
+        CompiledSchema.set_enabled(bool(enabled))
+        self._logger.info(f"Fast schema validation {'enabled' if enabled else 'disabled'}")
+
+    @exposed
+    def stats(self, prefix: str = None, spans: int = 0) -> dict:
+        """
+        Returns the latency histograms of the traced operations (command.* for control commands),
+        and optionally the last few spans in OpenTelemetry JSON format
+        """
+        result = {
+            "enabled": Tracer.enabled,
+            "load_time": self._load_time,
+            "boot_to_ready": self._boot_to_ready.dump(),
+            "persistence": self._persistence.stats(),
+            "timeouts": copy.deepcopy(self._timeouts),
+            "snapshot": {
+                "path": self._snapshot.get_path() if self._snapshot else None,
+                "revision": self._revision,
+                "catching_up": bool(self._catch_up_thread and self._catch_up_thread.is_alive()),
+                "catch_up_time": self._catch_up_time,
+                "conflicts": self._conflicts
+            },
+            "histograms": Tracer.stats(prefix)
+        }
+
+        for name, source in self._stats_sources.items():
+            result[name] = source()
+
+        if spans:
+            result['spans'] = Tracer.recent_spans(spans)
+
+        return result
+
+    @exposed
+    def flush(self, timeout: float = None):
+        """
+        Waits until every change made before the call is stored
+        """
+        self._flush(timeout)
+
+    @exposed
+    def migrate_storage(self) -> dict:
+        """
+        Rewrites the descriptions and QoS classes still stored in the flat layout into the compact format.
+        Safe to run while the store is in use, objects changed meanwhile are reported as conflicts.
+        """
+        self._flush(self.FLUSH_TIMEOUT)  # The queued writes are stored in the current format anyway
+
+        result = {prefix: self._objectstore.migrate(f"/{prefix}") for prefix in ['virtualmachines', 'qos']}
+        self._logger.info(f"Storage migrated: {result}")
+        return result
+
+    @exposed
+    def set_tracing(self, enabled: bool, export: bool = False):
+        """
+        Enables or disables tracing. With export, the spans are written to the file configured by MMVMM_TRACE_FILE.
+        """
+        Tracer.configure(bool(enabled), bool(export))
 
     @exposed
     def get_list(self) -> list:
-        return list(self._vm_map.keys())
+        return self._registry.names()
+
+    @exposed
+    def query(self, filters: dict = None, fields: list = None, limit: int = 100, cursor: str = None) -> dict:
+        """
+        Returns the VMs matching all filters (running, autostart, master, disk, tag), ordered by name.
+        Only the requested fields are returned for each VM (default: name).
+        Pass the returned next_cursor as cursor to get the next page, it is None on the last page.
+        """
+        fields = fields or ['name']
+        for field in fields:
+            if field not in self.QUERY_FIELDS:
+                raise KeyError(f"Unknown field: {field}")
+
+        vms, next_cursor = self._registry.query(filters, cursor, max(1, int(limit)))
+
+        return {
+            "items": [{field: self.QUERY_FIELDS[field](vm) for field in fields} for vm in vms],
+            "next_cursor": next_cursor
+        }
 
     @exposed
     @transformational
     def new(self, name: str, description: dict):
         self._logger.debug(f"Loading VM {name} from description: {description}")
 
-        if name in self._vm_map.keys():
+        if name in self._registry:
             raise KeyError("A virtual machine with this name already exists...")
 
-        vm = VM(name, description)
+        vm = VM(name, description, qos_classes=self._qos_classes)
 
-        self._vms.append(vm)
-        self._rebuild_map()
+        self._registry.add(vm)
         self._save(vm)
+        self._events.publish('registry', name, 'created')
         self._logger.info(f"New virtual machine created: {vm.get_name()}")
 
+    @exposed
+    def get_qos_classes(self) -> dict:
+        return {name: VM.throttle_schema.dump(limits) for name, limits in self._qos_classes.items()}
+
+    @exposed
+    def set_qos_class(self, name: str, limits: dict):
+        """
+        Creates or updates a named set of I/O limits. Drives using the class share a throttle group inside their VM.
+        Running VMs using the class get the new limits immediately.
+        """
+        name = self._qos_name_schema.load({'name': name})['name']
+        limits = VM.throttle_schema.load(limits)
+        VM.check_throttle(limits)
+
+        self._persistence.save(f"/qos/{name}", VM.throttle_schema.dump(limits))
+        self._qos_classes[name] = limits
+
+        for vm in self._registry.vms():
+            if vm.uses_qos_class(name):
+                try:
+                    vm.apply_qos_class(name)
+                except Exception as e:
+                    self._logger.error(f"Could not apply QoS class {name} to {vm.get_name()}: {str(e)}")
+
+        self._events.publish('qos', None, 'changed', {"name": name})
+        self._logger.info(f"QoS class {name} set")
+
+    @exposed
+    def delete_qos_class(self, name: str):
+        if name not in self._qos_classes:
+            raise KeyError("No QoS class with this name exists...")
+
+        users = [vm.get_name() for vm in self._registry.vms() if vm.uses_qos_class(name)]
+        if users:
+            raise KeyError(f"The QoS class is used by: {', '.join(users)}")
+
+        self._persistence.delete(f"/qos/{name}")
+        del self._qos_classes[name]
+
+        self._events.publish('qos', None, 'deleted', {"name": name})
+        self._logger.info(f"QoS class {name} deleted")
+
+    @staticmethod
+    def _create_overlays(overlays: list):
+        created = []
+        try:
+            for backing_path, backing_format, path in overlays:
+                DiskImage.create_overlay(backing_path, backing_format, path)
+                created.append(path)
+        except Exception:
+            for path in created:
+                DiskImage.remove(path)
+            raise
+
+    @exposed
+    @transformational
+    def clone(self, template: str, names: list, autostart: bool = False, parallel: int = 8) -> dict:
+        """
+        Creates new VMs from the description of a template VM.
+        Writable disks are replaced by qcow2 overlays backed by the template's disks, NICs get fresh MAC addresses.
+        The template VM is marked as a template: the overlays would be corrupted by writes to it's disks, so it can not
+        be started and it's disks can not be changed, until it is released by release_template.
+        """
+        try:
+            template_vm = self._registry.get(template)
+        except KeyError:
+            raise UnknownVMError()
+
+        if len(set(names)) != len(names):
+            raise KeyError("Duplicate names in the clone list...")
+
+        for name in names:
+            VM.name_schema.load({'name': name})  # fail early on invalid names, before touching the disks
+            if name in self._registry:
+                raise KeyError(f"A virtual machine with this name already exists: {name}")
+
+        was_template = template_vm.is_template()
+        template_vm.set_template(True)  # raises VMRunningError if the template is running
+        self._save(template_vm)  # manager commands are not saved by _execute_command, the flag must survive a sync
+
+        template_description = template_vm.dump_description()
+        reserved_macs = {nic['mac'].lower() for vm in self._registry.vms() for nic in vm.dump_description()['hardware']['network']}
+
+        clones = []
+        for name in names:
+            description = copy.deepcopy(template_description)
+            description['autostart'] = autostart
+            description['template'] = False
+            description['clone_of'] = template
+
+            for nic in description['hardware']['network']:
+                nic['mac'] = generate_mac_address(reserved_macs)
+                reserved_macs.add(nic['mac'])
+
+            overlays = []
+            for i, media in enumerate(description['hardware']['media']):
+                if media['type'] == 'disk' and not media['readonly']:
+                    overlay_path = os.path.join(os.path.dirname(media['path']), f"{name}_{i}.qcow2")
+                    overlays.append((media['path'], media['format'], overlay_path))
+                    media['path'] = overlay_path
+                    media['format'] = 'qcow2'
+
+            clones.append((name, description, overlays))
+
+        self._logger.info(f"Cloning {template} into {len(clones)} new virtual machines...")
+
+        created = []
+        failed = {}
+        with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+            futures = [executor.submit(self._create_overlays, overlays) for _, _, overlays in clones]
+
+            for future, (name, description, overlays) in zip(futures, clones):
+                try:
+                    future.result()
+                except Exception as e:
+                    self._logger.error(f"Could not create disk overlays for {name}: {str(e)}")
+                    failed[name] = str(e)
+                    continue
+
+                try:
+                    self.new(name, description)
+                except Exception as e:
+                    self._logger.error(f"Could not create clone {name}: {str(e)}")
+                    for _, _, path in overlays:
+                        DiskImage.remove(path)
+                    failed[name] = str(e)
+                    continue
+
+                created.append(name)
+
+        if not created and not was_template:  # nothing depends on it
+            template_vm.set_template(False)
+            self._save(template_vm)
+
+        return {"created": created, "failed": failed}
+
+    @exposed
+    @transformational
+    def release_template(self, name: str):
+        """
+        Turns a template back into an ordinary VM. Fails while clones backed by it's disks exist.
+        """
+        try:
+            template_vm = self._registry.get(name)
+        except KeyError:
+            raise UnknownVMError()
+
+        self._check_no_clones(name)
+        template_vm.set_template(False)
+        self._save(template_vm)
+
+    def _check_no_clones(self, template: str):
+        clones = [vm.get_name() for vm in self._registry.vms() if vm.dump_description()['clone_of'] == template]
+        if clones:
+            raise VMTemplateError(f"Still backing {len(clones)} clones: {', '.join(sorted(clones))}")
+
     @exposed
     @transformational
     def delete(self, name: str):
-        vm = self._vm_map[name]
+        vm = self._registry.get(name)
         vm.destroy()  # If not allowed, this should raise an error
 
+        if vm.is_template():  # The disks could be reused while the overlays of the clones still refer to them
+            self._check_no_clones(name)
+
         # no error raised... continuing
-        self._vms.remove(vm)
-        success = self._objectstore.delete_prefix(f"/virtualmachines/{name}/")
-        if not success:
-            self._logger.error(f"Failed to delete /virtualmachines/{name}/ from etcd!")
+        self._registry.remove(name)
+        self._persistence.delete(f"/virtualmachines/{name}")
+        self._flush(self.FLUSH_TIMEOUT)  # A deleted VM must not come back after a restart
 
-        self._rebuild_map()
+        self._events.publish('registry', name, 'deleted')
         self._logger.info(f"Virtual machine deleted: {name}")
 
     @exposed
     @transformational
     def sync(self):
-        # Delete all not running Virtual machines
+        # Forget all not running Virtual machines (their descriptions are kept in the store, so they can be loaded back)
         self._logger.info("Syncrhronizing all virtual machines with their descriptions....")
-        nowarn = []
-        for vm_name in self._vm_map.keys():
+        skipped = 0
+        for vm in self._registry.vms():
 
             try:
-                self.delete(vm_name)
+                vm.destroy()
             except VMRunningError:
-                nowarn.append(vm_name)
-                self._logger.warning(f"Couldn't sync {vm_name}. It's still running")
+                self._logger.warning(f"Couldn't sync {vm.get_name()}. It's still running")
+                skipped += 1
+                continue
+
+            self._registry.remove(vm.get_name())
 
         # Load them back
-        descriptions = self._objectstore.get_prefix('/virtualmachines')
-        for name, description in descriptions.items():
+        self._flush(self.FLUSH_TIMEOUT)
+        self._load_qos_classes()
+        descriptions, _, revision = self._objectstore.get_prefix_since('/virtualmachines')
+        self._load_descriptions(descriptions, skip=set(self._registry.names()))
+
+        if not skipped and not self._unsynced:  # Otherwise the snapshot stays at the earlier revision, so the skipped ones are caught up after a restart
+            self._revision = revision
+            self._write_snapshot()
+
+        self._events.publish('registry', None, 'synced')
+
+    def execute_command(self, target: str, cmd: str, args: dict, deadline: float = None) -> object:
+        """
+        Executes a command. With a deadline (time.monotonic() based), the command is not started if it's already late
+        (e.g. it waited behind a slow one), and blocking calls made by it give up with DeadlineExceededError when it passes.
+        """
+        with Tracer.span(f"command.{self._command_name(target, cmd)}", target=target or ""), Deadline.scope(deadline):
+            try:
+                Deadline.check("the command expired before it was started")
+            except DeadlineExceededError:
+                self._count_timeout(target, cmd, 'expired')
+                raise
+
             try:
-                self.new(name, description)
-            except KeyError as e:
-                if name not in nowarn:
-                    self._logger.error(f"Couldn't reload {name}. {str(e)} (Duplicate id?)")
+                with Deadline.acquire(self._lock, "the catch-up with etcd"):
+                    return self._execute_command(target, cmd, args)
+            except DeadlineExceededError:
+                self._count_timeout(target, cmd, 'cancelled')
+                raise
+
+    def _command_name(self, target: str, cmd: str) -> str:
+        """
+        Returns the name to account a command under. Clients can send anything, so unknown ones share a single name.
+        """
+        return cmd if cmd in (VM.exposed_functions if target else self.exposed_functions) else "unknown"
+
+    def _count_timeout(self, target: str, cmd: str, kind: str):
+        name = self._command_name(target, cmd)
+        self._timeouts[kind] += 1
+        self._timeouts['commands'][name] = self._timeouts['commands'].get(name, 0) + 1
 
-    def execute_command(self, target: str, cmd: str, args: dict) -> object:
+    def _execute_command(self, target: str, cmd: str, args: dict) -> object:
 
         if not target:
             try:
@@ -167,7 +692,7 @@ class VMMAnager(ExposedClass):  # TODO: Split this into two classes
         else:
 
             try:
-                vm = self._vm_map[target]
+                vm = self._registry.get(target)
             except KeyError:
                 raise UnknownVMError()
 
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+The control socket, and the command validation of the control loop with the command provider and the manager replaced by stubs.
+Run from the repository root: python3 -m unittest discover tests
+"""
+import os
+import sys
+import json
+import socket
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mmvmm"))
+
+from marshmallow.exceptions import ValidationError  # noqa: E402
+
+import control  # noqa: E402
+from control import SimpleCommandExecuter, SocketCommandProvider  # noqa: E402
+
+
+class StubCommandProvider(object):
+
+    def __init__(self, commands: list):
+        self.commands = list(commands)
+        self.results = []
+        self.executer = None
+
+    def stats(self) -> dict:
+        return {}
+
+    def get_command_object(self) -> tuple:
+        if not self.commands:
+            self.executer.stop()
+            return None
+
+        return self.commands.pop(0), self.results.append
+
+    def close(self):
+        pass
+
+
+class StubManager(object):
+
+    def __init__(self):
+        self.executed = []
+
+    def add_stats_source(self, name: str, source: callable):
+        pass
+
+    def execute_command(self, target: str, cmd: str, args: dict, deadline: float = None):
+        self.executed.append(cmd)
+        return []
+
+
+class ControlLoopTest(unittest.TestCase):
+
+    def _run(self, *commands) -> tuple:
+        provider = StubCommandProvider(commands)
+        manager = StubManager()
+        provider.executer = SimpleCommandExecuter(provider, manager)
+        provider.executer.loop()
+        return provider.results, manager.executed
+
+    def test_oversized_deadline(self):
+        results, executed = self._run(
+            {"cmd": "get_list", "deadline": 10 ** 400, "id": 1},
+            {"cmd": "get_list", "id": 2}
+        )
+
+        # The first one is rejected like any invalid command, and the loop keeps serving the next ones
+        self.assertEqual(results, [
+            {"success": False, "error": "Invalid command schema", "id": 1},
+            {"success": True, "result": [], "id": 2}
+        ])
+        self.assertEqual(executed, ["get_list"])
+
+    def test_oversized_deadline_fast_path(self):
+        with self.assertRaises(ValidationError):
+            SimpleCommandExecuter.control_command_schema.load({"cmd": "get_list", "deadline": 10 ** 400})
+
+        loaded = SimpleCommandExecuter.control_command_schema.load({"cmd": "get_list", "deadline": 10 ** 9})
+        self.assertEqual(loaded['deadline'], 1e9)
+
+
+class SocketCommandProviderTest(unittest.TestCase):
+
+    def setUp(self):
+        control.SocketCommandProvider.SOCKET_PATH = os.path.join(tempfile.mkdtemp(prefix="mmvmm-test-"), "control.sock")
+        self.provider = SocketCommandProvider(rate_limit=0)
+        self.addCleanup(self.provider.close)
+
+    def _connect(self) -> socket.socket:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(SocketCommandProvider.SOCKET_PATH)
+        client.settimeout(5)
+        self.addCleanup(client.close)
+        return client
+
+    def _receive_all(self, client: socket.socket) -> bytes:
+        data = b""
+        while True:
+            chunk = client.recv(4096)
+            if not chunk:
+                return data
+            data += chunk
+
+    def test_half_closed_connection_is_answered(self):
+        client = self._connect()
+        client.sendall(b"".join(json.dumps({"cmd": "get_list", "id": i}).encode() + b"\n" for i in (1, 2)))
+        client.shutdown(socket.SHUT_WR)  # like socat, the responses are still read
+
+        data, result_pusher = self.provider.get_command_object()
+        self.assertEqual(data, {"cmd": "get_list", "id": 1})
+        result_pusher({"success": True, "id": 1})
+
+        # The end of the stream is read while the second command is queued, it must still be run
+        other = self._connect()
+        other.sendall(json.dumps({"cmd": "get_list", "id": 3}).encode() + b"\n")
+
+        served = []
+        for _ in range(2):  # answered before the next one is picked, as the command loop does
+            data, result_pusher = self.provider.get_command_object()
+            result_pusher({"success": True, "id": data['id']})
+            served.append(data['id'])
+
+        self.assertEqual(sorted(served), [2, 3])
+
+        other.sendall(json.dumps({"cmd": "get_list", "id": 4}).encode() + b"\n")
+        self.provider.get_command_object()  # the answered connection is closed meanwhile
+
+        responses = self._receive_all(client).splitlines()
+        self.assertEqual([json.loads(response) for response in responses], [{"success": True, "id": 1}, {"success": True, "id": 2}])
+        self.assertEqual(self.provider.stats()['connections'], 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Timeouts of the guest agent client, against a channel that never answers.
+Run from the repository root: python3 -m unittest discover tests
+"""
+import os
+import sys
+import time
+import socket
+import logging
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mmvmm"))
+
+import qmp  # noqa: E402
+from guest_agent import GuestAgent  # noqa: E402
+from deadline import Deadline  # noqa: E402
+from exception import VMGuestAgentError, DeadlineExceededError  # noqa: E402
+
+
+class GuestAgentTimeoutTest(unittest.TestCase):
+
+    def setUp(self):
+        qmp.SOCKET_DIR = tempfile.mkdtemp(prefix="mmvmm-test-")
+        self.agent = GuestAgent(logging.getLogger("test"), timeout=2)
+
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.agent.get_sock_path())
+        self.server.listen(1)  # accepted by the kernel, nothing is ever answered
+        self.addCleanup(self.server.close)
+        self.addCleanup(self.agent.disconnect)
+
+    def _hold_lock(self, seconds: float):
+        self.agent._lock.acquire()
+        timer = threading.Timer(seconds, self.agent._lock.release)
+        timer.start()
+        self.addCleanup(timer.join)
+
+    def test_agent_timeout(self):
+        started = time.monotonic()
+        with self.assertRaises(VMGuestAgentError):
+            self.agent.execute("guest-ping", timeout=0.2)
+
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_deadline_includes_lock_wait(self):
+        self._hold_lock(0.3)
+
+        started = time.monotonic()
+        with Deadline.scope(started + 0.6), self.assertRaises(DeadlineExceededError):
+            self.agent.execute("guest-ping")
+
+        # Only the rest of the deadline is left for the request once the lock is taken
+        self.assertLess(time.monotonic() - started, 0.9)
+
+
+if __name__ == "__main__":
+    unittest.main()
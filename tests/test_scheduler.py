@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Ordering, weights and admission control of the control socket's FairScheduler.
+Run from the repository root: python3 -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "mmvmm"))
+
+from scheduler import FairScheduler  # noqa: E402
+
+
+class FairSchedulerTest(unittest.TestCase):
+
+    def _drain(self, scheduler: FairScheduler) -> list:
+        items = []
+        while scheduler:
+            items.append(scheduler.dequeue())
+        return items
+
+    def test_flow_order_is_kept(self):
+        scheduler = FairScheduler()
+        scheduler.add_flow("a", "a")
+
+        for i in range(5):
+            scheduler.enqueue("a", "start" if i == 3 else "get_list", i)
+
+        # A lifecycle command does not overtake the earlier commands of it's own connection
+        self.assertEqual(self._drain(scheduler), [0, 1, 2, 3, 4])
+
+    def test_flows_are_interleaved(self):
+        scheduler = FairScheduler()
+        scheduler.add_flow("flood", "flood")
+        scheduler.add_flow("interactive", "interactive")
+
+        for i in range(100):
+            scheduler.enqueue("flood", "get_list", ("flood", i))
+        scheduler.enqueue("interactive", "get_list", ("interactive", 0))
+
+        self.assertIn(("interactive", 0), self._drain(scheduler)[:2])
+
+    def test_priority_of_head_command(self):
+        scheduler = FairScheduler()
+        scheduler.add_flow("reader", "reader")
+        scheduler.add_flow("admin", "admin")
+
+        scheduler.enqueue("reader", "query", "query")
+        scheduler.enqueue("admin", "poweroff", "poweroff")
+
+        self.assertEqual(scheduler.dequeue(), "poweroff")
+        self.assertEqual(scheduler.dequeue(), "query")
+        self.assertIsNone(scheduler.dequeue())
+
+    def test_weights(self):
+        scheduler = FairScheduler()
+        scheduler.add_flow("heavy", "heavy", 1.0)
+        scheduler.add_flow("light", "light", 0.25)
+
+        for i in range(100):
+            scheduler.enqueue("heavy", "set_ram", "heavy")
+            scheduler.enqueue("light", "set_ram", "light")
+
+        served = [scheduler.dequeue() for _ in range(50)]
+        self.assertEqual(served.count("heavy"), 40)
+        self.assertEqual(served.count("light"), 10)
+
+    def test_configure_flow(self):
+        scheduler = FairScheduler()
+        scheduler.add_flow("a", "connection1")
+        scheduler.configure_flow("a", "backup", 0.5)
+
+        flow = scheduler.stats()['flows'][0]
+        self.assertEqual((flow['name'], flow['weight']), ("backup", 0.5))
+
+    def test_rate_limited(self):
+        scheduler = FairScheduler(rate=1, burst=3)
+        scheduler.add_flow("a", "a")
+        scheduler.add_flow("b", "b")
+
+        self.assertEqual([scheduler.enqueue("a", "get_list", i) for i in range(4)], [None, None, None, "rate_limited"])
+        self.assertIsNone(scheduler.enqueue("b", "get_list", 0))  # the buckets are per connection
+
+        stats = scheduler.stats()
+        self.assertEqual(stats['rejected']['rate_limited'], 1)
+        self.assertEqual(stats['queued'], 4)
+
+    def test_queue_limits(self):
+        scheduler = FairScheduler(max_queued_per_flow=2, max_queued=3)
+        scheduler.add_flow("a", "a")
+        scheduler.add_flow("b", "b")
+
+        self.assertEqual([scheduler.enqueue("a", "get_list", i) for i in range(3)], [None, None, "flow_queue_full"])
+        self.assertEqual([scheduler.enqueue("b", "get_list", i) for i in range(2)], [None, "queue_full"])
+
+        self.assertEqual(scheduler.dequeue(), 0)  # room again
+        self.assertIsNone(scheduler.enqueue("b", "get_list", 1))
+
+    def test_remove_flow(self):
+        scheduler = FairScheduler()
+        scheduler.add_flow("a", "a")
+        scheduler.enqueue("a", "get_list", 0)
+        scheduler.enqueue("a", "get_list", 1)
+
+        self.assertEqual(scheduler.remove_flow("a"), [0, 1])
+        self.assertFalse(scheduler)
+        self.assertEqual(scheduler.stats()['connections'], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
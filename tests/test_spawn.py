@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Starting processes into cgroups, on a plain directory standing in for the cgroup hierarchy.
+Run from the repository root: python3 -m unittest discover tests
+"""
+import os
+import sys
+import time
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+
+from fakes import install_fakes, make_description  # noqa: E402
+
+import cgroup  # noqa: E402
+from vm import VM  # noqa: E402
+from spawn import spawn  # noqa: E402
+from exception import VMCGroupError  # noqa: E402
+
+
+class SpawnTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="mmvmm-test-")
+
+    def test_joins_cgroup(self):
+        procs = os.path.join(self.workdir, "cgroup.procs")
+
+        process = spawn(["/bin/sleep", "10"], pidfd=True, cgroup_procs=procs)
+        try:
+            with open(procs, "r") as f:
+                self.assertEqual(f.read().split(), [str(process.pid)])
+            self.assertIsNone(process.poll())  # the same pid runs the command
+        finally:
+            process.kill()
+            process.wait()
+
+    def test_join_failure(self):
+        procs = os.path.join(self.workdir, "missing", "cgroup.procs")
+
+        with self.assertRaises(VMCGroupError):
+            spawn(["/bin/sleep", "10"], pidfd=True, cgroup_procs=procs)
+
+    def test_vm_started_without_cgroup(self):
+        install_fakes(self.workdir)
+        original = cgroup.CGroup.get_procs_path
+        cgroup.CGroup.get_procs_path = lambda self: os.path.join(self._path, "missing", "cgroup.procs")
+        self.addCleanup(setattr, cgroup.CGroup, "get_procs_path", original)
+
+        vm = VM("nocgroup", make_description(0))
+        vm.start()
+        self.addCleanup(vm.terminate, kill=True)
+
+        self.assertFalse(vm.in_cgroup())
+
+        started = time.monotonic()
+        while not vm._qmp.is_online():  # QEMU is running regardless
+            self.assertLess(time.monotonic() - started, 10, "QMP did not come online")
+            time.sleep(0.01)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Cloning VMs from templates, on the in-memory object store and the fake QEMU of the benchmarks.
+Run from the repository root: python3 -m unittest discover tests
+"""
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+
+from fakes import install_fakes, make_description, MemoryObjectStore  # noqa: E402
+
+import disk_image  # noqa: E402
+from vm_manager import VMMAnager  # noqa: E402
+from exception import VMTemplateError  # noqa: E402
+
+
+class TemplateTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.workdir = tempfile.mkdtemp(prefix="mmvmm-test-")
+        install_fakes(cls.workdir)
+        disk_image.QEMU_IMG_BINARY = "/bin/true"  # the overlay files are still claimed, only left empty
+
+    def setUp(self):
+        self.manager = VMMAnager(MemoryObjectStore())
+
+        description = make_description(0)
+        description['hardware']['media'][0]['path'] = os.path.join(tempfile.mkdtemp(dir=self.workdir), "base.qcow2")
+        self.manager.new("base", description)
+
+    def tearDown(self):
+        self.manager.close(timeout=10)
+
+    def test_template_survives_sync(self):
+        result = self.manager.execute_command(None, "clone", {"template": "base", "names": ["clone1"]})
+        self.assertEqual(result, {"created": ["clone1"], "failed": {}})
+
+        self.manager.execute_command(None, "sync", {})
+
+        with self.assertRaises(VMTemplateError):
+            self.manager.execute_command("base", "start", {})
+
+    def test_release_survives_sync(self):
+        self.manager.execute_command(None, "clone", {"template": "base", "names": ["clone1"]})
+        self.manager.execute_command(None, "delete", {"name": "clone1"})
+        self.manager.execute_command(None, "release_template", {"name": "base"})
+
+        self.manager.execute_command(None, "sync", {})
+
+        self.assertFalse(self.manager.execute_command("base", "dump_description", {})['template'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+I/O limits and QoS classes of the drives, on the fake QEMU of the benchmarks.
+Run from the repository root: python3 -m unittest discover tests
+"""
+import os
+import sys
+import time
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+
+from fakes import install_fakes, make_description  # noqa: E402
+
+from vm import VM  # noqa: E402
+
+
+class ThrottleTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        install_fakes(tempfile.mkdtemp(prefix="mmvmm-test-"))
+
+    def setUp(self):
+        description = make_description(0)
+        description['hardware']['media'][0]['qos'] = "gold"
+        description['hardware']['media'].append({"type": "disk", "path": "/var/lib/mmvmm/second.qcow2", "format": "qcow2", "qos": "gold"})
+
+        self.qos_classes = {"gold": VM.throttle_schema.load({"iops": 500})}
+        self.vm = VM("throttled", description, qos_classes=self.qos_classes)
+
+    def _start(self) -> list:
+        self.vm.start()
+        self.addCleanup(self.vm.terminate, kill=True)
+
+        started = time.monotonic()
+        while not self.vm._qmp.is_online():
+            self.assertLess(time.monotonic() - started, 10, "QMP did not come online")
+            time.sleep(0.01)
+
+        commands = []
+        execute = self.vm._qmp_execute
+
+        def recording_execute(command: str, arguments: dict = None):
+            commands.append((command, arguments))
+            return execute(command, arguments)
+
+        self.vm._qmp_execute = recording_execute
+        return commands
+
+    def test_qos_class_limits_on_every_member(self):
+        args = self.vm._media_args(self.vm.dump_description()['hardware'])
+        drives = [args[i + 1] for i, arg in enumerate(args) if arg == '-drive']
+
+        self.assertEqual(len(drives), 2)
+        for drive in drives:  # QEMU only puts a drive into the group if it has limits
+            self.assertIn("throttling.iops-total=500", drive)
+            self.assertIn("throttling.group=qos-gold", drive)
+
+    def test_unlimited_qos_class(self):
+        self.qos_classes['gold'] = VM.throttle_schema.load({})
+
+        args = self.vm._media_args(self.vm.dump_description()['hardware'])
+        self.assertFalse([arg for arg in args if 'throttling' in arg])
+
+    def test_qos_class_applied_to_every_member(self):
+        commands = self._start()
+
+        self.qos_classes['gold'] = VM.throttle_schema.load({"iops": 1000})
+        self.vm.apply_qos_class("gold")
+
+        throttles = [arguments for command, arguments in commands if command == "block_set_io_throttle"]
+        self.assertEqual([(a['device'], a['group'], a['iops']) for a in throttles], [("drive0", "qos-gold", 1000), ("drive1", "qos-gold", 1000)])
+
+    def test_own_limits_leave_the_group(self):
+        commands = self._start()
+
+        self.vm.set_io_throttle(1, {"iops": 20})
+
+        # In a group of it's own, otherwise the limits of the class (and so of drive0) would be overwritten
+        self.assertEqual([command for command, _ in commands], ["block_set_io_throttle"])
+        arguments = commands[0][1]
+        self.assertEqual((arguments['device'], arguments['group'], arguments['iops']), ("drive1", "drive1", 20))
+
+
+if __name__ == "__main__":
+    unittest.main()
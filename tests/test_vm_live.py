@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Live description changes of a VM running on the fake QEMU of the benchmarks.
+Run from the repository root: python3 -m unittest discover tests
+"""
+import os
+import sys
+import copy
+import time
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+
+from fakes import install_fakes, make_description  # noqa: E402
+
+from vm import VM  # noqa: E402
+
+
+class LiveUpdateTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        install_fakes(tempfile.mkdtemp(prefix="mmvmm-test-"))
+
+    def setUp(self):
+        description = make_description(0)
+        description['hardware'].update({"cpu": 2, "max_cpu": 4, "ram": 1024, "max_ram": 4096})
+        description['hardware']['media'].append({"type": "disk", "path": "/var/lib/mmvmm/second.qcow2", "format": "qcow2"})
+
+        self.vm = VM("live", description)
+        self.vm.start()
+
+        started = time.monotonic()
+        while not self.vm._qmp.is_online():
+            self.assertLess(time.monotonic() - started, 10, "QMP did not come online")
+            time.sleep(0.01)
+
+        self.commands = []
+        execute = self.vm._qmp_execute
+
+        def recording_execute(command: str, arguments: dict = None):
+            self.commands.append(command)
+            return execute(command, arguments)
+
+        self.vm._qmp_execute = recording_execute
+
+    def tearDown(self):
+        self.vm.terminate(kill=True)
+
+    def _update(self, **hardware) -> dict:
+        description = self.vm.dump_description()
+        description['hardware'].update(hardware)
+        return self.vm.update_description(description)
+
+    def test_ram_pending_change_reverted(self):
+        self.assertIn("ram: 1024 -> 512", self._update(ram=512)['pending_restart'])
+
+        result = self._update(ram=1024)
+        self.assertEqual(result, {"applied": [], "pending_restart": []})
+        self.assertNotIn("object-add", self.commands)
+        self.assertEqual(self.vm.get_pending_restart(), [])
+
+        result = self._update(ram=1536)
+        self.assertEqual(result['applied'], ["ram: 1024 -> 1536"])
+        self.assertEqual(self.commands.count("object-add"), 1)
+
+    def test_cpu_pending_change_reverted(self):
+        self.assertIn("cpu: 2 -> 1", self._update(cpu=1)['pending_restart'])
+
+        self.assertEqual(self._update(cpu=2), {"applied": [], "pending_restart": []})
+        self.assertNotIn("device_add", self.commands)
+
+        self.assertEqual(self._update(cpu=3)['applied'], ["cpu: 2 -> 3"])
+        self.assertEqual(self.commands.count("device_add"), 1)
+
+    def test_disk_added_over_pending_removal(self):
+        original = self.vm.dump_description()['hardware']['media']
+
+        self.assertIn("media 1: removed", self._update(media=original[:1])['pending_restart'])
+
+        replacement = {"type": "disk", "path": "/var/lib/mmvmm/third.qcow2", "format": "qcow2"}
+        result = self._update(media=original[:1] + [replacement])
+        self.assertEqual(result['pending_restart'], ["media 1: drive changed"])
+        self.assertNotIn("blockdev-add", self.commands)
+
+        # The limits are meant for the new disk, the old one must not be throttled
+        self.vm.set_io_throttle(1, {"iops": 100})
+        self.assertNotIn("block_set_io_throttle", self.commands)
+
+        restored = copy.deepcopy(original)
+        restored[1]['throttle'] = {"iops": 100}
+        result = self._update(media=restored)
+        self.assertEqual(result, {"applied": ["media 1: throttle changed"], "pending_restart": []})
+
+
+if __name__ == "__main__":
+    unittest.main()